@@ -0,0 +1,67 @@
+#!/bin/bash
+#$ -cwd
+#$ -pe smp 4
+#$ -l h_rt=1:0:0
+#$ -l h_vmem=8G
+#$ -j n
+#$ -o /data/home/qc25022/CancEHR-Tokenisation/HPC_Files/logo/
+#$ -e /data/home/qc25022/CancEHR-Tokenisation/HPC_Files/loge/
+
+# Encode the shards of a run as an array job, one task per slice of the shards.
+# Fit once, run the array, then merge once the array has finished:
+#   qsub -N tok_fit run_tokenisation_array.sh fit
+#   qsub -N tok_encode -hold_jid tok_fit -t 1-8 run_tokenisation_array.sh encode
+#   qsub -N tok_merge -hold_jid tok_encode run_tokenisation_array.sh merge
+# With SLURM use sbatch --dependency=afterok:<job id> and --array=1-8, SLURM_ARRAY_TASK_ID is used instead.
+
+set -e
+
+# Set the base directory for your project
+BASE_DIR="/data/home/qc25022/CancEHR-Tokenisation"
+
+# --- Environment Setup ---
+module load intel intel-mpi python
+source /data/home/qc25022/CancEHR-Tokenisation/env/bin/activate
+
+# --- Path Definitions ---
+CONFIG_FILE="${BASE_DIR}/src/pipelines/config/cprd_test.yaml"
+RUN_NAME="cprd_upgi"
+NUM_SHARDS=8
+STEP="$1"
+
+# --- Execute from Project Root ---
+cd "${BASE_DIR}"
+
+case "${STEP}" in
+	fit)
+		python -m src.pipelines.run \
+			--config_filepath "${CONFIG_FILE}" \
+			--run_name "${RUN_NAME}" \
+			--overwrite \
+			--fit_only \
+			--workers 4
+		;;
+	encode)
+		# array task ids start at 1
+		TASK_ID="${SGE_TASK_ID:-${SLURM_ARRAY_TASK_ID}}"
+		python -m src.pipelines.run \
+			--config_filepath "${CONFIG_FILE}" \
+			--run_name "${RUN_NAME}" \
+			--num_shards "${NUM_SHARDS}" \
+			--shard_index "$((TASK_ID - 1))" \
+			--workers 4
+		;;
+	merge)
+		python -m src.pipelines.run \
+			--config_filepath "${CONFIG_FILE}" \
+			--run_name "${RUN_NAME}" \
+			--num_shards "${NUM_SHARDS}" \
+			--merge
+		;;
+	*)
+		echo "Usage: $0 fit|encode|merge"
+		exit 1
+		;;
+esac
+echo "Step ${STEP} finished."
+deactivate
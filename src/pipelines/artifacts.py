@@ -0,0 +1,252 @@
+import os
+import json
+import shutil
+import importlib
+from collections import OrderedDict
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+import numpy as np
+import polars as pl
+from src.preprocessing.base import BasePreprocessor
+from src.preprocessing.sketch import KLLSketch
+from src.postprocessing.base import Postprocessor
+from src.tokenization.algorithms.base import Tokenizer
+from src.pipelines.manifest import hash_fitted_state
+
+ARTIFACTS_DIRNAME = "artifacts"
+ARTIFACTS_FILENAME = "artifacts.json"
+ARTIFACTS_VERSION = 1
+
+# Only classes from these packages, and of these types, are rebuilt when artifacts are loaded
+ARTIFACT_MODULES = ("src.preprocessing.", "src.postprocessing.", "src.tokenization.")
+ARTIFACT_CLASSES = (BasePreprocessor, Postprocessor, Tokenizer, KLLSketch)
+
+def save_artifacts(directory: str, config: dict, tokenizer: Tokenizer, preprocessors: List[BasePreprocessor]) -> str:
+    """
+    Save the fitted tokenizer and preprocessors to an artifact directory, without pickling anything.
+    The state of every object is written as JSON, numpy arrays as .npy files (allow_pickle=False) and
+    DataFrames as parquet files, so loading the artifacts never executes stored code. The directory is
+    written next to its destination and moved into place once complete.
+
+    Args:
+        directory (str): the artifact directory, replaced if it exists
+        config (dict): the pipeline config the objects were built from
+        tokenizer (Tokenizer): the fitted tokenizer
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors, in the order they are applied
+
+    Returns:
+        str: the fitted state hash of the saved objects, see manifest.hash_fitted_state
+    """
+    tmp_directory = f"{directory}.tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    os.makedirs(tmp_directory)
+
+    writer = _ArtifactWriter(tmp_directory)
+    fitted_state_hash = hash_fitted_state(tokenizer, preprocessors)
+    data = {
+        "version": ARTIFACTS_VERSION,
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "config": config,
+        "fitted_state_hash": fitted_state_hash,
+        "tokenizer": writer.encode(tokenizer),
+        "preprocessors": [writer.encode(preprocessor) for preprocessor in preprocessors],
+    }
+    with open(os.path.join(tmp_directory, ARTIFACTS_FILENAME), "w") as f:
+        json.dump(data, f, indent=1, default=str)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_directory, directory)
+    return fitted_state_hash
+
+def load_artifacts(directory: str) -> Tuple[dict, Tokenizer, List[BasePreprocessor]]:
+    """
+    Load the fitted tokenizer and preprocessors saved by save_artifacts.
+    The loaded objects are checked against the fitted state hash recorded when they were saved.
+
+    Args:
+        directory (str): the artifact directory, or a run directory containing one
+
+    Returns:
+        Tuple[dict, Tokenizer, List[BasePreprocessor]]: the pipeline config, the tokenizer and the preprocessors
+    """
+    if not os.path.exists(os.path.join(directory, ARTIFACTS_FILENAME)) and os.path.isdir(os.path.join(directory, ARTIFACTS_DIRNAME)):
+        directory = os.path.join(directory, ARTIFACTS_DIRNAME)
+    path = os.path.join(directory, ARTIFACTS_FILENAME)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No artifacts found in {directory}")
+
+    with open(path, "r") as f:
+        data = json.load(f)
+    if data.get("version") != ARTIFACTS_VERSION:
+        raise ValueError(f"Unsupported artifacts version {data.get('version')} in {path}, expected {ARTIFACTS_VERSION}")
+
+    reader = _ArtifactReader(directory)
+    tokenizer = reader.decode(data["tokenizer"])
+    preprocessors = [reader.decode(preprocessor) for preprocessor in data["preprocessors"]]
+
+    if hash_fitted_state(tokenizer, preprocessors) != data["fitted_state_hash"]:
+        raise RuntimeError(f"The fitted state loaded from {directory} does not match the state that was saved")
+    return data["config"], tokenizer, preprocessors
+
+class _ArtifactWriter:
+    """Encodes objects as JSON, writing arrays, DataFrames and Hugging Face tokenizers to files in the directory."""
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = 0
+
+    def _path(self, subdirectory: str, extension: str) -> str:
+        """A new file path relative to the artifact directory."""
+        os.makedirs(os.path.join(self.directory, subdirectory), exist_ok=True)
+        self.files += 1
+        return f"{subdirectory}/{self.files}{extension}"
+
+    def encode(self, obj: Any) -> Any:
+        """
+        Encode an object as JSON data. Lists and strings, numbers, booleans and None are stored as they are,
+        every other type is a single key object naming the type.
+
+        Args:
+            obj (Any): the object
+
+        Returns:
+            Any: JSON-serialisable data
+        """
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        if isinstance(obj, list):
+            return [self.encode(value) for value in obj]
+        if isinstance(obj, tuple):
+            return {"$tuple": [self.encode(value) for value in obj]}
+        if isinstance(obj, (set, frozenset)):
+            return {"$set" if isinstance(obj, set) else "$frozenset": [self.encode(value) for value in obj]}
+        if isinstance(obj, dict):
+            # items rather than a JSON object, keys need not be strings and the order is kept
+            return {"$ordereddict" if isinstance(obj, OrderedDict) else "$dict": [[self.encode(key), self.encode(value)] for key, value in obj.items()]}
+        if isinstance(obj, np.generic):
+            return {"$numpy_scalar": [obj.dtype.str, obj.item()]}
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject:
+                return {"$object_array": [self.encode(value) for value in obj.tolist()]}
+            path = self._path("arrays", ".npy")
+            np.save(os.path.join(self.directory, path), obj, allow_pickle=False)
+            return {"$ndarray": path}
+        if isinstance(obj, pl.DataFrame):
+            path = self._path("frames", ".parquet")
+            obj.write_parquet(os.path.join(self.directory, path))
+            return {"$dataframe": path}
+        if isinstance(obj, pl.Series):
+            path = self._path("frames", ".parquet")
+            obj.to_frame().write_parquet(os.path.join(self.directory, path))
+            return {"$series": path}
+        if isinstance(obj, pl.DataType) or (isinstance(obj, type) and issubclass(obj, pl.DataType)):
+            # the dtype of an empty column, parquet stores every Polars dtype the preprocessors use.
+            # Dtype classes such as pl.Int64 (rather than pl.Int64()) are stored as an instance
+            path = self._path("frames", ".parquet")
+            pl.DataFrame(schema={"dtype": obj}).write_parquet(os.path.join(self.directory, path))
+            return {"$dtype_class" if isinstance(obj, type) else "$dtype": path}
+        if isinstance(obj, datetime):
+            return {"$datetime": obj.isoformat()}
+        if isinstance(obj, date):
+            return {"$date": obj.isoformat()}
+        if isinstance(obj, Path):
+            return {"$path": str(obj)}
+        if type(obj).__name__ == "PreTrainedTokenizerFast":
+            path = self._path("hf", "")
+            obj.save_pretrained(os.path.join(self.directory, path))
+            return {"$hf_tokenizer": path}
+        if isinstance(obj, ARTIFACT_CLASSES):
+            # caches named in _transient_state are rebuilt after loading
+            transient = getattr(obj, "_transient_state", ())
+            state = {key: value for key, value in vars(obj).items() if key not in transient}
+            return {"$object": f"{type(obj).__module__}:{type(obj).__qualname__}", "state": {key: self.encode(value) for key, value in state.items()}}
+        raise ValueError(f"Cannot save objects of type {type(obj).__qualname__} as artifacts")
+
+class _ArtifactReader:
+    """Decodes the JSON data of _ArtifactWriter, reading the files it refers to."""
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _file(self, path: str) -> str:
+        """The absolute path of a file in the artifact directory, refusing paths outside it."""
+        full_path = os.path.realpath(os.path.join(self.directory, path))
+        if os.path.commonpath([full_path, os.path.realpath(self.directory)]) != os.path.realpath(self.directory):
+            raise ValueError(f"Artifact file {path} is outside the artifact directory")
+        return full_path
+
+    def decode(self, data: Any) -> Any:
+        """
+        Decode JSON data written by _ArtifactWriter.encode.
+
+        Args:
+            data (Any): the JSON data
+
+        Returns:
+            Any: the object
+        """
+        if data is None or isinstance(data, (bool, int, float, str)):
+            return data
+        if isinstance(data, list):
+            return [self.decode(value) for value in data]
+
+        if "$object" in data:
+            return self._decode_object(data["$object"], data["state"])
+        (tag, value), = data.items()
+        if tag == "$tuple":
+            return tuple(self.decode(item) for item in value)
+        if tag == "$set":
+            return {self.decode(item) for item in value}
+        if tag == "$frozenset":
+            return frozenset(self.decode(item) for item in value)
+        if tag in ("$dict", "$ordereddict"):
+            items = [(self.decode(key), self.decode(item)) for key, item in value]
+            return OrderedDict(items) if tag == "$ordereddict" else dict(items)
+        if tag == "$numpy_scalar":
+            return np.dtype(value[0]).type(value[1])
+        if tag == "$object_array":
+            array = np.empty(len(value), dtype=object)
+            array[:] = [self.decode(item) for item in value]
+            return array
+        if tag == "$ndarray":
+            return np.load(self._file(value), allow_pickle=False)
+        if tag == "$dataframe":
+            return pl.read_parquet(self._file(value))
+        if tag == "$series":
+            return pl.read_parquet(self._file(value)).to_series()
+        if tag == "$dtype":
+            return pl.read_parquet_schema(self._file(value))["dtype"]
+        if tag == "$dtype_class":
+            return type(pl.read_parquet_schema(self._file(value))["dtype"])
+        if tag == "$datetime":
+            return datetime.fromisoformat(value)
+        if tag == "$date":
+            return date.fromisoformat(value)
+        if tag == "$path":
+            return Path(value)
+        if tag == "$hf_tokenizer":
+            from transformers import PreTrainedTokenizerFast
+            return PreTrainedTokenizerFast.from_pretrained(self._file(value))
+        raise ValueError(f"Unknown artifact type {tag}")
+
+    def _decode_object(self, name: str, state: Dict[str, Any]) -> Any:
+        """Rebuild a preprocessor, postprocessor, tokenizer or sketch from its saved attributes, without calling __init__."""
+        module_name, _, qualname = name.partition(":")
+        if not module_name.startswith(ARTIFACT_MODULES):
+            raise ValueError(f"Refusing to load {name}: only classes from {ARTIFACT_MODULES} can be loaded")
+        cls = importlib.import_module(module_name)
+        for attribute in qualname.split("."):
+            cls = getattr(cls, attribute)
+        if not (isinstance(cls, type) and issubclass(cls, ARTIFACT_CLASSES)):
+            raise ValueError(f"Refusing to load {name}: not a preprocessor, postprocessor, tokenizer or sketch")
+
+        obj = cls.__new__(cls)
+        obj.__dict__.update({key: self.decode(value) for key, value in state.items()})
+        if hasattr(obj, "_reset_transient_state"):
+            obj._reset_transient_state()
+        return obj
+
+def artifacts_directory(run_directory: str) -> str:
+    """The artifact directory of a run directory."""
+    return os.path.join(run_directory, ARTIFACTS_DIRNAME)
@@ -0,0 +1,63 @@
+import os
+from typing import List, Optional
+from src.pipelines.artifacts import load_artifacts
+from src.pipelines.output import OUTPUT_FORMATS
+from src.pipelines.run import build_postprocessors, encode_files
+
+def gather_event_files(paths: List[str]) -> List[str]:
+    """
+    Expand a list of parquet files and directories of parquet files into the parquet files.
+
+    Args:
+        paths (List[str]): parquet files or directories containing them
+
+    Returns:
+        List[str]: the parquet files, directories are listed in name order
+    """
+    event_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            event_files.extend(os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith(".parquet"))
+        elif os.path.exists(path):
+            event_files.append(path)
+        else:
+            raise FileNotFoundError(f"Event file not found: {path}")
+    return event_files
+
+def encode_with_artifacts(artifacts: str, event_files: List[str], output_directory: str, workers: int = 1, output_format: Optional[str] = None, row_budget: Optional[int] = None) -> None:
+    """
+    Encode event files with the preprocessors and tokenizer saved by a previous run, without fitting anything.
+    Postprocessors hold no fitted state, they are rebuilt from the config saved with the artifacts.
+
+    Args:
+        artifacts (str): the artifact directory, or the run directory containing it
+        event_files (List[str]): the parquet files to encode
+        output_directory (str): the directory the encoded files are written to
+        workers (int): number of worker processes to encode with (1 encodes serially)
+        output_format (Optional[str]): one of OUTPUT_FORMATS, None uses the format of the run
+        row_budget (Optional[int]): if positive, files are read and encoded about this many event rows at a time,
+            None uses the encode_row_budget of the run
+    """
+    config, tokenizer, preprocessors = load_artifacts(artifacts)
+    postprocessors = build_postprocessors(config)
+    output_format = output_format or config.get("output_format", "pkl")
+    row_budget = config.get("encode_row_budget", 0) if row_budget is None else row_budget
+
+    os.makedirs(output_directory, exist_ok=True)
+    print(f"Encoding {len(event_files)} files with the artifacts in {artifacts}")
+    encode_files(tokenizer, event_files, output_directory, preprocessors, postprocessors, workers=workers, output_format=output_format, row_budget=row_budget)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Encode event files with the fitted preprocessors and tokenizer of a previous run.")
+    parser.add_argument("--artifacts", type=str, required=True, help="The artifacts directory of a run, or the run directory.")
+    parser.add_argument("--event_files", type=str, nargs="+", required=True, help="Parquet files, or directories of parquet files, to encode.")
+    parser.add_argument("--output_directory", type=str, required=True, help="Directory the encoded files are written to.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to encode files in parallel.")
+    parser.add_argument("--output_format", type=str, default=None, choices=list(OUTPUT_FORMATS), help="Format of the encoded files, defaults to the format of the run.")
+    parser.add_argument("--row_budget", type=int, default=None, help="Read and encode files this many event rows at a time (0 reads whole files), defaults to the encode_row_budget of the run.")
+
+    args = parser.parse_args()
+
+    encode_with_artifacts(args.artifacts, gather_event_files(args.event_files), args.output_directory, args.workers, args.output_format, args.row_budget)
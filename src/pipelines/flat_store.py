@@ -0,0 +1,202 @@
+import os
+import json
+from typing import Dict, Iterable, Optional, Tuple
+import numpy as np
+from tqdm import tqdm
+from src.pipelines.output import OUTPUT_FORMATS, iter_timelines, output_extension
+from src.pipelines.manifest import RunManifest
+
+TOKENS_FILENAME = "tokens.bin"
+TIMESTAMPS_FILENAME = "timestamps.bin"
+INDEX_FILENAME = "index.npy"
+META_FILENAME = "meta.json"
+
+# One row per subject, tokens[offset:offset + length] are the subject's tokens
+INDEX_DTYPE = np.dtype([("subject_id", np.int64), ("offset", np.int64), ("length", np.int64)])
+
+def token_dtype_for_vocab(max_token_id: int) -> np.dtype:
+    """
+    Get the smallest unsigned dtype that can hold every token id of a vocabulary.
+
+    Args:
+        max_token_id (int): the largest token id in the vocabulary
+
+    Returns:
+        np.dtype: uint16 or uint32
+    """
+    return np.dtype(np.uint16) if max_token_id <= np.iinfo(np.uint16).max else np.dtype(np.uint32)
+
+def find_encoded_shards(split_directory: str, output_format: Optional[str] = None) -> list:
+    """
+    Get the encoded shards of a split directory in a stable order.
+
+    Args:
+        split_directory (str): e.g. <run_directory>/train
+        output_format (Optional[str]): only find shards in this output format, any of OUTPUT_FORMATS if None
+
+    Returns:
+        list: the paths of the encoded shards
+    """
+    extensions = (output_extension(output_format),) if output_format is not None else tuple(OUTPUT_FORMATS.values())
+    return sorted(
+        os.path.join(split_directory, file)
+        for file in os.listdir(split_directory)
+        if file.endswith(extensions)
+    )
+
+def write_flat_store(shard_paths: Iterable[str], output_directory: str, token_dtype: np.dtype) -> Dict:
+    """
+    Concatenate the encoded shards of one split into a flat token store: a contiguous
+    tokens.bin and timestamps.bin (int64 seconds since the epoch) plus an index of
+    (subject_id, offset, length) rows. Shards are streamed, so the split is never held in memory.
+
+    Args:
+        shard_paths (Iterable[str]): encoded shards written by the pipeline
+        output_directory (str): the directory to write the store to
+        token_dtype (np.dtype): the on-disk dtype of token ids (see token_dtype_for_vocab)
+
+    Returns:
+        Dict: the store metadata written to meta.json
+    """
+    token_dtype = np.dtype(token_dtype)
+    max_token_id = np.iinfo(token_dtype).max
+    os.makedirs(output_directory, exist_ok=True)
+
+    index_rows = []
+    offset = 0
+    with open(os.path.join(output_directory, TOKENS_FILENAME), "wb") as tokens_file, \
+         open(os.path.join(output_directory, TIMESTAMPS_FILENAME), "wb") as timestamps_file:
+        for shard_path in tqdm(list(shard_paths), desc=f"Writing flat store {output_directory}", leave=False):
+            for timeline in iter_timelines(shard_path):
+                tokens = np.asarray(timeline["tokens"], dtype=np.int64)
+                if tokens.size and (tokens.min() < 0 or tokens.max() > max_token_id):
+                    raise ValueError(f"Token ids of subject {timeline['subject_id']} in {shard_path} do not fit in {token_dtype}")
+                timestamps = np.rint(np.asarray(timeline["timestamps"], dtype=np.float64)).astype(np.int64)
+
+                tokens.astype(token_dtype).tofile(tokens_file)
+                timestamps.tofile(timestamps_file)
+                index_rows.append((timeline["subject_id"], offset, len(tokens)))
+                offset += len(tokens)
+
+    np.save(os.path.join(output_directory, INDEX_FILENAME), np.array(index_rows, dtype=INDEX_DTYPE))
+
+    meta = {
+        "token_dtype": token_dtype.name,
+        "timestamp_dtype": "int64",
+        "num_subjects": len(index_rows),
+        "num_tokens": offset,
+    }
+    with open(os.path.join(output_directory, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+def export_flat_store(run_directory: str, splits: Iterable[str], max_token_id: int, store_directory: Optional[str] = None, output_format: Optional[str] = None) -> None:
+    """
+    Write a flat token store for each split of a finished run to <run_directory>/flat/<split>.
+    The shards recorded in the run's manifest are exported, so files left from earlier runs are ignored.
+    Runs without a manifest export the shards found in each split directory.
+
+    Args:
+        run_directory (str): the run directory with one subdirectory of encoded shards per split
+        splits (Iterable[str]): the splits to export
+        max_token_id (int): the largest token id in the vocabulary
+        store_directory (Optional[str]): where to write the stores, defaults to <run_directory>/flat
+        output_format (Optional[str]): the output format of the shards, used when there is no manifest
+    """
+    store_directory = store_directory or os.path.join(run_directory, "flat")
+    token_dtype = token_dtype_for_vocab(max_token_id)
+    manifest = RunManifest.load(run_directory)
+    for split in splits:
+        shard_paths = manifest.outputs(split) if manifest.shards else find_encoded_shards(os.path.join(run_directory, split), output_format)
+        meta = write_flat_store(shard_paths, os.path.join(store_directory, split), token_dtype)
+        print(f"Flat store {split}: {meta['num_subjects']} subjects, {meta['num_tokens']} tokens ({meta['token_dtype']})")
+
+
+class FlatTokenStore:
+    """
+    Read-only view of a flat token store. tokens.bin and timestamps.bin are memory-mapped,
+    so per-subject slices are zero-copy and every process reading the store shares the
+    page cache. Pickling only sends the directory, the files are re-mapped on unpickling,
+    which makes the store cheap to hand to dataloader workers.
+
+    Args:
+        directory (str): a directory written by write_flat_store
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._open()
+
+    def _open(self) -> None:
+        with open(os.path.join(self.directory, META_FILENAME), "r") as f:
+            self.meta = json.load(f)
+        self.index = np.load(os.path.join(self.directory, INDEX_FILENAME))
+        self.tokens = self._map(TOKENS_FILENAME, np.dtype(self.meta["token_dtype"]))
+        self.timestamps = self._map(TIMESTAMPS_FILENAME, np.dtype(self.meta["timestamp_dtype"]))
+        self._positions = {int(subject_id): i for i, subject_id in enumerate(self.index["subject_id"])}
+
+    def _map(self, filename: str, dtype: np.dtype) -> np.ndarray:
+        # np.memmap cannot map an empty file
+        if self.meta["num_tokens"] == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, filename), dtype=dtype, mode="r", shape=(self.meta["num_tokens"],))
+
+    def __getstate__(self) -> Dict:
+        return {"directory": self.directory}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.directory = state["directory"]
+        self._open()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the tokens and timestamps of the subject at a position in the index.
+
+        Args:
+            position (int): the position of the subject in the index
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: zero-copy views of the subject's tokens and timestamps
+        """
+        _, offset, length = self.index[position]
+        return self.tokens[offset:offset + length], self.timestamps[offset:offset + length]
+
+    @property
+    def subject_ids(self) -> np.ndarray:
+        """The subject ids in index order."""
+        return self.index["subject_id"]
+
+    def get(self, subject_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the tokens and timestamps of a subject.
+
+        Args:
+            subject_id (int): the subject to look up
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: zero-copy views of the subject's tokens and timestamps
+        """
+        if subject_id not in self._positions:
+            raise KeyError(f"Subject {subject_id} not found in flat store {self.directory}")
+        return self[self._positions[subject_id]]
+
+
+if __name__ == "__main__":
+
+    import argparse
+    import polars as pl
+    parser = argparse.ArgumentParser(description="Export the encoded shards of a finished run as flat token stores.")
+    parser.add_argument("--run_directory", type=str, required=True)
+    parser.add_argument("--splits", nargs="+", default=["train", "tuning", "held_out"])
+
+    args = parser.parse_args()
+
+    vocab = pl.read_csv(os.path.join(args.run_directory, "vocab.csv"))
+    output_format = None
+    if os.path.exists(os.path.join(args.run_directory, "config.yaml")):
+        import yaml
+        with open(os.path.join(args.run_directory, "config.yaml"), "r") as f:
+            output_format = yaml.safe_load(f).get("output_format", "pkl")
+    export_flat_store(args.run_directory, args.splits, int(vocab["token"].max()), output_format=output_format)
@@ -0,0 +1,285 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import numpy as np
+import polars as pl
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the sha256 of a file's content.
+
+    Args:
+        path (str): the file to hash
+        chunk_size (int): number of bytes read at a time
+
+    Returns:
+        str: the hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fingerprint_file(path: str, previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Fingerprint an input shard by its size, modification time and content hash.
+    If a previous fingerprint has the same size and mtime its content hash is reused,
+    so unchanged shards are not re-read.
+
+    Args:
+        path (str): the shard to fingerprint
+        previous (Optional[Dict[str, Any]]): the fingerprint recorded by an earlier run
+
+    Returns:
+        Dict[str, Any]: the size, mtime and sha256 of the shard
+    """
+    stat = os.stat(path)
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if previous is not None and previous.get("size") == fingerprint["size"] and previous.get("mtime") == fingerprint["mtime"] and previous.get("sha256"):
+        fingerprint["sha256"] = previous["sha256"]
+    else:
+        fingerprint["sha256"] = hash_file(path)
+    return fingerprint
+
+def hash_config(config: dict) -> str:
+    """
+    Hash a pipeline config independently of key order.
+
+    Args:
+        config (dict): the config file
+
+    Returns:
+        str: the hex digest of the config
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+def hash_fitted_state(*components: Any) -> str:
+    """
+    Hash the fitted state of the tokenizer, preprocessors and postprocessors.
+    Objects are reduced to a canonical form (sets and dicts sorted, arrays and
+    DataFrames hashed by content) so the hash is stable across processes.
+
+    Args:
+        *components: the fitted objects (or lists of objects) to hash
+
+    Returns:
+        str: the hex digest of the fitted state
+    """
+    canonical = [_canonical(component) for component in components]
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+def _canonical(obj: Any) -> Any:
+    """Reduce an object to JSON-serialisable data that does not depend on hash seeds or memory addresses."""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return {"ndarray": str(obj.dtype), "shape": list(obj.shape), "sha256": hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest()}
+    if isinstance(obj, pl.DataFrame):
+        return {"dataframe": hashlib.sha256(obj.write_csv().encode()).hexdigest()}
+    if isinstance(obj, (list, tuple)):
+        if obj and all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in obj):
+            return _canonical(np.asarray(obj))
+        return [_canonical(x) for x in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted((_canonical(x) for x in obj), key=lambda x: json.dumps(x, sort_keys=True, default=str))
+    if isinstance(obj, dict):
+        items = [[_canonical(k), _canonical(v)] for k, v in obj.items()]
+        return sorted(items, key=lambda kv: json.dumps(kv[0], sort_keys=True, default=str))
+    if hasattr(obj, "backend_tokenizer"):
+        # Hugging Face fast tokenizers, their other attributes include where they were loaded from
+        return {"class": type(obj).__qualname__, "json": obj.backend_tokenizer.to_str()}
+    if hasattr(obj, "to_str") and callable(obj.to_str):
+        # e.g. Hugging Face tokenizers, which serialise themselves to JSON
+        return {"class": type(obj).__qualname__, "json": obj.to_str()}
+    if hasattr(obj, "__dict__"):
+        # caches named in _transient_state depend on what was encoded so far, not on the fit
+        transient = getattr(obj, "_transient_state", ())
+        state = {key: value for key, value in vars(obj).items() if key not in transient}
+        return {"class": type(obj).__qualname__, "state": _canonical(state)}
+    return repr(obj)
+
+
+class RunManifest:
+    """
+    Per-run record of which input shards were encoded and from which upstream state.
+    Stored as manifest.json in the run directory and rewritten after every shard,
+    so a crashed run can be resumed without re-encoding finished shards.
+
+    Args:
+        run_directory (str): the run directory the manifest belongs to
+        filename (str): the manifest file, relative to the run directory
+    """
+    def __init__(self, run_directory: str, filename: str = MANIFEST_FILENAME):
+        self.run_directory = run_directory
+        self.path = os.path.join(run_directory, filename)
+        self.config_hash: Optional[str] = None
+        self.fitted_state_hash: Optional[str] = None
+        # fingerprints of the train shards the saved preprocessors and tokenizer were fitted on
+        self.fit_fingerprints: Dict[str, Dict[str, Any]] = {}
+        self.shards: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def load(cls, run_directory: str, filename: str = MANIFEST_FILENAME) -> "RunManifest":
+        """
+        Load the manifest of a run directory, or an empty manifest if there is none.
+
+        Args:
+            run_directory (str): the run directory
+            filename (str): the manifest file, relative to the run directory
+
+        Returns:
+            RunManifest: the loaded manifest
+        """
+        manifest = cls(run_directory, filename)
+        if os.path.exists(manifest.path):
+            with open(manifest.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION:
+                print(f"Ignoring manifest with unsupported version {data.get('version')}: {manifest.path}")
+                return manifest
+            manifest.config_hash = data.get("config_hash")
+            manifest.fitted_state_hash = data.get("fitted_state_hash")
+            manifest.fit_fingerprints = data.get("fit_fingerprints", {})
+            manifest.shards = data.get("shards", {})
+        return manifest
+
+    def save(self) -> None:
+        """Atomically write the manifest to the run directory."""
+        data = {
+            "version": MANIFEST_VERSION,
+            "config_hash": self.config_hash,
+            "fitted_state_hash": self.fitted_state_hash,
+            "fit_fingerprints": self.fit_fingerprints,
+            "shards": self.shards,
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def shard_key(dataset: str, event_file: str) -> str:
+        """The manifest key of an input shard, e.g. 'train/0.parquet'."""
+        return f"{dataset}/{os.path.basename(event_file)}"
+
+    def is_up_to_date(self, dataset: str, event_file: str, output_path: str, fingerprint: Dict[str, Any]) -> bool:
+        """
+        Check whether a shard was already encoded from the same input and upstream state.
+
+        Args:
+            dataset (str): the dataset directory of the shard
+            event_file (str): the input shard
+            output_path (str): where the encoded shard is written
+            fingerprint (Dict[str, Any]): the current fingerprint of the input shard
+
+        Returns:
+            bool: True if the shard does not need to be re-encoded
+        """
+        entry = self.shards.get(self.shard_key(dataset, event_file))
+        if entry is None or not os.path.exists(output_path):
+            return False
+        return (
+            entry.get("sha256") == fingerprint["sha256"]
+            and entry.get("output") == os.path.relpath(output_path, self.run_directory)
+            and entry.get("config_hash") == self.config_hash
+            and entry.get("fitted_state_hash") == self.fitted_state_hash
+        )
+
+    def previous_fingerprint(self, dataset: str, event_file: str) -> Optional[Dict[str, Any]]:
+        """The fingerprint recorded for a shard, when it was encoded or fitted on, if any."""
+        key = self.shard_key(dataset, event_file)
+        return self.shards.get(key) or self.fit_fingerprints.get(key)
+
+    def record_fit(self, event_files: List[str]) -> None:
+        """
+        Record the fingerprints of the train shards the saved fitted state was fitted on.
+
+        Args:
+            event_files (List[str]): the train shards
+        """
+        self.fit_fingerprints = {}
+        for event_file in event_files:
+            fingerprint = fingerprint_file(event_file, self.previous_fingerprint("train", event_file))
+            self.fit_fingerprints[self.shard_key("train", event_file)] = {key: fingerprint[key] for key in ("size", "mtime", "sha256")}
+
+    def is_fit_up_to_date(self, config_hash: str, event_files: List[str]) -> bool:
+        """
+        Check whether the saved fitted state was fitted with the same config on the same train shards.
+
+        Args:
+            config_hash (str): the hash of the current config, see hash_config
+            event_files (List[str]): the current train shards
+
+        Returns:
+            bool: True if the preprocessors and tokenizer do not need to be fitted again
+        """
+        if self.config_hash != config_hash or not self.fit_fingerprints:
+            return False
+        if set(self.fit_fingerprints) != {self.shard_key("train", event_file) for event_file in event_files}:
+            return False
+        return all(
+            fingerprint_file(event_file, self.previous_fingerprint("train", event_file))["sha256"] == self.fit_fingerprints[self.shard_key("train", event_file)]["sha256"]
+            for event_file in event_files
+        )
+
+    def record(self, dataset: str, event_file: str, output_path: str, fingerprint: Dict[str, Any]) -> None:
+        """
+        Record a successfully encoded shard and persist the manifest.
+        An output the shard was previously encoded to under another path is deleted.
+
+        Args:
+            dataset (str): the dataset directory of the shard
+            event_file (str): the input shard
+            output_path (str): the encoded shard
+            fingerprint (Dict[str, Any]): the fingerprint of the input shard
+        """
+        key = self.shard_key(dataset, event_file)
+        output = os.path.relpath(output_path, self.run_directory)
+        # the shard was encoded to another file before, e.g. in another output format
+        previous = self.shards.get(key)
+        if previous is not None and previous["output"] != output and os.path.exists(os.path.join(self.run_directory, previous["output"])):
+            os.remove(os.path.join(self.run_directory, previous["output"]))
+
+        self.shards[key] = {
+            "input_path": event_file,
+            "size": fingerprint["size"],
+            "mtime": fingerprint["mtime"],
+            "sha256": fingerprint["sha256"],
+            "output": output,
+            "config_hash": self.config_hash,
+            "fitted_state_hash": self.fitted_state_hash,
+            "encoded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        self.save()
+
+    def outputs(self, dataset: str) -> List[str]:
+        """The encoded shards recorded for a dataset directory, sorted by path."""
+        return sorted(os.path.join(self.run_directory, entry["output"]) for key, entry in self.shards.items() if key.split("/")[0] == dataset)
+
+    def remove_missing(self, expected_keys: List[str]) -> List[str]:
+        """
+        Forget shards that are no longer part of the input data and delete their outputs.
+
+        Args:
+            expected_keys (List[str]): the shard keys of the current input data
+
+        Returns:
+            List[str]: the keys that were removed
+        """
+        expected = set(expected_keys)
+        removed = [key for key in self.shards if key not in expected]
+        for key in removed:
+            output_path = os.path.join(self.run_directory, self.shards[key]["output"])
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            del self.shards[key]
+        return removed
@@ -0,0 +1,153 @@
+import os
+import pickle
+from typing import Dict, Iterable, Iterator, List
+import polars as pl
+
+# Supported output formats and the file extension of their encoded shards
+OUTPUT_FORMATS = {
+    "pkl": ".pkl",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+# Schema of the columnar formats, timestamps are whole seconds since the Unix epoch (0 for untimed events)
+TIMELINE_SCHEMA = {
+    "subject_id": pl.Int64,
+    "tokens": pl.List(pl.Int32),
+    "timestamps": pl.List(pl.Int64),
+}
+
+def output_extension(output_format: str) -> str:
+    """
+    Get the file extension of encoded shards in the given output format.
+
+    Args:
+        output_format (str): one of OUTPUT_FORMATS
+
+    Returns:
+        str: the file extension, including the leading dot
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Output format {output_format} not supported, expected one of {list(OUTPUT_FORMATS)}")
+    return OUTPUT_FORMATS[output_format]
+
+def timelines_to_frame(timelines: List[Dict]) -> pl.DataFrame:
+    """
+    Convert encoded timelines into a DataFrame with one row per subject.
+
+    Args:
+        timelines (List[Dict]): dictionaries with subject_id, tokens and timestamps
+
+    Returns:
+        pl.DataFrame: the timelines with the TIMELINE_SCHEMA columns
+    """
+    frame = pl.DataFrame(
+        {
+            "subject_id": [timeline["subject_id"] for timeline in timelines],
+            "tokens": [timeline["tokens"] for timeline in timelines],
+            "timestamps": [timeline["timestamps"] for timeline in timelines],
+        },
+        schema={"subject_id": pl.Int64, "tokens": pl.List(pl.Int64), "timestamps": pl.List(pl.Float64)},
+    )
+    return frame.with_columns(
+        pl.col("tokens").cast(TIMELINE_SCHEMA["tokens"]),
+        pl.col("timestamps").list.eval(pl.element().round(0)).cast(TIMELINE_SCHEMA["timestamps"]),
+    )
+
+def write_timelines(timelines: List[Dict], output_path: str, output_format: str, row_group_size: int = 1024) -> None:
+    """
+    Write the encoded timelines of one shard. The file is written to a temporary path
+    first so an interrupted write never leaves a truncated shard behind.
+
+    Args:
+        timelines (List[Dict]): dictionaries with subject_id, tokens and timestamps
+        output_path (str): the file to write
+        output_format (str): one of OUTPUT_FORMATS
+        row_group_size (int): subjects per parquet row group, the unit read by iter_timelines
+    """
+    output_extension(output_format)
+    tmp_path = f"{output_path}.tmp"
+    if output_format == "pkl":
+        with open(tmp_path, "wb") as f:
+            pickle.dump(timelines, f)
+    elif output_format == "parquet":
+        timelines_to_frame(timelines).write_parquet(tmp_path, row_group_size=row_group_size)
+    elif output_format == "arrow":
+        timelines_to_frame(timelines).write_ipc(tmp_path)
+    os.replace(tmp_path, output_path)
+
+def write_timeline_batches(batches: Iterable[List[Dict]], output_path: str, output_format: str, row_group_size: int = 1024) -> None:
+    """
+    Write the encoded timelines of one shard as they are produced, one batch of subjects at a time.
+    Parquet and Arrow IPC shards are appended to batch by batch, so only one batch is held in memory.
+    A pickle shard is a single list, so its batches are collected and written at the end. The file is
+    written to a temporary path first, as in write_timelines.
+
+    Args:
+        batches (Iterable[List[Dict]]): the timelines of consecutive subjects, in batches
+        output_path (str): the file to write
+        output_format (str): one of OUTPUT_FORMATS
+        row_group_size (int): subjects per parquet row group, the unit read by iter_timelines
+    """
+    if output_format == "pkl":
+        write_timelines([timeline for batch in batches for timeline in batch], output_path, output_format)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    output_extension(output_format)
+    tmp_path = f"{output_path}.tmp"
+    schema = timelines_to_frame([]).to_arrow().schema
+    if output_format == "parquet":
+        writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+        write = lambda table: writer.write_table(table, row_group_size=row_group_size)
+    else:
+        writer = pa.ipc.new_file(tmp_path, schema)
+        write = writer.write_table
+    with writer:
+        for batch in batches:
+            if batch:
+                write(timelines_to_frame(batch).to_arrow())
+    os.replace(tmp_path, output_path)
+
+def iter_timelines(path: str, batch_size: int = 1024) -> Iterator[Dict]:
+    """
+    Stream the subjects of an encoded shard without loading the whole file.
+    Parquet and Arrow IPC shards are read batch_size subjects at a time,
+    pickle shards can only be loaded whole.
+
+    Args:
+        path (str): an encoded shard written by write_timelines
+        batch_size (int): number of subjects to read at a time
+
+    Yields:
+        Dict: subject_id, tokens and timestamps of one subject
+    """
+    if path.endswith(OUTPUT_FORMATS["pkl"]):
+        with open(path, "rb") as f:
+            yield from pickle.load(f)
+        return
+
+    if path.endswith(OUTPUT_FORMATS["parquet"]):
+        scan = pl.scan_parquet(path)
+    elif path.endswith(OUTPUT_FORMATS["arrow"]):
+        scan = pl.scan_ipc(path, memory_map=True)
+    else:
+        raise ValueError(f"Cannot infer the output format of {path}")
+
+    num_subjects = scan.select(pl.len()).collect().item()
+    for offset in range(0, num_subjects, batch_size):
+        yield from scan.slice(offset, batch_size).collect().iter_rows(named=True)
+
+def read_timelines(path: str) -> List[Dict]:
+    """
+    Load all subjects of an encoded shard.
+
+    Args:
+        path (str): an encoded shard written by write_timelines
+
+    Returns:
+        List[Dict]: subject_id, tokens and timestamps of every subject
+    """
+    return list(iter_timelines(path))
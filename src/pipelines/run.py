@@ -2,12 +2,13 @@ import yaml
 from src.tokenization import WordLevelTokenizer
 import os
 import polars as pl
-import pickle
 import json
 from datetime import datetime
 import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from src.preprocessing.base import BasePreprocessor
 from src.postprocessing.base import Postprocessor
 from src.preprocessing import QuantileBinPreprocessor, CodeEnrichmentPreprocessor, LoadStaticDataPreprocessor, EthosQuantileAgePreprocessor, DemographicAggregationPreprocessor, BinnedAgePreprocessor, QuantileBin3LevelPreprocessor, RoundNumericPreprocessor
@@ -15,15 +16,22 @@ from src.preprocessing.code_truncation import CodeTruncationPreprocessor
 from src.preprocessing.filter import FilterPreprocessor
 from src.preprocessing.top_k_filter import TopKCodePreprocessor
 from src.postprocessing import TimeIntervalPostprocessor, DemographicSortOrderPostprocessor, RemoveNumericPostprocessor
-from src.preprocessing.utils import fit_preprocessors_jointly
+from src.preprocessing.fit_scheduler import FitScheduler, fit_preprocessors_jointly
+from src.preprocessing.planner import plan_preprocessors
 from src.preprocessing.decimal_age import DecimalAgePreprocessor
 from src.postprocessing.natural_language_translation import NaturalLanguageTranslationPostprocessor
 from src.tokenization.algorithms.bpe import BPETokenizer
 from src.tokenization.algorithms.hf_bpe import HFBPETokenizer
 from src.preprocessing.raw_age import RawAgePreprocessor
+from src.pipelines.manifest import RunManifest, fingerprint_file, hash_config, hash_fitted_state
+from src.pipelines.output import OUTPUT_FORMATS, output_extension, write_timeline_batches, write_timelines
+from src.pipelines.flat_store import export_flat_store
+from src.pipelines.artifacts import artifacts_directory, load_artifacts, save_artifacts
+from src.pipelines.stage_cache import StageCache
+from src.preprocessing.utils import map_event_files
 DATASET_DIRS = ["train", "tuning", "held_out"]
 
-def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
+def run_pipeline(config: dict, run_name: str, overwrite: bool = False, workers: int = 1, resume: bool = False, stage_cache: str = None, fit_only: bool = False):
     """
     Run a tokenization pipeline end to end.
 
@@ -31,39 +39,205 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
         config (dict): the config file
         run_name (str): the name of the run
         overwrite (bool): whether to overwrite the save directory if it exists
+        workers (int): number of worker processes used to encode shards (1 encodes serially)
+        resume (bool): whether to continue an existing run, only re-encoding shards whose
+            input, config or fitted state changed since they were last encoded. The saved preprocessors
+            and tokenizer are loaded instead of fitted again if the config and train shards are unchanged
+        stage_cache (str): if given, a directory caching the preprocessed and post-processed events of each
+            shard, shared between runs. Runs with the same input shards, fitted preprocessors and postprocessors
+            read the cached events instead of applying them again, see src.pipelines.stage_cache
+        fit_only (bool): whether to stop after saving the fitted state, the shards are then encoded by array
+            job tasks and merged, see src.pipelines.sharding
     """
 
     # Validate all the expected fields are present in the config
     validate_config(config)
 
+    run_directory = prepare_run_directory(config, run_name, overwrite, resume)
+    if run_directory is None:
+        return
+
+    # Check data is valid and load it
+    data_files = gather_data_files(config["data"]["path"])
+    print(f"Found {len(data_files['train'])} train files, {len(data_files['tuning'])} tuning files, and {len(data_files['held_out'])} held out files")
+
+    # Load the fitted state of the run being resumed, or create, fit and plan the preprocessors and create the tokenizer
+    fitted = load_fitted_run(config, run_directory, data_files["train"]) if resume else None
+    if fitted is not None:
+        tokenizer, preprocessors = fitted
+    else:
+        preprocessors = fit_preprocessing(config, data_files["train"], workers=workers)
+        tokenizer = build_tokenizer(config)
+    postprocessors = build_postprocessors(config)
+
+    # Optionally read the events through a cache of the preprocessed and post-processed shards
+    cache = None
+    if stage_cache is not None:
+        event_files = data_files["train"] if fit_only else [file for dataset in DATASET_DIRS for file in data_files[dataset]]
+        cache = StageCache(stage_cache, event_files, preprocessors, postprocessors)
+
+    # Fit tokenizer to train data
+    if fitted is None:
+        train_tokenizer(tokenizer, data_files["train"], preprocessors, postprocessors, workers=workers, stage_cache=cache)
+
+    write_run(config, run_name, run_directory, data_files, tokenizer, preprocessors, postprocessors, workers=workers, stage_cache=cache, encode=not fit_only)
+
+def prepare_run_directory(config: dict, run_name: str, overwrite: bool = False, resume: bool = False):
+    """
+    Create the run directory and its dataset subdirectories.
+
+    Args:
+        config (dict): the config file
+        run_name (str): the name of the run
+        overwrite (bool): whether to overwrite the run directory if it exists
+        resume (bool): whether to keep an existing run directory
+
+    Returns:
+        Optional[str]: the run directory, or None if it exists and neither overwrite nor resume is set
+    """
     run_directory = os.path.join(config["save_path"], run_name)
 
+    if overwrite and resume:
+        print("Error: --overwrite and --resume cannot be used together.")
+        return None
+
     # Check if save directory already exists
     if os.path.exists(run_directory):
-        if overwrite:
+        if resume:
+            print(f"Resuming existing directory: {run_directory}")
+        elif overwrite:
             print(f"Overwriting existing directory: {run_directory}")
             shutil.rmtree(run_directory)
         else:
-            print(f"Error: Save directory {run_directory} already exists. Use the --overwrite flag to overwrite it.")
-            return
+            print(f"Error: Save directory {run_directory} already exists. Use the --overwrite flag to overwrite it or --resume to continue it.")
+            return None
 
     # Create save_path directory
-    os.makedirs(run_directory)
+    os.makedirs(run_directory, exist_ok=True)
 
-    # ... (rest of the run_pipeline function remains the same)
     # Create subdirectories for each dataset
     for dataset in DATASET_DIRS:
-        os.makedirs(os.path.join(config["save_path"], run_name, dataset), exist_ok=True)
+        os.makedirs(os.path.join(run_directory, dataset), exist_ok=True)
+    return run_directory
 
-    # Check data is valid and load it
-    data_files = gather_data_files(config["data"]["path"])
-    print(f"Found {len(data_files['train'])} train files, {len(data_files['tuning'])} tuning files, and {len(data_files['held_out'])} held out files")
+def load_fitted_run(config: dict, run_directory: str, train_files: List[str]) -> Optional[Tuple[object, List[BasePreprocessor]]]:
+    """
+    Load the saved tokenizer and preprocessors of a run being resumed, if they were fitted with the same
+    config on the same train shards, so an interrupted run does not fit them again.
+
+    Args:
+        config (dict): the config file
+        run_directory (str): the run directory
+        train_files (List[str]): the train files
+
+    Returns:
+        Optional[Tuple[Tokenizer, List[BasePreprocessor]]]: the tokenizer and preprocessors, or None if they need to be fitted
+    """
+    manifest = RunManifest.load(run_directory)
+    if not manifest.fit_fingerprints or not os.path.exists(artifacts_directory(run_directory)):
+        print("No fitted state saved in the run directory, fitting")
+        return None
+    if not manifest.is_fit_up_to_date(hash_config(config), train_files):
+        print("The config or train files changed since the run was fitted, fitting again")
+        return None
+
+    fitted_config, tokenizer, preprocessors = load_artifacts(run_directory)
+    if hash_config(fitted_config) != hash_config(config):
+        print("The saved artifacts were fitted with another config, fitting again")
+        return None
+    print(f"Loaded the fitted preprocessors and tokenizer of {run_directory}")
+    return tokenizer, preprocessors
+
+def fit_preprocessing(config: dict, event_files: List[str], workers: int = 1) -> List[BasePreprocessor]:
+    """
+    Create the preprocessors of a config, fit them jointly on the train files and optimise the fitted steps.
+
+    Args:
+        config (dict): the config file
+        event_files (List[str]): the train files
+        workers (int): number of worker processes used to read the files (1 reads serially)
+
+    Returns:
+        List[BasePreprocessor]: the fitted preprocessors, in the order they are applied
+    """
+    preprocessors = build_preprocessors(config)
+
+    # Fit all preprocessors jointly
+    if preprocessors:
+        fit_preprocessors_jointly(preprocessors, event_files, workers=workers)
+
+    # Fuse, reorder and drop redundant preprocessing steps, the encoded events are unchanged
+    if preprocessors and config.get("optimize_preprocessing", True):
+        preprocessors = plan_preprocessors(preprocessors, event_files)
+    return preprocessors
+
+def write_run(config: dict, run_name: str, run_directory: str, data_files: Dict[str, List[str]], tokenizer, preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor], workers: int = 1, stage_cache: StageCache = None, encoded_from: str = None, encode: bool = True):
+    """
+    Save the fitted state of a run, encode its shards and write the run metadata to the run directory.
+
+    Args:
+        config (dict): the config file
+        run_name (str): the name of the run
+        run_directory (str): the run directory, see prepare_run_directory
+        data_files (Dict[str, List[str]]): the event files of each dataset directory
+        tokenizer (Tokenizer): the trained tokenizer
+        preprocessors (List[Preprocessor]): the fitted preprocessors
+        postprocessors (List[Postprocessor]): the postprocessors
+        workers (int): number of worker processes used to encode shards (1 encodes serially)
+        stage_cache (StageCache): if given, the cache the events are read from
+        encoded_from (str): if given, a run directory holding the same encoded shards, they are copied
+            instead of encoded again
+        encode (bool): whether to encode the shards, if False they are left to array job tasks that
+            merge_shard_tasks (src.pipelines.sharding) combines, and the flat token store is exported there
+    """
+    # Save the fitted preprocessors and tokenizer, new shards can then be encoded without fitting again (see src.pipelines.encode)
+    save_artifacts(artifacts_directory(run_directory), config, tokenizer, preprocessors)
+
+    # Record what the encoded shards are derived from, shards already encoded from the same state are skipped
+    manifest = RunManifest.load(run_directory)
+    manifest.config_hash = hash_config(config)
+    manifest.fitted_state_hash = hash_fitted_state(tokenizer, preprocessors, postprocessors)
+    manifest.record_fit(data_files["train"])
+    manifest.save()
+
+    # encode train, tuning and held out data
+    if not encode:
+        print(f"Fitted state saved to {run_directory}, encode the shards with --num_shards and --shard_index, then --merge")
+    elif encoded_from is None:
+        encode_datasets(tokenizer, data_files, run_directory, preprocessors, postprocessors, workers=workers, manifest=manifest, output_format=config.get("output_format", "pkl"), stage_cache=stage_cache, row_budget=config.get("encode_row_budget", 0))
+    else:
+        copy_encoded_datasets(encoded_from, manifest)
+
+    # optionally concatenate each split into a memory-mappable flat token store
+    if encode and config.get("flat_store", False):
+        export_flat_store(run_directory, data_files.keys(), int(tokenizer.vocab["token"].max()), output_format=config.get("output_format", "pkl"))
+
+    # store a copy of the config file
+    with open(os.path.join(run_directory, "config.yaml"), "w") as f:
+        yaml.dump(config, f)
 
-    data_files['train'] = data_files['train']
-    data_files['tuning'] = data_files['tuning']
-    data_files['held_out'] = data_files['held_out']
+    # store metadata
+    metadata = {
+        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "run_name": run_name,
+        "config": config,
+    }
+    with open(os.path.join(run_directory, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+
+    # store the vocab file as a csv
+    tokenizer.vocab.write_csv(os.path.join(run_directory, "vocab.csv"))
 
-    # Create preprocessors
+def build_preprocessors(config: dict) -> List[BasePreprocessor]:
+    """
+    Create the (unfitted) preprocessors of a config, in the configured order.
+
+    Args:
+        config (dict): the config file
+
+    Returns:
+        List[BasePreprocessor]: the preprocessors
+    """
     preprocessors = []
     if "preprocessing" in config:
         for preprocessing_config in config["preprocessing"]:
@@ -77,7 +251,9 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
                     matching_type=preprocessing_config["matching_type"],
                     matching_value=preprocessing_config["matching_value"],
                     k=preprocessing_config["k"],
-                    value_column=preprocessing_config["value_column"]
+                    value_column=preprocessing_config["value_column"],
+                    fit_mode=preprocessing_config.get("fit_mode", "exact"),
+                    sketch_k=preprocessing_config.get("sketch_k", 200)
                 )
             elif preprocessing_config["type"] == "filter":
                 preprocessor = FilterPreprocessor(
@@ -126,7 +302,9 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
                 preprocessor = QuantileBin3LevelPreprocessor(
                     matching_type=preprocessing_config["matching_type"],
                     matching_value=preprocessing_config["matching_value"],
-                    value_column=preprocessing_config["value_column"]
+                    value_column=preprocessing_config["value_column"],
+                    fit_mode=preprocessing_config.get("fit_mode", "exact"),
+                    sketch_k=preprocessing_config.get("sketch_k", 200)
                 )
             elif preprocessing_config["type"] == "demographic_aggregation":
                 preprocessor = DemographicAggregationPreprocessor(
@@ -154,14 +332,21 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
                 )
             else:
                 raise ValueError(f"Preprocessor {preprocessing_config['type']} not supported")
-            
+
             preprocessors.append(preprocessor)
 
-    # Fit all preprocessors jointly
-    if preprocessors:
-        fit_preprocessors_jointly(preprocessors, data_files["train"])
+    return preprocessors
+
+def build_postprocessors(config: dict) -> List[Postprocessor]:
+    """
+    Create the postprocessors of a config, in the configured order.
+
+    Args:
+        config (dict): the config file
 
-    # Load postprocessors
+    Returns:
+        List[Postprocessor]: the postprocessors
+    """
     postprocessors = []
     if "postprocessing" in config:
         for postprocessing_config in config["postprocessing"]:
@@ -170,11 +355,7 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
                 interval_tokens=postprocessing_config.get("interval_tokens", {}),
                 use_dynamic_bucketing=postprocessing_config.get("use_dynamic_bucketing", False)
                 ,wrap_token=postprocessing_config.get("wrap_token", True)
-<<<<<<< HEAD
                 ,dataset=postprocessing_config.get("dataset", "MIMIC")
-=======
-                ,dataset=postprocessing_config.get("dataset", "CPRD")
->>>>>>> f88d1cc78a428e40bb8985c34d0bb542ec130d14
             )
             elif postprocessing_config["type"] == "demographic_sort_order":
                 postprocessor = DemographicSortOrderPostprocessor(postprocessing_config["token_patterns"])
@@ -189,10 +370,21 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
                 )
             else:
                 raise ValueError(f"Postprocessor {postprocessing_config['type']} not supported")
-            
+
             postprocessors.append(postprocessor)
 
-    # Load tokenizer
+    return postprocessors
+
+def build_tokenizer(config: dict):
+    """
+    Create the (untrained) tokenizer of a config.
+
+    Args:
+        config (dict): the config file
+
+    Returns:
+        Tokenizer: the tokenizer
+    """
     if config["tokenization"]["tokenizer"] == "word_level":
         tokenizer = WordLevelTokenizer(
             vocab_size=config["tokenization"]["vocab_size"],
@@ -206,7 +398,8 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
             insert_event_tokens=config["tokenization"]["insert_event_tokens"],
             insert_numeric_tokens=config["tokenization"]["insert_numeric_tokens"],
             insert_text_tokens=config["tokenization"]["insert_text_tokens"],
-            end_of_word_suffix=config["tokenization"].get("end_of_word_suffix", "</w>")
+            end_of_word_suffix=config["tokenization"].get("end_of_word_suffix", "</w>"),
+            cache_size=config["tokenization"].get("cache_size", 100000),
         )
     elif config["tokenization"]["tokenizer"] == "hf_bpe":
         tokenizer = HFBPETokenizer(
@@ -215,37 +408,43 @@ def run_pipeline(config: dict, run_name: str, overwrite: bool = False):
             insert_numeric_tokens=config["tokenization"]["insert_numeric_tokens"],
             insert_text_tokens=config["tokenization"]["insert_text_tokens"],
             tokenizer_dir=config["tokenization"].get("tokenizer_dir"),  # optional
+            encode_batch_size=config["tokenization"].get("encode_batch_size", 1024),
         )
     else:
         raise ValueError(f"Tokenizer {config['tokenization']['tokenizer']} not supported")
+    return tokenizer
 
-    # Fit tokenizer to train data
-    tokenizer.train(data_files["train"], preprocessors, postprocessors)
-
-    # encode train data
-    encode_files(tokenizer, data_files["train"], os.path.join(run_directory, "train"), preprocessors, postprocessors)
+def train_tokenizer(tokenizer, event_files: List[str], preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor], workers: int = 1, stage_cache: StageCache = None):
+    """
+    Train the tokenizer on the train files. Tokenizers with a fit consumer read each file once through a
+    FitScheduler, on a process pool when workers > 1, others read the files in their own train method.
+    With a stage cache the tokenizer reads the cached events of the files instead.
 
-    # encode tuning data
-    encode_files(tokenizer, data_files["tuning"], os.path.join(run_directory, "tuning"), preprocessors, postprocessors)
+    Args:
+        tokenizer (Tokenizer): the tokenizer to train
+        event_files (List[str]): the train files
+        preprocessors (List[Preprocessor]): the fitted preprocessors
+        postprocessors (List[Postprocessor]): the postprocessors
+        workers (int): number of worker processes used to read the files (1 reads serially)
+        stage_cache (StageCache): if given, the cache the events are read from
+    """
+    if stage_cache is not None:
+        cached = map_event_files(stage_cache.resolve, event_files, workers, "Caching preprocessed events")
+        # one set of postprocessors is applied to every file, so post-processed events are only read if all files have them
+        if all(postprocessed for _path, postprocessed in cached):
+            postprocessors = []
+        else:
+            cached = [stage_cache.resolve(event_file, postprocessed=False) for event_file in event_files]
+        event_files = [path for path, _postprocessed in cached]
+        preprocessors = []
 
-    # encode held out data
-    encode_files(tokenizer, data_files["held_out"], os.path.join(run_directory, "held_out"), preprocessors, postprocessors)
+    consumer = tokenizer.fit_consumer(preprocessors, postprocessors)
+    if consumer is None:
+        tokenizer.train(event_files, preprocessors, postprocessors)
+        return
 
-    # store a copy of the config file
-    with open(os.path.join(run_directory, "config.yaml"), "w") as f:
-        yaml.dump(config, f)
-
-    # store metadata
-    metadata = {
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "run_name": run_name,
-        "config": config,
-    }
-    with open(os.path.join(run_directory, "metadata.json"), "w") as f:
-        json.dump(metadata, f)
-
-    # store the vocab file as a csv
-    tokenizer.vocab.write_csv(os.path.join(run_directory, "vocab.csv"))
+    print(f"Training {tokenizer.tokenizer_name} tokenizer on {len(event_files)} files...")
+    FitScheduler(event_files, workers).register(consumer).run()
 
 def validate_config(config: dict):
     """
@@ -259,6 +458,14 @@ def validate_config(config: dict):
     # Check tokenizer is valid
     if config["tokenization"]["tokenizer"] not in ["word_level", "bpe", "hf_bpe"]:
         raise ValueError(f"Tokenizer {config['tokenization']['tokenizer']} not supported")
+
+    # Check output format is valid
+    if config.get("output_format", "pkl") not in OUTPUT_FORMATS:
+        raise ValueError(f"Output format {config['output_format']} not supported, expected one of {list(OUTPUT_FORMATS)}")
+
+    # Check the encode row budget is a number of rows (0 encodes whole shards)
+    if not isinstance(config.get("encode_row_budget", 0), int) or config.get("encode_row_budget", 0) < 0:
+        raise ValueError(f"encode_row_budget must be a non-negative integer, got {config['encode_row_budget']}")
     
     # Check data path is valid and files exist
     if config["data"]["path"] is None:
@@ -309,20 +516,183 @@ def gather_data_files(data_path: str):
 
     return data_files
 
-def encode_files(tokenizer, event_files: List[str], save_path: str, preprocessors: List[BasePreprocessor] = None, postprocessors: List[Postprocessor] = None):
+def encode_files(tokenizer, event_files: List[str], save_path: str, preprocessors: List[BasePreprocessor] = None, postprocessors: List[Postprocessor] = None, workers: int = 1, output_format: str = "pkl", row_budget: int = 0):
     """
-    Encode a list of event files and save them as pickle files.
+    Encode a list of event files and save them as pickle (or parquet / arrow) files.
 
     Args:
         tokenizer (Tokenizer): the tokenizer to use
         event_files (List[str]): the list of event files to encode
         save_path (str): the path to save the encoded files
         preprocessors (List[Preprocessor]): the list of preprocessors to use
+        postprocessors (List[Postprocessor]): the list of postprocessors to use
+        workers (int): number of worker processes to encode with (1 encodes serially)
+        output_format (str): the format of the encoded files, one of OUTPUT_FORMATS
+        row_budget (int): if positive, shards are read and encoded about this many event rows at a time
+    """
+    jobs = [(file, save_path) for file in event_files]
+    _run_encode_jobs(tokenizer, jobs, preprocessors, postprocessors, workers, output_format=output_format, row_budget=row_budget)
+
+def encode_datasets(tokenizer, data_files: Dict[str, List[str]], run_directory: str, preprocessors: List[BasePreprocessor] = None, postprocessors: List[Postprocessor] = None, workers: int = 1, manifest: RunManifest = None, output_format: str = "pkl", stage_cache: StageCache = None, row_budget: int = 0):
+    """
+    Encode the train, tuning and held out files into their run subdirectories.
+    With more than one worker, the shards of all splits share a single process pool so the
+    fitted tokenizer, preprocessors and postprocessors are only sent to each worker once.
+
+    Args:
+        tokenizer (Tokenizer): the tokenizer to use
+        data_files (Dict[str, List[str]]): the event files of each dataset directory
+        run_directory (str): the run directory containing one subdirectory per dataset
+        preprocessors (List[Preprocessor]): the list of preprocessors to use
+        postprocessors (List[Postprocessor]): the list of postprocessors to use
+        workers (int): number of worker processes to encode with (1 encodes serially)
+        manifest (RunManifest): if given, shards it records as up to date are skipped
+            and every newly encoded shard is recorded in it
+        output_format (str): the format of the encoded files, one of OUTPUT_FORMATS
+        stage_cache (StageCache): if given, the cache the events are read from
+        row_budget (int): if positive, shards are read and encoded about this many event rows at a time
+    """
+    jobs = []
+    fingerprints = {}
+    for dataset in DATASET_DIRS:
+        for file in data_files[dataset]:
+            save_path = os.path.join(run_directory, dataset)
+            if manifest is not None:
+                fingerprint = fingerprint_file(file, manifest.previous_fingerprint(dataset, file))
+                if manifest.is_up_to_date(dataset, file, _output_path(file, save_path, output_format), fingerprint):
+                    continue
+                fingerprints[file] = (dataset, fingerprint)
+            jobs.append((file, save_path))
+
+    on_complete = None
+    if manifest is not None:
+        removed = manifest.remove_missing([RunManifest.shard_key(dataset, file) for dataset in DATASET_DIRS for file in data_files[dataset]])
+        if removed:
+            print(f"Removed {len(removed)} encoded shards whose input no longer exists: {removed}")
+        total = sum(len(data_files[dataset]) for dataset in DATASET_DIRS)
+        print(f"{total - len(jobs)}/{total} shards are up to date, encoding {len(jobs)}")
+
+        def on_complete(event_file: str, output_path: str):
+            dataset, fingerprint = fingerprints[event_file]
+            manifest.record(dataset, event_file, output_path, fingerprint)
+
+    _run_encode_jobs(tokenizer, jobs, preprocessors, postprocessors, workers, on_complete, output_format, stage_cache, row_budget)
+
+def copy_encoded_datasets(source_directory: str, manifest: RunManifest):
     """
-    for file in tqdm(event_files):
-        encoded_data = tokenizer.encode(file, preprocessors, postprocessors)
-        with open(os.path.join(save_path, os.path.basename(file).replace(".parquet", ".pkl")), "wb") as f:
-            pickle.dump(encoded_data, f)
+    Copy the encoded shards of another run that encoded the same shards from the same fitted state,
+    recording them in the manifest of this run.
+
+    Args:
+        source_directory (str): the run directory the shards are copied from
+        manifest (RunManifest): the manifest of the run directory the shards are copied to
+    """
+    source = RunManifest.load(source_directory)
+    removed = manifest.remove_missing(list(source.shards))
+    if removed:
+        print(f"Removed {len(removed)} encoded shards that {source_directory} does not have: {removed}")
+
+    print(f"Copying {len(source.shards)} encoded shards from {source_directory}")
+    for key, entry in tqdm(source.shards.items()):
+        dataset = key.split("/")[0]
+        output_path = os.path.join(manifest.run_directory, entry["output"])
+        shutil.copyfile(os.path.join(source_directory, entry["output"]), output_path)
+        manifest.record(dataset, entry["input_path"], output_path, entry)
+
+def encode_file(tokenizer, event_file: str, save_path: str, preprocessors: List[BasePreprocessor] = None, postprocessors: List[Postprocessor] = None, output_format: str = "pkl", stage_cache: StageCache = None, row_budget: int = 0) -> str:
+    """
+    Encode a single event file and save it as a file named after the shard.
+
+    Args:
+        tokenizer (Tokenizer): the tokenizer to use
+        event_file (str): the event file to encode
+        save_path (str): the directory to save the encoded file in
+        preprocessors (List[Preprocessor]): the list of preprocessors to use
+        postprocessors (List[Postprocessor]): the list of postprocessors to use
+        output_format (str): the format of the encoded file, one of OUTPUT_FORMATS
+        stage_cache (StageCache): if given, the cache the events are read from
+        row_budget (int): if positive, the shard is read and encoded about this many event rows at a time and
+            written as it is encoded, see Tokenizer.encode_stream
+
+    Returns:
+        str: the path of the written file
+    """
+    read_file, preprocessors, postprocessors = event_file, preprocessors or [], postprocessors or []
+    if stage_cache is not None:
+        read_file, postprocessed = stage_cache.resolve(event_file)
+        preprocessors, postprocessors = [], [] if postprocessed else postprocessors
+
+    output_path = _output_path(event_file, save_path, output_format)
+    if row_budget > 0:
+        write_timeline_batches(tokenizer.encode_stream(read_file, preprocessors, postprocessors, row_budget), output_path, output_format)
+    else:
+        write_timelines(tokenizer.encode(read_file, preprocessors, postprocessors), output_path, output_format)
+    return output_path
+
+def _output_path(event_file: str, save_path: str, output_format: str = "pkl") -> str:
+    """The path the encoded version of an event file is written to."""
+    return os.path.join(save_path, os.path.basename(event_file).replace(".parquet", output_extension(output_format)))
+
+def _run_encode_jobs(tokenizer, jobs: List[tuple], preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor], workers: int, on_complete=None, output_format: str = "pkl", stage_cache: StageCache = None, row_budget: int = 0):
+    """
+    Encode (event_file, save_path) jobs either serially or on a process pool.
+    on_complete(event_file, output_path) is called in this process after each shard is written.
+    Any failure is re-raised as a RuntimeError naming the shard that failed.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        for event_file, save_path in tqdm(jobs):
+            try:
+                output_path = encode_file(tokenizer, event_file, save_path, preprocessors, postprocessors, output_format, stage_cache, row_budget)
+            except Exception as e:
+                raise RuntimeError(f"Failed to encode shard {event_file}: {e}") from e
+            if on_complete is not None:
+                on_complete(event_file, output_path)
+        return
+
+    # spawn rather than fork, forking a process that has already used polars' thread pool can deadlock
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(jobs)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_encode_worker,
+        initargs=(tokenizer, preprocessors, postprocessors, stage_cache),
+    ) as executor:
+        futures = {
+            executor.submit(_encode_file_in_worker, event_file, save_path, output_format, row_budget): event_file
+            for event_file, save_path in jobs
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            event_file = futures[future]
+            try:
+                output_path = future.result()
+            except Exception as e:
+                for pending in futures:
+                    pending.cancel()
+                raise RuntimeError(f"Failed to encode shard {event_file}: {e}") from e
+            if on_complete is not None:
+                on_complete(event_file, output_path)
+
+# Fitted pipeline state of an encode worker process, set once by _init_encode_worker
+_WORKER_STATE = {}
+
+def _init_encode_worker(tokenizer, preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor], stage_cache: StageCache = None):
+    """Store the fitted tokenizer, preprocessors, postprocessors and stage cache in the worker process."""
+    _WORKER_STATE["tokenizer"] = tokenizer
+    _WORKER_STATE["preprocessors"] = preprocessors
+    _WORKER_STATE["postprocessors"] = postprocessors
+    _WORKER_STATE["stage_cache"] = stage_cache
+
+def _encode_file_in_worker(event_file: str, save_path: str, output_format: str, row_budget: int = 0) -> str:
+    """Encode a single shard with the state stored by _init_encode_worker."""
+    return encode_file(
+        _WORKER_STATE["tokenizer"],
+        event_file,
+        save_path,
+        _WORKER_STATE["preprocessors"],
+        _WORKER_STATE["postprocessors"],
+        output_format,
+        _WORKER_STATE["stage_cache"],
+        row_budget,
+    )
 
 if __name__ == "__main__":
 
@@ -331,10 +701,24 @@ if __name__ == "__main__":
     parser.add_argument("--config_filepath", type=str)
     parser.add_argument("--run_name", type=str)
     parser.add_argument("--overwrite", action="store_true", help="Overwrite the save directory if it exists.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to encode shards in parallel.")
+    parser.add_argument("--resume", action="store_true", help="Continue an existing run, only re-encoding shards whose input or upstream state changed.")
+    parser.add_argument("--stage_cache", type=str, default=None, help="Directory caching the preprocessed and post-processed events of each shard, shared between runs.")
+    parser.add_argument("--fit_only", action="store_true", help="Fit and save the preprocessors and tokenizer without encoding, for --num_shards array jobs.")
+    parser.add_argument("--num_shards", "--num-shards", type=int, default=1, help="Number of array job tasks the shards are split between, see --shard_index and --merge.")
+    parser.add_argument("--shard_index", "--shard-index", type=int, default=None, help="The array job task (0 to num_shards - 1) to encode, in a run prepared with --fit_only.")
+    parser.add_argument("--merge", action="store_true", help="Check every array job task finished and combine their manifests and statistics.")
 
     args = parser.parse_args()
 
     with open(args.config_filepath, "r") as f:
         config = yaml.safe_load(f)
 
-    run_pipeline(config, args.run_name, args.overwrite)
\ No newline at end of file
+    if args.merge or args.shard_index is not None:
+        from src.pipelines.sharding import encode_shard_task, merge_shard_tasks
+        if args.merge:
+            merge_shard_tasks(config, args.run_name, args.num_shards)
+        else:
+            encode_shard_task(config, args.run_name, args.num_shards, args.shard_index, args.workers, args.stage_cache)
+    else:
+        run_pipeline(config, args.run_name, args.overwrite, args.workers, args.resume, args.stage_cache, args.fit_only)
\ No newline at end of file
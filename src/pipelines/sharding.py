@@ -0,0 +1,163 @@
+import os
+import json
+from datetime import datetime
+from typing import Any, Dict, List
+from src.pipelines.artifacts import artifacts_directory, load_artifacts
+from src.pipelines.flat_store import export_flat_store
+from src.pipelines.manifest import RunManifest, hash_config, hash_fitted_state
+from src.pipelines.output import iter_timelines
+from src.pipelines.stage_cache import StageCache
+from src.pipelines.run import DATASET_DIRS, build_postprocessors, encode_datasets, gather_data_files, validate_config
+
+TASKS_DIRNAME = "tasks"
+STATS_FILENAME = "stats.json"
+
+def task_manifest_filename(num_shards: int, shard_index: int) -> str:
+    """The manifest of an encode task, relative to the run directory."""
+    return os.path.join(TASKS_DIRNAME, f"task_{shard_index}_of_{num_shards}.json")
+
+def shard_data_files(data_files: Dict[str, List[str]], num_shards: int, shard_index: int) -> Dict[str, List[str]]:
+    """
+    The event files encoded by one of num_shards tasks. The files of all splits are ordered by split and
+    file name and dealt to the tasks in turn, so every task gets a similar share of each split.
+
+    Args:
+        data_files (Dict[str, List[str]]): the event files of each dataset directory
+        num_shards (int): the number of tasks
+        shard_index (int): the task, from 0 to num_shards - 1
+
+    Returns:
+        Dict[str, List[str]]: the event files of each dataset directory encoded by the task
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} is out of range for {num_shards} shards")
+    files = [(dataset, file) for dataset in DATASET_DIRS for file in sorted(data_files[dataset])]
+    task_files = {dataset: [] for dataset in DATASET_DIRS}
+    for dataset, file in files[shard_index::num_shards]:
+        task_files[dataset].append(file)
+    return task_files
+
+def encode_shard_task(config: dict, run_name: str, num_shards: int, shard_index: int, workers: int = 1, stage_cache: str = None) -> None:
+    """
+    Encode one slice of the train, tuning and held out files into a run directory prepared with --fit_only,
+    e.g. as one task of an SGE or SLURM array job. The task loads the fitted preprocessors and tokenizer from
+    the run's artifacts and records the shards it encoded in its own manifest, see merge_shard_tasks.
+    A task that is run again only re-encodes the shards whose input or upstream state changed.
+
+    Args:
+        config (dict): the config file, the same as the one the run was fitted with
+        run_name (str): the name of the run
+        num_shards (int): the number of tasks the files are split between
+        shard_index (int): the task, from 0 to num_shards - 1
+        workers (int): number of worker processes the task encodes with
+        stage_cache (str): if given, a directory caching the preprocessed events of each shard
+    """
+    validate_config(config)
+    run_directory = os.path.join(config["save_path"], run_name)
+    if not os.path.exists(artifacts_directory(run_directory)):
+        raise FileNotFoundError(f"No fitted artifacts in {run_directory}, run the pipeline with --fit_only first")
+
+    fitted_config, tokenizer, preprocessors = load_artifacts(run_directory)
+    if hash_config(fitted_config) != hash_config(config):
+        raise ValueError(f"The config does not match the config {run_directory} was fitted with")
+    postprocessors = build_postprocessors(config)
+
+    data_files = shard_data_files(gather_data_files(config["data"]["path"]), num_shards, shard_index)
+    print(f"Task {shard_index} of {num_shards}: encoding {sum(len(files) for files in data_files.values())} files into {run_directory}")
+
+    cache = None
+    if stage_cache is not None:
+        cache = StageCache(stage_cache, [file for dataset in DATASET_DIRS for file in data_files[dataset]], preprocessors, postprocessors)
+
+    manifest = RunManifest.load(run_directory, task_manifest_filename(num_shards, shard_index))
+    manifest.config_hash = hash_config(config)
+    manifest.fitted_state_hash = hash_fitted_state(tokenizer, preprocessors, postprocessors)
+    manifest.save()
+
+    encode_datasets(tokenizer, data_files, run_directory, preprocessors, postprocessors, workers=workers, manifest=manifest, output_format=config.get("output_format", "pkl"), stage_cache=cache, row_budget=config.get("encode_row_budget", 0))
+
+    # Count the subjects and tokens of newly encoded shards, re-encoding a shard replaces its entry
+    for entry in manifest.shards.values():
+        if "stats" not in entry:
+            entry["stats"] = shard_stats(os.path.join(run_directory, entry["output"]))
+    manifest.save()
+
+def shard_stats(path: str) -> Dict[str, int]:
+    """
+    The number of subjects and tokens in an encoded shard.
+
+    Args:
+        path (str): the encoded shard
+
+    Returns:
+        Dict[str, int]: the subject and token counts
+    """
+    stats = {"subjects": 0, "tokens": 0}
+    for timeline in iter_timelines(path):
+        stats["subjects"] += 1
+        stats["tokens"] += len(timeline["tokens"])
+    return stats
+
+def merge_shard_tasks(config: dict, run_name: str, num_shards: int) -> Dict[str, Any]:
+    """
+    Check that the encode tasks of a run encoded every shard from the fitted state of the run, record their
+    shards in the run's manifest and write the combined statistics of the tasks to stats.json. The flat
+    token store is exported here if the config asks for one, as it needs every shard.
+    Raises a RuntimeError naming the missing shards and the tasks to run again if any shard is missing.
+
+    Args:
+        config (dict): the config file
+        run_name (str): the name of the run
+        num_shards (int): the number of tasks the files were split between
+
+    Returns:
+        Dict[str, Any]: the combined statistics
+    """
+    validate_config(config)
+    run_directory = os.path.join(config["save_path"], run_name)
+    manifest = RunManifest.load(run_directory)
+    if manifest.fitted_state_hash is None:
+        raise FileNotFoundError(f"No fitted run in {run_directory}, run the pipeline with --fit_only first")
+
+    data_files = gather_data_files(config["data"]["path"])
+    expected = {RunManifest.shard_key(dataset, file): shard_index for shard_index in range(num_shards) for dataset, files in shard_data_files(data_files, num_shards, shard_index).items() for file in files}
+
+    shards = {}
+    for shard_index in range(num_shards):
+        task_manifest = RunManifest.load(run_directory, task_manifest_filename(num_shards, shard_index))
+        if task_manifest.config_hash != manifest.config_hash or task_manifest.fitted_state_hash != manifest.fitted_state_hash:
+            continue
+        for key, entry in task_manifest.shards.items():
+            if (
+                expected.get(key) == shard_index
+                and entry.get("config_hash") == manifest.config_hash
+                and entry.get("fitted_state_hash") == manifest.fitted_state_hash
+                and os.path.exists(os.path.join(run_directory, entry["output"]))
+            ):
+                shards[key] = entry
+
+    missing = sorted(key for key in expected if key not in shards)
+    if missing:
+        tasks = sorted({expected[key] for key in missing})
+        raise RuntimeError(f"{len(missing)} of {len(expected)} shards are not encoded: {missing}. Run the tasks with --shard_index {tasks} again")
+
+    manifest.shards = shards
+    manifest.save()
+
+    stats = {"num_shards": num_shards, "merged_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "datasets": {}}
+    for dataset in DATASET_DIRS:
+        entries = [entry for key, entry in shards.items() if key.split("/")[0] == dataset]
+        stats["datasets"][dataset] = {
+            "files": len(entries),
+            "subjects": sum(entry["stats"]["subjects"] for entry in entries),
+            "tokens": sum(entry["stats"]["tokens"] for entry in entries),
+        }
+    with open(os.path.join(run_directory, STATS_FILENAME), "w") as f:
+        json.dump(stats, f, indent=2)
+    for dataset, dataset_stats in stats["datasets"].items():
+        print(f"{dataset}: {dataset_stats['files']} files, {dataset_stats['subjects']} subjects, {dataset_stats['tokens']} tokens")
+
+    if config.get("flat_store", False):
+        _config, tokenizer, _preprocessors = load_artifacts(run_directory)
+        export_flat_store(run_directory, DATASET_DIRS, int(tokenizer.vocab["token"].max()), output_format=config.get("output_format", "pkl"))
+    return stats
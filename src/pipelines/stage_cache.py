@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+import polars as pl
+from src.preprocessing.base import BasePreprocessor
+from src.preprocessing.utils import EVENT_COLUMNS, load_events
+from src.postprocessing.base import Postprocessor
+from src.pipelines.manifest import fingerprint_file, hash_fitted_state
+
+STAGE_CACHE_VERSION = 1
+FINGERPRINTS_FILENAME = "fingerprints.json"
+
+# Keys of the events built by Tokenizer._process_events, and the event columns they are stored in
+EVENT_KEYS = {"code": "code", "timestamp": "time", "numeric_value": "numeric_value", "text_value": "text_value", "unit": "unit"}
+
+class StageCache:
+    """
+    Content-addressed cache of the preprocessed and post-processed events of each shard, stored as parquet.
+    A preprocessed entry is keyed by the sha256 of the input shard and the hash of the fitted preprocessors,
+    a post-processed entry by its preprocessed key and the hash of the postprocessors, so runs that share the
+    same upstream chain (e.g. sweeps over tokenizer settings) read the cached events instead of applying it.
+
+    Post-processed events are stored as an event table with one row per event. Shards whose post-processed
+    events that table cannot reproduce exactly (e.g. a subject left without events, or values of another
+    type) only cache their preprocessed events, and are post-processed when they are read.
+
+    Args:
+        directory (str): the cache directory, shared between runs
+        event_files (List[str]): the input shards that will be read through the cache
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors
+        postprocessors (List[Postprocessor]): the postprocessors
+    """
+    def __init__(self, directory: str, event_files: List[str], preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor]):
+        self.directory = directory
+        self.preprocessors = preprocessors
+        self.postprocessors = postprocessors
+        os.makedirs(os.path.join(directory, "preprocessed"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "postprocessed"), exist_ok=True)
+
+        preprocessed_state = hash_fitted_state(preprocessors)
+        postprocessed_state = hash_fitted_state(postprocessors)
+        fingerprints = self._fingerprint(event_files)
+        self.keys: Dict[str, Tuple[str, str]] = {}
+        for event_file in event_files:
+            preprocessed_key = _hash([STAGE_CACHE_VERSION, "preprocessed", fingerprints[event_file]["sha256"], preprocessed_state, EVENT_COLUMNS])
+            postprocessed_key = _hash([STAGE_CACHE_VERSION, "postprocessed", preprocessed_key, postprocessed_state])
+            self.keys[event_file] = (preprocessed_key, postprocessed_key)
+
+    def _fingerprint(self, event_files: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Fingerprint the input shards, reusing the content hash of shards whose size and mtime are unchanged."""
+        path = os.path.join(self.directory, FINGERPRINTS_FILENAME)
+        previous = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                previous = json.load(f)
+
+        fingerprints = {file: fingerprint_file(file, previous.get(os.path.abspath(file))) for file in event_files}
+        previous.update({os.path.abspath(file): fingerprint for file, fingerprint in fingerprints.items()})
+        _write_atomically(path, lambda tmp_path: _dump_json(previous, tmp_path))
+        return fingerprints
+
+    def resolve(self, event_file: str, postprocessed: bool = True) -> Tuple[str, bool]:
+        """
+        The cached events of a shard, computed and stored first if they are not cached yet.
+        Read the returned file without preprocessors, and without postprocessors if it is post-processed.
+
+        Args:
+            event_file (str): the input shard
+            postprocessed (bool): whether to return the post-processed events when they can be cached
+
+        Returns:
+            Tuple[str, bool]: the parquet file holding the shard's events and whether they are post-processed
+        """
+        preprocessed_key, postprocessed_key = self.keys[event_file]
+        preprocessed_path = os.path.join(self.directory, "preprocessed", f"{preprocessed_key}.parquet")
+        postprocessed_path = os.path.join(self.directory, "postprocessed", f"{postprocessed_key}.parquet")
+        # marks shards whose post-processed events cannot be stored, so later runs do not try again
+        unsupported_path = os.path.join(self.directory, "postprocessed", f"{postprocessed_key}.unsupported")
+
+        if postprocessed and self.postprocessors and os.path.exists(postprocessed_path):
+            return postprocessed_path, True
+
+        if os.path.exists(preprocessed_path):
+            events = None
+        else:
+            events = load_events(event_file, self.preprocessors)
+            _write_atomically(preprocessed_path, events.write_parquet)
+
+        if not (postprocessed and self.postprocessors) or os.path.exists(unsupported_path):
+            return preprocessed_path, False
+
+        if events is None:
+            events = pl.read_parquet(preprocessed_path)
+        frame = postprocessed_events(events, self.postprocessors)
+        if frame is None:
+            _write_atomically(unsupported_path, lambda tmp_path: open(tmp_path, "w").close())
+            return preprocessed_path, False
+        _write_atomically(postprocessed_path, frame.write_parquet)
+        return postprocessed_path, True
+
+def postprocessed_events(events: pl.DataFrame, postprocessors: List[Postprocessor]) -> Optional[pl.DataFrame]:
+    """
+    Apply the postprocessors to preprocessed events and store the result as events again, one row per event.
+    Tokenizing the returned events without postprocessors gives the same tokens as tokenizing the
+    preprocessed events with them.
+
+    Args:
+        events (pl.DataFrame): the preprocessed events
+        postprocessors (List[Postprocessor]): the postprocessors to apply
+
+    Returns:
+        Optional[pl.DataFrame]: the post-processed events, or None if they cannot be stored exactly
+    """
+    unit = pl.col("unit") if "unit" in events.columns else pl.lit(None, dtype=pl.String)
+    grouped = events.group_by("subject_id", maintain_order=True).agg(
+        pl.struct(
+            pl.col("code"),
+            pl.col("time").alias("timestamp"),
+            pl.col("numeric_value"),
+            pl.col("text_value"),
+            unit.alias("unit"),
+        ).alias("event_list")
+    )
+    subjects = [
+        {"subject_id": (subject_id,), "event_list": event_list}
+        for subject_id, event_list in zip(grouped["subject_id"].to_list(), grouped["event_list"].to_list())
+    ]
+    for postprocessor in postprocessors:
+        subjects = postprocessor.encode(subjects)
+
+    columns = {"subject_id": []}
+    columns.update({column: [] for column in EVENT_KEYS.values()})
+    subject_ids = set()
+    for subject in subjects:
+        subject_id = subject["subject_id"][0]
+        # a subject without events still gets <start> and <end> tokens, but has no rows to store
+        if not subject["event_list"] or subject_id in subject_ids:
+            return None
+        subject_ids.add(subject_id)
+        for event in subject["event_list"]:
+            if not set(event) <= set(EVENT_KEYS):
+                return None
+            columns["subject_id"].append(subject_id)
+            for key, column in EVENT_KEYS.items():
+                columns[column].append(event.get(key))
+
+    schema = {"subject_id": events.schema["subject_id"], "code": pl.String, "time": events.schema["time"]}
+    schema.update({column: events.schema.get(column, pl.String) for column in ["numeric_value", "text_value", "unit"]})
+    try:
+        frame = pl.DataFrame(columns, schema=schema, strict=True)
+    except (TypeError, ValueError, pl.exceptions.PolarsError):
+        return None
+
+    # Values the column dtype does not hold exactly, e.g. a float that is not a float32, would change their tokens
+    for column, values in columns.items():
+        if frame[column].to_list() != values:
+            return None
+    return frame
+
+def _hash(data: Any) -> str:
+    """The sha256 of JSON data."""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+def _dump_json(data: Any, path: str) -> None:
+    """Write JSON data to a file."""
+    with open(path, "w") as f:
+        json.dump(data, f, indent=1)
+
+def _write_atomically(path: str, write) -> None:
+    """Call write(tmp_path) and move the written file into place, so concurrent runs never read a partial entry."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
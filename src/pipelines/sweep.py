@@ -0,0 +1,211 @@
+import os
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+import yaml
+from src.pipelines.manifest import hash_config
+from src.pipelines.stage_cache import StageCache
+from src.preprocessing.utils import map_event_files
+from src.pipelines.run import (
+    DATASET_DIRS,
+    build_postprocessors,
+    build_tokenizer,
+    fit_preprocessing,
+    gather_data_files,
+    prepare_run_directory,
+    train_tokenizer,
+    validate_config,
+    write_run,
+)
+
+# The stages of a run, in order. Each stage depends on the previous one and on these config sections
+STAGE_SECTIONS = {
+    "fit": lambda config: {
+        "data": config["data"]["path"],
+        "preprocessing": config.get("preprocessing", []),
+        "optimize_preprocessing": config.get("optimize_preprocessing", True),
+    },
+    "preprocess": lambda config: {"postprocessing": config.get("postprocessing", [])},
+    "tokenize": lambda config: {"tokenization": config["tokenization"]},
+    "encode": lambda config: {"output_format": config.get("output_format", "pkl")},
+}
+
+class SweepStage:
+    """
+    A stage of the sweep DAG, shared by every run whose config agrees on this stage and all stages before it.
+
+    fit: fit and optimise the preprocessors on the train shards
+    preprocess: apply the preprocessors and postprocessors to every shard, storing the events in the stage cache
+    tokenize: train the tokenizer on the cached train events
+    encode: encode every shard into the run directory of the first run, the other runs copy the encoded shards
+
+    Args:
+        kind (str): the stage, one of STAGE_SECTIONS
+        key (str): the hash of the config sections of this stage and the stages before it
+        config (dict): the config of the first run that reaches this stage, the stage reads its sections
+    """
+    def __init__(self, kind: str, key: str, config: dict):
+        self.kind = kind
+        self.key = key
+        self.config = config
+        self.children: List["SweepStage"] = []
+        # (run_name, config) of the runs written after an encode stage
+        self.runs: List[Tuple[str, dict]] = []
+
+def stage_keys(config: dict) -> List[Tuple[str, str]]:
+    """
+    The key of each stage of a config. A key hashes the config sections of its stage and the key of the
+    stage before it, so two configs share a stage exactly when they agree on it and on every earlier stage.
+
+    Args:
+        config (dict): the config file
+
+    Returns:
+        List[Tuple[str, str]]: (stage, key) of every stage, in order
+    """
+    keys = []
+    parent = None
+    for kind, sections in STAGE_SECTIONS.items():
+        parent = hash_config({"stage": kind, "parent": parent, **sections(config)})
+        keys.append((kind, parent))
+    return keys
+
+def build_sweep(runs: List[Tuple[str, dict]]) -> List[SweepStage]:
+    """
+    Build the sweep DAG of the runs, merging the stages they share.
+
+    Args:
+        runs (List[Tuple[str, dict]]): the run name and config of every run
+
+    Returns:
+        List[SweepStage]: the fit stages, the roots of the DAG
+    """
+    run_directories = {}
+    for run_name, config in runs:
+        run_directory = os.path.abspath(os.path.join(config["save_path"], run_name))
+        if run_directory in run_directories:
+            raise ValueError(f"Runs {run_directories[run_directory]} and {run_name} would both write to {run_directory}")
+        run_directories[run_directory] = run_name
+
+    roots: List[SweepStage] = []
+    for run_name, config in runs:
+        stages = roots
+        for kind, key in stage_keys(config):
+            stage = next((stage for stage in stages if stage.key == key), None)
+            if stage is None:
+                stage = SweepStage(kind, key, config)
+                stages.append(stage)
+            stages = stage.children
+        stage.runs.append((run_name, config))
+    return roots
+
+def print_sweep(roots: List[SweepStage]) -> None:
+    """Print the sweep DAG, one line per stage with the runs that share it."""
+    def runs_of(stage: SweepStage) -> List[str]:
+        return [run_name for run_name, _config in stage.runs] + [name for child in stage.children for name in runs_of(child)]
+
+    def print_stage(stage: SweepStage, depth: int) -> None:
+        print(f"{'  ' * depth}{stage.kind} {stage.key[:8]}: {', '.join(runs_of(stage))}")
+        for child in stage.children:
+            print_stage(child, depth + 1)
+
+    print("Sweep stages:")
+    for root in roots:
+        print_stage(root, 1)
+
+def run_sweep(runs: List[Tuple[str, dict]], overwrite: bool = False, workers: int = 1, resume: bool = False, stage_cache: Optional[str] = None) -> None:
+    """
+    Run several pipelines as one sweep. Runs whose configs agree on the preprocessing, postprocessing,
+    tokenization or output format share those stages (see build_sweep), each shared stage runs once and
+    every run still writes its own run directory, as run_pipeline would.
+
+    Args:
+        runs (List[Tuple[str, dict]]): the run name and config of every run
+        overwrite (bool): whether to overwrite run directories that exist
+        workers (int): number of worker processes used to fit and encode
+        resume (bool): whether to continue existing run directories, see run_pipeline
+        stage_cache (Optional[str]): the directory the preprocessed events are cached in, a temporary
+            directory removed after the sweep if None
+    """
+    for _run_name, config in runs:
+        validate_config(config)
+
+    roots = build_sweep(runs)
+    print_sweep(roots)
+
+    if stage_cache is not None:
+        _run_stages(roots, {"workers": workers, "overwrite": overwrite, "resume": resume, "stage_cache": stage_cache})
+        return
+    with tempfile.TemporaryDirectory(prefix="stage_cache_") as directory:
+        _run_stages(roots, {"workers": workers, "overwrite": overwrite, "resume": resume, "stage_cache": directory})
+
+def _run_stages(stages: List[SweepStage], state: Dict[str, Any]) -> None:
+    """
+    Run the stages and, depth first, their children. state holds the sweep options and the results of the
+    stages before, each child gets a copy extended with the result of its parent.
+    """
+    for stage in stages:
+        config = stage.config
+        workers = state["workers"]
+        stage_state = dict(state)
+
+        if stage.kind == "fit":
+            print(f"Fitting preprocessors for {config['data']['path']}")
+            data_files = gather_data_files(config["data"]["path"])
+            print(f"Found {len(data_files['train'])} train files, {len(data_files['tuning'])} tuning files, and {len(data_files['held_out'])} held out files")
+            stage_state["data_files"] = data_files
+            stage_state["preprocessors"] = fit_preprocessing(config, data_files["train"], workers=workers)
+
+        elif stage.kind == "preprocess":
+            data_files = state["data_files"]
+            event_files = [file for dataset in DATASET_DIRS for file in data_files[dataset]]
+            postprocessors = build_postprocessors(config)
+            cache = StageCache(state["stage_cache"], event_files, state["preprocessors"], postprocessors)
+            map_event_files(cache.resolve, event_files, workers, "Preprocessing shards")
+            stage_state["postprocessors"] = postprocessors
+            stage_state["cache"] = cache
+
+        elif stage.kind == "tokenize":
+            tokenizer = build_tokenizer(config)
+            train_tokenizer(tokenizer, state["data_files"]["train"], state["preprocessors"], state["postprocessors"], workers=workers, stage_cache=state["cache"])
+            stage_state["tokenizer"] = tokenizer
+
+        elif stage.kind == "encode":
+            # the first run encodes the shards, the others copy them
+            encoded_from = None
+            for run_name, run_config in stage.runs:
+                run_directory = prepare_run_directory(run_config, run_name, state["overwrite"], state["resume"])
+                if run_directory is None:
+                    raise RuntimeError(f"Cannot write run {run_name}, see the error above")
+                print(f"Writing run {run_name} to {run_directory}")
+                write_run(
+                    run_config, run_name, run_directory, state["data_files"], state["tokenizer"],
+                    state["preprocessors"], state["postprocessors"], workers=workers,
+                    stage_cache=state["cache"], encoded_from=encoded_from,
+                )
+                encoded_from = encoded_from or run_directory
+
+        _run_stages(stage.children, stage_state)
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Run several pipeline configs as one sweep, running the stages they share once.")
+    parser.add_argument("--config_filepaths", type=str, nargs="+", required=True, help="The config files of the runs.")
+    parser.add_argument("--run_names", type=str, nargs="+", default=None, help="The name of each run, defaults to the config file names.")
+    parser.add_argument("--overwrite", action="store_true", help="Overwrite run directories that exist.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to fit and encode shards in parallel.")
+    parser.add_argument("--resume", action="store_true", help="Continue existing runs, only re-encoding shards whose input or upstream state changed.")
+    parser.add_argument("--stage_cache", type=str, default=None, help="Directory caching the preprocessed events of each shard, a temporary directory if not given.")
+
+    args = parser.parse_args()
+
+    run_names = args.run_names or [os.path.splitext(os.path.basename(path))[0] for path in args.config_filepaths]
+    if len(run_names) != len(args.config_filepaths):
+        parser.error("--run_names needs one name per config file")
+
+    runs = []
+    for run_name, config_filepath in zip(run_names, args.config_filepaths):
+        with open(config_filepath, "r") as f:
+            runs.append((run_name, yaml.safe_load(f)))
+
+    run_sweep(runs, args.overwrite, args.workers, args.resume, args.stage_cache)
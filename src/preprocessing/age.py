@@ -0,0 +1,95 @@
+import polars as pl
+from abc import abstractmethod
+from typing import Optional, Sequence
+from .base import BasePreprocessor
+from .utils import align_to_schema, insert_static_events
+from .values import python_timestamp
+
+BIRTH_CODE = "MEDS_BIRTH"
+STATIC_CODE = "STATIC_DATA_NO_CODE"
+SECONDS_PER_YEAR = 365.25 * 24 * 3600
+
+# Codes starting with these prefixes are static data, not the first medical event of a timeline
+STATIC_PREFIXES = ("DEMOGRAPHICS//", "GENDER//", "ETHNICITY//", "REGION//")
+
+def subject_ages(events: pl.DataFrame, static_prefixes: Sequence[str] = STATIC_PREFIXES, seconds_per_unit: float = SECONDS_PER_YEAR) -> pl.DataFrame:
+    """
+    Compute the age of every subject with a MEDS_BIRTH event at their first medical event,
+    with one group_by for the birth times and one for the first event times.
+    The birth time is the time of the subject's first MEDS_BIRTH event, the first medical event
+    is the earliest timed event that is not MEDS_BIRTH, STATIC_DATA_NO_CODE or static data.
+
+    Args:
+        events (pl.DataFrame): the events
+        static_prefixes (Sequence[str]): code prefixes of static data events
+        seconds_per_unit (float): the number of seconds in the unit of the age
+
+    Returns:
+        pl.DataFrame: subject_id and age columns, in order of each subject's first MEDS_BIRTH event.
+            The age is null if the birth time is null or the subject has no medical events.
+    """
+    births = (
+        events.filter((pl.col("code") == BIRTH_CODE) & pl.col("subject_id").is_not_null())
+        .group_by("subject_id", maintain_order=True)
+        .agg(pl.col("time").first().alias("birth_time"))
+    )
+
+    medical = (pl.col("code") != BIRTH_CODE) & pl.col("time").is_not_null() & (pl.col("code") != STATIC_CODE)
+    for prefix in static_prefixes:
+        medical = medical & ~pl.col("code").str.starts_with(prefix)
+    first_events = events.filter(medical).group_by("subject_id").agg(pl.col("time").min().alias("first_time"))
+
+    ages = births.join(first_events, on="subject_id", how="left", maintain_order="left")
+    # numpy divides exactly as Python does, Polars multiplies by the reciprocal of a scalar divisor
+    seconds = python_timestamp(ages["first_time"]).to_numpy() - python_timestamp(ages["birth_time"]).to_numpy()
+    return ages.select("subject_id", pl.Series("age", seconds / seconds_per_unit, dtype=pl.Float64).fill_nan(None))
+
+class AgePreprocessor(BasePreprocessor):
+    """
+    Base class for preprocessors that insert static age events computed from the time between
+    MEDS_BIRTH and the first medical event. Subclasses only format the ages into events.
+
+    Args:
+        keep_meds_birth (bool): whether to keep the MEDS_BIRTH events
+    """
+    def __init__(self, keep_meds_birth: bool = False):
+        super().__init__(matching_type="equals", matching_value="")
+        self.keep_meds_birth = keep_meds_birth
+
+    @abstractmethod
+    def _age_events(self, ages: pl.DataFrame) -> pl.DataFrame:
+        """
+        Format the ages into age events, implemented by subclasses
+
+        Args:
+            ages (pl.DataFrame): subject_id and age (in years, not null) of every subject with an age
+
+        Returns:
+            pl.DataFrame: the age events, with subject_id, code and optionally numeric_value and text_value columns
+        """
+        raise NotImplementedError("Subclasses must implement this method")
+
+    inserts_events = True
+
+    def encode_polars(self, events: pl.DataFrame, events_sorted: Optional[bool] = None) -> pl.DataFrame:
+        """
+        Add the age events of every subject, without a time so they sort after the subject's other
+        static events and before its timed events.
+
+        Args:
+            events (pl.DataFrame): the events to encode
+            events_sorted (Optional[bool]): whether the events are known to be sorted by (subject_id, time), None checks
+
+        Returns:
+            pl.DataFrame: the events with the age events added
+        """
+        age_events = self._age_events(subject_ages(events).drop_nulls("age"))
+
+        if not self.keep_meds_birth:
+            events = events.filter(pl.col("code") != BIRTH_CODE)
+
+        if age_events.is_empty():
+            return events
+
+        age_events = align_to_schema(age_events, events.schema)
+        return insert_static_events(events, age_events, events_sorted, after_untimed=True)
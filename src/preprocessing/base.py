@@ -1,9 +1,15 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, TYPE_CHECKING
 import polars as pl
 import numpy as np
 from abc import ABC, abstractmethod
 import os
 from tqdm import tqdm
+from .values import python_float, python_str
+from .sketch import KLLSketch
+from .matcher import CodeMatcher, MATCHING_TYPES
+
+if TYPE_CHECKING:
+    from .fit_scheduler import ShardConsumer
 
 class BasePreprocessor(ABC):
     """
@@ -13,14 +19,34 @@ class BasePreprocessor(ABC):
         matching_type (str): the type of matching to perform
         matching_value (str): the value to match against
     """
+    # Attributes that are caches rather than fitted state
+    _transient_state = ("_code_matcher",)
+    # Whether encoding keeps events that are sorted by (subject_id, time) sorted
+    keeps_sorted = True
+    # Preprocessors that insert events into the timelines, their encode_polars(events, events_sorted)
+    # is told whether the events are known to be sorted by (subject_id, time), see utils.scan_events
+    inserts_events = False
+
     def __init__(self, matching_type: str, matching_value: str):
         self.matching_type = matching_type
         self.matching_value = matching_value
         
         # validate matching type
-        if matching_type not in ["starts_with", "ends_with", "contains", "equals", "regex"]:
+        if matching_type not in MATCHING_TYPES:
             raise ValueError(f"Invalid matching type: {matching_type}")
         
+    @property
+    def matcher(self) -> CodeMatcher:
+        """The compiled matcher of the configured pattern, rebuilt if the pattern changes."""
+        matcher = self.__dict__.get("_code_matcher")
+        if matcher is None or (matcher.matching_type, matcher.matching_value) != (self.matching_type, self.matching_value):
+            matcher = self._code_matcher = CodeMatcher(self.matching_type, self.matching_value)
+        return matcher
+
+    def _reset_transient_state(self) -> None:
+        """Recreate the caches named in _transient_state, e.g. after fitted state is loaded without them."""
+        self.__dict__.pop("_code_matcher", None)
+
     def _match(self, code: str) -> bool:
         """
         Check if a code matches the configured pattern
@@ -31,22 +57,19 @@ class BasePreprocessor(ABC):
         Returns:
             bool: True if the code matches the configured pattern, False otherwise
         """
-        # Handle None or empty codes gracefully
-        if code is None or code == "":
-            return False
-            
-        if self.matching_type == "starts_with":
-            return code.startswith(self.matching_value)
-        elif self.matching_type == "ends_with":
-            return code.endswith(self.matching_value)
-        elif self.matching_type == "contains":
-            return self.matching_value in code
-        elif self.matching_type == "equals":
-            return code == self.matching_value
-        elif self.matching_type == "regex":
-            import re
-            return bool(re.search(self.matching_value, code))
-        return False
+        return self.matcher.match(code)
+
+    def _match_mask(self, codes: pl.Series) -> pl.Series:
+        """
+        Column version of _match, check which codes match the configured pattern
+
+        Args:
+            codes (pl.Series): the codes to check
+
+        Returns:
+            pl.Series: a Boolean series, True where the code matches the configured pattern
+        """
+        return self.matcher.mask(codes)
     
     @abstractmethod
     def fit(self, event_files: List[str]) -> None:
@@ -58,6 +81,16 @@ class BasePreprocessor(ABC):
         """
         raise NotImplementedError("Subclasses must implement this method")
     
+    def fit_consumer(self) -> Optional["ShardConsumer"]:
+        """
+        The consumer that fits this preprocessor from a shared read of the train files, see
+        fit_scheduler.FitScheduler. None fits it with fit(event_files), e.g. from a lookup file.
+
+        Returns:
+            Optional[ShardConsumer]: the consumer, or None
+        """
+        return None
+
     @abstractmethod
     def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
         """
@@ -71,6 +104,20 @@ class BasePreprocessor(ABC):
         """
         raise NotImplementedError("Subclasses must implement this method")
 
+    def encode_lazy(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        """
+        Add this preprocessor to a lazy query over the events. Preprocessors that can be
+        written as Polars expressions override this so the whole chain runs as one optimised
+        query. The default collects the events and calls encode_polars.
+
+        Args:
+            events (pl.LazyFrame): the events to encode
+
+        Returns:
+            pl.LazyFrame: the events with encoded data
+        """
+        return self.encode_polars(events.collect()).lazy()
+
 
 class ValuePreprocessor(BasePreprocessor):
     """
@@ -80,10 +127,20 @@ class ValuePreprocessor(BasePreprocessor):
         matching_type (str): the type of matching to perform
         matching_value (str): the value to match against
         value_column (str): the column containing the values to transform
+        fit_mode (str): "exact" keeps every training value, "sketch" keeps a KLLSketch per code
+        sketch_k (int): the size of the sketches in sketch mode, larger is more accurate
     """
-    def __init__(self, matching_type: str, matching_value: str, value_column: str):
+    # Whether the subclass implements _encode_values, otherwise values are encoded row by row with _encode
+    has_column_encoding = False
+
+    def __init__(self, matching_type: str, matching_value: str, value_column: str, fit_mode: str = "exact", sketch_k: int = 200):
         super().__init__(matching_type, matching_value)
         self.value_column = value_column
+
+        if fit_mode not in ["exact", "sketch"]:
+            raise ValueError(f"Invalid fit mode: {fit_mode}")
+        self.fit_mode = fit_mode
+        self.sketch_k = sketch_k
         
         # data storage for codes and their values
         self.data: Dict[str, List[Any]] = {}
@@ -134,6 +191,53 @@ class ValuePreprocessor(BasePreprocessor):
         # Call the child class's _fit() method to fit the preprocessor to the data
         self._fit()
 
+    def _summarise(self, values: np.ndarray) -> Any:
+        """
+        Summarise the values of one code read from one event file, in a worker process.
+
+        Args:
+            values (np.ndarray): the Float64 values
+
+        Returns:
+            Any: the values in exact mode, a KLLSketch of them in sketch mode
+        """
+        if self.fit_mode == "sketch":
+            return KLLSketch.from_values(values, self.sketch_k)
+        return values
+
+    def _add_summaries(self, code: str, summaries: List[Any]) -> None:
+        """
+        Add the summaries from _summarise of one code, in file order, to self.data.
+
+        Args:
+            code (str): the code
+            summaries (List[Any]): the summaries to add
+        """
+        if self.fit_mode == "sketch":
+            sketch = self.data[code] if isinstance(self.data.get(code), KLLSketch) else KLLSketch.from_values(self.data.get(code, []), self.sketch_k)
+            for summary in summaries:
+                sketch.merge(summary)
+            self.data[code] = sketch
+        else:
+            existing = [np.asarray(self.data[code], dtype=np.float64)] if code in self.data else []
+            self.data[code] = np.concatenate(existing + summaries)
+
+    def _quantile(self, code: str, probs) -> np.ndarray:
+        """
+        The quantiles of the training values of a code, estimated from the sketch in sketch mode.
+
+        Args:
+            code (str): the code
+            probs: the probabilities of the quantiles
+
+        Returns:
+            np.ndarray: the quantiles
+        """
+        values = self.data[code]
+        if isinstance(values, KLLSketch):
+            return values.quantile(probs)
+        return np.quantile(np.asarray(values), probs)
+
     def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
         """
         Encode the data in the event files and overwrite self.value_column column.
@@ -144,6 +248,83 @@ class ValuePreprocessor(BasePreprocessor):
         Returns:
             pl.DataFrame: the events with the encoded self.value_column column
         """
+        return events.with_columns(self._encode_expression())
+
+    def encode_lazy(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        """
+        Add the encoding of self.value_column to a lazy query over the events.
+
+        Args:
+            events (pl.LazyFrame): the events to encode
+
+        Returns:
+            pl.LazyFrame: the events with the encoded self.value_column column
+        """
+        return events.with_columns(self._encode_expression())
+
+    def _encode_expression(self, match_column: Optional[str] = None) -> pl.Expr:
+        """
+        The expression that replaces self.value_column with its encoded value.
+
+        Args:
+            match_column (Optional[str]): a Boolean column already holding _match_mask of the codes,
+                see utils.scan_events. None matches the codes here.
+
+        Returns:
+            pl.Expr: the encoding expression
+        """
+        # Subclasses without a column version of _encode are encoded row by row
+        if not self.has_column_encoding:
+            return self._encode_rows_expression()
+
+        columns = ["code", self.value_column] + ([match_column] if match_column else [])
+        return pl.struct(columns).map_batches(
+            lambda events: self._encode_series(
+                events.struct.field("code"),
+                events.struct.field(self.value_column),
+                events.struct.field(match_column) if match_column else None,
+            ),
+            return_dtype=pl.String,
+            is_elementwise=True,
+        ).alias(self.value_column)
+
+    def _encode_series(self, codes: pl.Series, values: pl.Series, code_matches: Optional[pl.Series] = None) -> pl.Series:
+        """
+        Encode a column of values with _encode_values, giving the same strings as _encode_rows_expression.
+
+        Args:
+            codes (pl.Series): the code of each event
+            values (pl.Series): the self.value_column value of each event
+            code_matches (Optional[pl.Series]): _match_mask of the codes if already computed
+
+        Returns:
+            pl.Series: the encoded values as strings
+        """
+        if code_matches is None:
+            code_matches = self._match_mask(codes)
+        matched = code_matches & values.is_not_null()
+        floats = python_float(values.filter(matched))
+        valid = floats.is_not_null()
+        floats = floats.filter(valid)
+        encoded = self._encode_values(codes.filter(matched).filter(valid), floats).cast(pl.String)
+
+        # Values the subclass leaves unencoded are written as their float
+        unencoded = encoded.is_null()
+        if unencoded.any():
+            encoded = encoded.scatter(unencoded.arg_true(), python_str(floats.filter(unencoded)))
+
+        # Values of codes that do not match, or that are not valid floats, are kept as strings.
+        # Only these are formatted, as str() on many distinct floats is the slow part
+        positions = matched.arg_true().filter(valid)
+        kept = np.ones(values.len(), dtype=bool)
+        kept[positions.to_numpy()] = False
+        strings = pl.repeat(None, values.len(), dtype=pl.String, eager=True).alias(values.name)
+        if kept.any():
+            strings = strings.scatter(np.flatnonzero(kept), python_str(values.filter(pl.Series(kept))))
+        return strings.scatter(positions, encoded)
+
+    def _encode_rows_expression(self) -> pl.Expr:
+        """The row by row expression that replaces self.value_column with its encoded value."""
         def encode_row(row):
             code = row["code"]
             value = row[self.value_column]
@@ -168,10 +349,7 @@ class ValuePreprocessor(BasePreprocessor):
             else:
                 return str(value)
 
-        events = events.with_columns(
-            pl.struct(["code", self.value_column]).map_elements(encode_row, return_dtype=pl.String).alias(self.value_column)
-        )
-        return events
+        return pl.struct(["code", self.value_column]).map_elements(encode_row, return_dtype=pl.String).alias(self.value_column)
             
     @abstractmethod
     def _fit(self) -> None:
@@ -194,6 +372,21 @@ class ValuePreprocessor(BasePreprocessor):
         """
         raise NotImplementedError("Subclasses must implement this method")
 
+    def _encode_values(self, codes: pl.Series, values: pl.Series) -> Optional[pl.Series]:
+        """
+        Column version of _encode, optionally implemented by subclasses that set has_column_encoding
+        so encoding avoids a Python call per event. Only called with matching codes and non-null float values.
+
+        Args:
+            codes (pl.Series): the codes
+            values (pl.Series): the Float64 values to encode
+
+        Returns:
+            Optional[pl.Series]: the encoded values as strings, null where the value is kept as is,
+                or None when the subclass has no column encoding
+        """
+        return None
+
 
 class CodePreprocessor(BasePreprocessor):
     """
@@ -203,8 +396,19 @@ class CodePreprocessor(BasePreprocessor):
         matching_type (str): the type of matching to perform
         matching_value (str): the value to match against
     """
+    # Attributes that cache results rather than hold fitted state, left out of the fitted state hash
+    _transient_state = ("_code_matcher", "code_memo")
+
     def __init__(self, matching_type: str, matching_value: str):
         super().__init__(matching_type, matching_value)
+
+        # memo of code -> transformed code, shared by every shard this instance encodes
+        self.code_memo: Dict[str, str] = {}
+
+    def _reset_transient_state(self) -> None:
+        """Recreate the caches named in _transient_state, e.g. after fitted state is loaded without them."""
+        super()._reset_transient_state()
+        self.code_memo = {}
         
     def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
         """
@@ -216,17 +420,47 @@ class CodePreprocessor(BasePreprocessor):
         Returns:
             pl.DataFrame: the events with transformed codes
         """
-        def transform_row(row):
-            code = row["code"]
-            if self._match(code):
-                return self._transform_code(code)
-            return code
-
-        events = events.with_columns(
-            pl.struct(["code"]).map_elements(transform_row, return_dtype=pl.String).alias("code")
-        )
-        return events
-    
+        return events.with_columns(self._transform_expression())
+
+    def encode_lazy(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        """
+        Add the transformation of the 'code' column to a lazy query over the events.
+
+        Args:
+            events (pl.LazyFrame): the events to encode
+
+        Returns:
+            pl.LazyFrame: the events with transformed codes
+        """
+        return events.with_columns(self._transform_expression())
+
+    def _transform_expression(self) -> pl.Expr:
+        """The expression that replaces the 'code' column with the transformed codes."""
+        return pl.col("code").map_batches(self._transform_codes, return_dtype=pl.String, is_elementwise=True).alias("code")
+
+    def _transform_codes(self, codes: pl.Series) -> pl.Series:
+        """
+        Transform a column of codes. _transform_code is called once per distinct matching code
+        not already in self.code_memo, and the results are mapped back onto the column.
+
+        Args:
+            codes (pl.Series): the codes
+
+        Returns:
+            pl.Series: the transformed codes, null codes stay null
+        """
+        codes = codes.cast(pl.String)
+        unique_codes = codes.drop_nulls().unique().to_list()
+        new_codes = pl.Series([code for code in unique_codes if code not in self.code_memo], dtype=pl.String)
+        for code, matched in zip(new_codes, self._match_mask(new_codes)):
+            self.code_memo[code] = self._transform_code(code) if matched else code
+
+        changed = [(code, self.code_memo[code]) for code in unique_codes if self.code_memo[code] != code]
+        if not changed:
+            return codes
+        old, new = zip(*changed)
+        return codes.replace(pl.Series(old, dtype=pl.String), pl.Series(new, dtype=pl.String))
+
     @abstractmethod
     def _transform_code(self, code: str) -> str:
         """
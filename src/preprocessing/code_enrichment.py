@@ -89,6 +89,9 @@ class CodeEnrichmentPreprocessor(CodePreprocessor):
         
         # Optimization: Create simple lookup cache
         self._create_simple_cache()
+
+        # Codes transformed with a previous lookup table are stale
+        self.code_memo.clear()
     
     def _create_simple_cache(self):
         """
@@ -1,8 +1,11 @@
 import polars as pl
 import numpy as np
+from functools import partial
 from typing import List, Dict, Any, Optional
 from .base import BasePreprocessor
-from tqdm import tqdm
+from .utils import align_to_schema, insert_static_events
+from .fit_scheduler import FitScheduler, ShardConsumer
+from .values import map_unique_floats, python_float
 
 class DemographicAggregationPreprocessor(BasePreprocessor):
     """
@@ -23,6 +26,8 @@ class DemographicAggregationPreprocessor(BasePreprocessor):
         measurements (List[Dict]): List of measurement configurations
     """
     
+    inserts_events = True
+
     def __init__(self, matching_type: str, matching_value: str, measurements: List[Dict[str, Any]]):
         # Initialize base class attributes (not used for matching but required for interface)
         self.matching_type = matching_type
@@ -71,30 +76,45 @@ class DemographicAggregationPreprocessor(BasePreprocessor):
                         raise ValueError(f"Measurement {i}: bin_labels must have length {measurement['num_bins']}")
                 
     
-    def fit(self, event_files: List[str]) -> None:
+    def fit(self, event_files: List[str], workers: int = 1) -> None:
         """
         Fit quantile bins for each measurement type based on training data
         
         Args:
             event_files (List[str]): List of parquet file paths to train on
+            workers (int): number of worker processes used to read the files (1 reads serially)
         """
         print(f"Fitting DemographicAggregationPreprocessor on {len(event_files)} files...")
-        
-        # Collect aggregated values for each measurement type
-        measurement_data = {i: [] for i in range(len(self.measurements))}
-        
-        for file_path in tqdm(event_files, desc="Collecting demographic measurement data"):
-            events = pl.read_parquet(file_path)
-            
-            # Process each subject in this file
-            for subject_id in events["subject_id"].unique():
-                subject_events = events.filter(pl.col("subject_id") == subject_id)
-                
-                # Process each measurement type for this subject
-                for measurement_idx, measurement in enumerate(self.measurements):
-                    aggregated_value = self._aggregate_subject_measurement(subject_events, measurement)
-                    if aggregated_value is not None:
-                        measurement_data[measurement_idx].append(aggregated_value)
+        FitScheduler(event_files, workers).register(self.fit_consumer()).run()
+
+    def fit_consumer(self) -> ShardConsumer:
+        """
+        The consumer that aggregates the measurements of each file and fits the quantile bins.
+
+        Returns:
+            ShardConsumer: the consumer
+        """
+        value_columns = list(dict.fromkeys(measurement["value_column"] for measurement in self.measurements))
+        return ShardConsumer(
+            "demographic measurements",
+            partial(aggregate_measurements, measurements=self.measurements),
+            self._fit_bins,
+            columns=["subject_id", "code", *value_columns],
+            fits=[self],
+        )
+
+    def _fit_bins(self, file_aggregates: List[List[pl.DataFrame]]) -> None:
+        """
+        Fit the quantile bins of each measurement from the aggregated values of every file.
+
+        Args:
+            file_aggregates (List[List[pl.DataFrame]]): per file, the aggregate_measurements result
+        """
+        # Collect aggregated values for each measurement type, one group_by per file and measurement
+        measurement_data = {
+            i: np.concatenate([aggregates[i]["value"].to_numpy() for aggregates in file_aggregates]) if file_aggregates else np.empty(0)
+            for i in range(len(self.measurements))
+        }
         
         # Compute quantile bins for each measurement
         for measurement_idx, measurement in enumerate(self.measurements):
@@ -121,183 +141,155 @@ class DemographicAggregationPreprocessor(BasePreprocessor):
                 print(f"  Warning: No valid values found for {token_prefix}Qx")
                 self.quantile_bins[measurement_idx] = None
     
-    def _aggregate_subject_measurement(self, subject_events: pl.DataFrame, measurement: Dict[str, Any]) -> Optional[float]:
-        """
-        Find and aggregate measurement values for a single subject
-        
-        Args:
-            subject_events (pl.DataFrame): All events for one subject
-            measurement (Dict): Measurement configuration
-            
-        Returns:
-            Optional[float]: Aggregated value or None if no valid measurements found
-        """
-        # Find matching measurement tokens
-        matching_events = subject_events.filter(pl.col("code").str.starts_with(measurement["token_pattern"]))
-        
-        if matching_events.is_empty():
-            return None
-        
-        # Extract values from specified column
-        values = []
-        value_column = measurement["value_column"]
-        
-        for event in matching_events.iter_rows(named=True):
-            value = event[value_column]
-            if value is not None:
-                try:
-                    # Convert to float
-                    numeric_value = float(value)
-                    values.append(numeric_value)
-                except (ValueError, TypeError):
-                    continue  # Skip non-numeric values
-        
-        if not values:
-            return None
-        
-        # Apply aggregation
-        aggregation = measurement["aggregation"]
-        if aggregation == "mean":
-            return np.mean(values)
-        elif aggregation == "min":
-            return np.min(values)
-        elif aggregation == "max":
-            return np.max(values)
-        elif aggregation == "median":
-            return np.median(values)
-        else:
-            raise ValueError(f"Unknown aggregation method: {aggregation}")
-    
-    def _bin_value(self, value: float, measurement_idx: int) -> Optional[str]:
+    def _bin_values(self, values: np.ndarray, measurement_idx: int) -> Optional[pl.Series]:
         """
-        Bin a value using the fitted quantile bins
+        Bin values using the fitted quantile bins
         
         Args:
-            value (float): Value to bin
+            values (np.ndarray): Values to bin
             measurement_idx (int): Index of measurement configuration
             
         Returns:
-            Optional[str]: Bin label (e.g., "Q3") or None if no bins available
+            Optional[pl.Series]: Bin labels (e.g., "Q3") or None if no bins available
         """
         if measurement_idx not in self.quantile_bins or self.quantile_bins[measurement_idx] is None:
             return None
         
         edges = self.quantile_bins[measurement_idx]
-        bin_index = np.digitize(value, edges[1:-1])  # Exclude first and last edges
+        bin_indices = np.digitize(values, edges[1:-1])  # Exclude first and last edges
 
         measurement = self.measurements[measurement_idx]
         bin_labels = measurement.get("bin_labels")
         if bin_labels is not None:
-            return bin_labels[bin_index]
+            return pl.Series(np.array([str(label) for label in bin_labels], dtype=object)[bin_indices], dtype=pl.String)
         
-        return f"Q{bin_index + 1}"  # 1-indexed bin labels
+        return "Q" + pl.Series(bin_indices + 1).cast(pl.String)  # 1-indexed bin labels
     
-    def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
+    def _inserted_code(self, measurement: Dict[str, Any]) -> str:
+        """
+        The code of the demographic events of a measurement type
+        
+        Args:
+            measurement (Dict): Measurement configuration
+            
+        Returns:
+            str: the token prefix without trailing slashes if the code is inserted, otherwise the no-code placeholder
+        """
+        if measurement.get("insert_code", True):
+            token_prefix = measurement.get("token_prefix", "")
+            return token_prefix.rstrip("//") if token_prefix else "DEMOGRAPHIC"
+        return "STATIC_DATA_NO_CODE"
+    
+    def encode_polars(self, events: pl.DataFrame, events_sorted: Optional[bool] = None) -> pl.DataFrame:
         """
         Process events to create demographic tokens and optionally remove original measurements
         
         Args:
             events (pl.DataFrame): Original events DataFrame
+            events_sorted (Optional[bool]): whether the events are known to be sorted by (subject_id, time), None checks
             
         Returns:
             pl.DataFrame: Events with demographic tokens added and original measurements optionally removed
         """
         print(f"Processing demographic measurements for {len(events['subject_id'].unique())} subjects...")
         
-        # Collect demographic events to add
-        demographic_events = []
-        
-        # Process each subject
-        for subject_id in events["subject_id"].unique():
-            subject_events = events.filter(pl.col("subject_id") == subject_id)
+        # Create the demographic events of each measurement type, for every subject with a value
+        demographic_event_sets = []
+        for measurement_idx, (measurement, aggregates) in enumerate(zip(self.measurements, aggregate_measurements(events, self.measurements))):
+            # Determine whether to bin or use raw rounded value
+            if "num_bins" in measurement:
+                # Use existing binning logic
+                text_content = self._bin_values(aggregates["value"].to_numpy(), measurement_idx)
+                if text_content is None:
+                    continue
+            else:
+                # Use raw value with rounding (Default to 1 decimal place)
+                decimals = measurement.get("decimals", 1)
+                text_content = map_unique_floats(aggregates["value"], lambda value: f"{value:.{decimals}f}")
             
-            # Process each measurement type for this subject
-            for measurement_idx, measurement in enumerate(self.measurements):
-                # Calculate aggregated value
-                aggregated_value = self._aggregate_subject_measurement(subject_events, measurement)
-                
-                if aggregated_value is not None:
-                    # Determine whether to bin or use raw rounded value
-                    text_content = None
-
-                    if "num_bins" in measurement:
-                        # Use existing binning logic
-                        text_content = self._bin_value(aggregated_value, measurement_idx)
-                    else:
-                        # Use raw value with rounding (Default to 1 decimal place)
-                        decimals = measurement.get("decimals", 1)
-                        text_content = f"{aggregated_value:.{decimals}f}"
-                    
-                    # Proceed only if we have a valid text value (bin or raw string)
-                    if text_content is not None:
-                        # Create demographic event
-                        token_prefix = measurement.get("token_prefix", "")
-                        insert_code = measurement.get("insert_code", True)
-                        
-                        if insert_code:
-                            # Code and value as separate tokens
-                            code = token_prefix.rstrip("//") if token_prefix else "DEMOGRAPHIC"
-                            text_value = text_content
-                        else:
-                            # Combined format with full control over prefix
-                            code = "STATIC_DATA_NO_CODE"
-                            text_value = f"{token_prefix}{text_content}"
-                        
-                        # Create demographic event with full MEDS schema
-                        demographic_event = {}
-                        demographic_event["subject_id"] = subject_id
-                        demographic_event["time"] = None  # Static demographic data
-                        demographic_event["code"] = code
-                        demographic_event["numeric_value"] = None
-                        demographic_event["text_value"] = text_value
-                        
-                        # Fill in all other columns from original events with None
-                        for col in events.columns:
-                            if col not in demographic_event:
-                                demographic_event[col] = None
-                        
-                        demographic_events.append(demographic_event)
-        
-        # Create demographic events DataFrame if any were created
-        if demographic_events:
-            demographic_df = pl.DataFrame(demographic_events)
+            code = self._inserted_code(measurement)
+            if measurement.get("insert_code", True):
+                # Code and value as separate tokens
+                text_value = text_content
+            else:
+                # Combined format with full control over prefix
+                text_value = measurement.get("token_prefix", "") + text_content
             
-            # Ensure schema compatibility
-            demographic_df = demographic_df.select(events.columns)
-            for col in events.columns:
-                original_dtype = events.select(col).dtypes[0]
-                demographic_df = demographic_df.with_columns(pl.col(col).cast(original_dtype))
-        else:
+            # Demographic events are static, without a time
+            demographic_event_sets.append(aggregates.select(
+                "subject_id",
+                pl.lit(code).alias("code"),
+                text_value.alias("text_value"),
+            ))
+        
+        demographic_df = pl.concat(demographic_event_sets) if demographic_event_sets else None
+        if demographic_df is not None and demographic_df.is_empty():
             demographic_df = None
         
-        # Remove original measurement tokens if requested
+        # Remove original measurement tokens if requested, with one anti-filter over the exact codes
         original_events = events
-        for measurement in self.measurements:
-            if measurement.get("remove_original_tokens", False):
-                # Remove all events matching this token pattern
-                events = events.filter(pl.col("code") != measurement["token_pattern"])
+        removed_codes = [measurement["token_pattern"] for measurement in self.measurements if measurement.get("remove_original_tokens", False)]
+        if removed_codes:
+            events = events.filter(pl.col("code").is_not_null() & ~pl.col("code").is_in(removed_codes))
         
         removed_count = len(original_events) - len(events)
         print(f"Removed {removed_count} original measurement tokens")
         
-        # Combine demographic events with (possibly filtered) original events
+        # Combine demographic events with (possibly filtered) original events, each subject's
+        # demographic events in measurement order ahead of its timeline (the events are sorted even without any)
         if demographic_df is not None:
-            if not events.is_empty():
-                combined_events = pl.concat([demographic_df, events], how="vertical")
-            else:
-                combined_events = demographic_df
-        else:
-            combined_events = events
-        
-        # Sort by subject_id and time (null values will sort first)
-        combined_events = combined_events.sort(["subject_id", "time"])
+            demographic_df = align_to_schema(demographic_df, events.schema)
+        combined_events = insert_static_events(events, events.clear() if demographic_df is None else demographic_df, events_sorted)
         
         # Print summary
-        print(f"Added {len(demographic_events)} demographic events")
+        print(f"Added {0 if demographic_df is None else len(demographic_df)} demographic events")
         
         return combined_events
 
 
+def aggregate_measurements(events: pl.DataFrame, measurements: List[Dict[str, Any]]) -> List[pl.DataFrame]:
+    """
+    Aggregate every subject's values of each measurement type.
+    Values are the events whose code starts with the token pattern, converted as float() does, skipping
+    those that are not numeric. One group_by per measurement collects each subject's values in event
+    order, then subjects with the same number of values are aggregated together with the numpy function,
+    which gives the same result as calling it on each subject's values.
+
+    Args:
+        events (pl.DataFrame): the events
+        measurements (List[Dict[str, Any]]): the measurement configurations
+
+    Returns:
+        List[pl.DataFrame]: per measurement, the subject_id and aggregated value of every subject with a value,
+            in order of each subject's first value
+    """
+    aggregations = {"mean": np.mean, "min": np.min, "max": np.max, "median": np.median}
+    results = []
+    for measurement in measurements:
+        matching = events.filter(
+            pl.col("subject_id").is_not_null()
+            & pl.col("code").str.starts_with(measurement["token_pattern"])
+            & pl.col(measurement["value_column"]).is_not_null()
+        )
+        grouped = (
+            pl.DataFrame({"subject_id": matching["subject_id"], "value": python_float(matching[measurement["value_column"]])})
+            .drop_nulls("value")
+            .group_by("subject_id", maintain_order=True)
+            .agg(pl.col("value"))
+        )
+
+        lengths = grouped["value"].list.len().to_numpy()
+        flat_values = grouped["value"].explode().to_numpy()
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        aggregated = np.empty(len(lengths), dtype=np.float64)
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            aggregated[rows] = aggregations[measurement["aggregation"]](flat_values[starts[rows, None] + np.arange(length)], axis=1)
+
+        results.append(grouped.select("subject_id", pl.Series("value", aggregated, dtype=pl.Float64)))
+    return results
+
+
 if __name__ == "__main__":
     # Test the preprocessor
     test_measurements = [
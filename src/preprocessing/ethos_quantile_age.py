@@ -3,7 +3,8 @@ import numpy as np
 from datetime import datetime
 from typing import List, Dict, Any, Optional, Union
 from .base import BasePreprocessor
-from tqdm import tqdm
+from .age import BIRTH_CODE, SECONDS_PER_YEAR, subject_ages
+from .utils import align_to_schema, insert_static_events
 
 class EthosQuantileAgePreprocessor(BasePreprocessor):
     """
@@ -25,6 +26,7 @@ class EthosQuantileAgePreprocessor(BasePreprocessor):
         insert_t1_code (bool): Whether to insert code for first age component (default: True)
         insert_t2_code (bool): Whether to insert code for second age component (default: True)
     """
+    inserts_events = True
     
     def __init__(self, matching_type: str, matching_value: str, time_unit: str = "years",
                  num_quantiles: int = 10, prefix: str = "AGE_", 
@@ -64,64 +66,20 @@ class EthosQuantileAgePreprocessor(BasePreprocessor):
         """
         print("EthosQuantileAgePreprocessor fit complete (no training required - uses deterministic algorithm)")
     
-    def _calculate_age_from_timeline(self, subject_events: pl.DataFrame) -> float:
+    def _calculate_ages(self, events: pl.DataFrame) -> pl.DataFrame:
         """
-        Calculate age from the time delta between MEDS_BIRTH and first real medical event
+        Calculate each subject's age from the time delta between MEDS_BIRTH and their first real medical event
         
         Args:
-            subject_events (pl.DataFrame): All events for a single subject
+            events (pl.DataFrame): All events
             
         Returns:
-            float: Age in specified time units
+            pl.DataFrame: subject_id and age in the specified time units of every subject with a MEDS_BIRTH event,
+                0 when the birth time or the first real medical event is missing
         """
-        # Find MEDS_BIRTH event
-        birth_events = subject_events.filter(pl.col("code") == "MEDS_BIRTH")
-        if birth_events.is_empty():
-            return 0.0  # No birth event found
-        
-        birth_time = birth_events["time"].to_list()[0]
-        if birth_time is None:
-            return 0.0  # No birth timestamp
-        
-        # Find first real medical event (not demographics, not birth, not null time)
-        real_events = subject_events.filter(
-            (pl.col("code") != "MEDS_BIRTH") &
-            (pl.col("time").is_not_null()) &
-            (~pl.col("code").str.starts_with("DEMOGRAPHICS//")) &
-            (~pl.col("code").str.starts_with("RACE//")) &
-            (~pl.col("code").str.starts_with("MARITAL_STATUS//")) &
-            (pl.col("code") != "STATIC_DATA_NO_CODE")
-        ).sort("time")
-        
-        if real_events.is_empty():
-            return 0.0  # No real medical events found
-        
-        first_medical_time = real_events["time"].to_list()[0]
-        if first_medical_time is None:
-            return 0.0  # No timestamp on first medical event
-        
-        # Calculate time delta
-        if hasattr(birth_time, 'timestamp'):
-            birth_timestamp = birth_time.timestamp()
-        else:
-            birth_timestamp = birth_time
-            
-        if hasattr(first_medical_time, 'timestamp'):
-            medical_timestamp = first_medical_time.timestamp()
-        else:
-            medical_timestamp = first_medical_time
-        
-        time_delta_seconds = medical_timestamp - birth_timestamp
-        
-        # Convert to specified time unit
-        if self.time_unit == "years":
-            return time_delta_seconds / (365.25 * 24 * 3600)
-        elif self.time_unit == "days":
-            return time_delta_seconds / (24 * 3600)
-        elif self.time_unit == "hours":
-            return time_delta_seconds / 3600
-        
-        return max(0.0, time_delta_seconds / (365.25 * 24 * 3600))  # Default to years
+        seconds_per_unit = {"years": SECONDS_PER_YEAR, "days": 24 * 3600, "hours": 3600}[self.time_unit]
+        ages = subject_ages(events, static_prefixes=("DEMOGRAPHICS//", "RACE//", "MARITAL_STATUS//"), seconds_per_unit=seconds_per_unit)
+        return ages.with_columns(pl.col("age").fill_null(0.0))
     
     def _encode_age_to_quantiles(self, age_years: float) -> tuple[str, str]:
         """
@@ -133,43 +91,58 @@ class EthosQuantileAgePreprocessor(BasePreprocessor):
         Returns:
             tuple[str, str]: (age_t1_token, age_t2_token)
         """
+        token1, token2 = self._encode_ages_to_quantiles(np.array([age_years], dtype=np.float64))
+        return token1[0], token2[0]
+
+    def _encode_ages_to_quantiles(self, ages: np.ndarray) -> tuple[pl.Series, pl.Series]:
+        """
+        Apply the Ethos quantile age encoding algorithm to an array of ages. numpy's floor_divide,
+        remainder and rint follow Python's //, % and round on floats.
+        
+        Args:
+            ages (np.ndarray): Patient ages in years
+            
+        Returns:
+            tuple[pl.Series, pl.Series]: the age_t1 tokens and the age_t2 tokens
+        """
         # Step 1: Scale age to quantile space
-        age_scaled = age_years * (self.num_quantiles ** 2) / 100
-        age_scaled = min(age_scaled, self.num_quantiles ** 2 - 1)  # Cap at max value
+        age_scaled = ages * (self.num_quantiles ** 2) / 100
+        age_scaled = np.minimum(age_scaled, self.num_quantiles ** 2 - 1)  # Cap at max value
         
         # Step 2: Split into two components
-        age_t1 = int(age_scaled // self.num_quantiles)  # floor
-        age_t2 = int(round(age_scaled % self.num_quantiles))  # round
+        age_t1 = np.floor_divide(age_scaled, self.num_quantiles).astype(np.int64)  # floor
+        age_t2 = np.rint(np.remainder(age_scaled, self.num_quantiles)).astype(np.int64)  # round
         
         # Step 3: Handle edge case
-        if age_t2 == self.num_quantiles:
-            age_t1 += 1
-            age_t2 = 0
+        carry = age_t2 == self.num_quantiles
+        age_t1 = np.where(carry, age_t1 + 1, age_t1)
+        age_t2 = np.where(carry, 0, age_t2)
         
         # Step 4: Generate tokens (1-indexed)
-        token1 = f"Q{age_t1 + 1}"
-        token2 = f"Q{age_t2 + 1}"
+        token1 = "Q" + pl.Series(age_t1 + 1).cast(pl.String)
+        token2 = "Q" + pl.Series(age_t2 + 1).cast(pl.String)
         
         return token1, token2
     
-    def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
+    def encode_polars(self, events: pl.DataFrame, events_sorted: Optional[bool] = None) -> pl.DataFrame:
         """
         Replace MEDS_BIRTH events with two quantile age events based on timeline analysis
         
         Args:
             events (pl.DataFrame): Original events DataFrame
+            events_sorted (Optional[bool]): whether the events are known to be sorted by (subject_id, time), None checks
             
         Returns:
             pl.DataFrame: Events DataFrame with MEDS_BIRTH replaced by age quantiles
         """
         # Find MEDS_BIRTH events
-        birth_events = events.filter(pl.col("code") == "MEDS_BIRTH")
+        birth_events = events.filter(pl.col("code") == BIRTH_CODE)
         
         # Decide whether to keep or remove MEDS_BIRTH events
         if self.keep_meds_birth:
             non_birth_events = events  # Keep all events including MEDS_BIRTH
         else:
-            non_birth_events = events.filter(pl.col("code") != "MEDS_BIRTH")  # Remove MEDS_BIRTH
+            non_birth_events = events.filter(pl.col("code") != BIRTH_CODE)  # Remove MEDS_BIRTH
         
         if birth_events.is_empty():
             print("No MEDS_BIRTH events found to process")
@@ -177,80 +150,37 @@ class EthosQuantileAgePreprocessor(BasePreprocessor):
         
         print(f"Processing {len(birth_events)} MEDS_BIRTH events using dynamic age calculation")
         
-        # Process each subject separately to calculate age from their timeline
-        age_events = []
-        processed_subjects = set()
-        
-        for subject_id in events["subject_id"].unique():
-            if subject_id in processed_subjects:
-                continue
-            processed_subjects.add(subject_id)
-            
-            # Get all events for this subject
-            subject_events = events.filter(pl.col("subject_id") == subject_id)
-            
-            # Find MEDS_BIRTH event for this subject
-            subject_birth_events = subject_events.filter(pl.col("code") == "MEDS_BIRTH")
-            if subject_birth_events.is_empty():
-                continue  # No birth event for this subject
-            
-            # Calculate age from timeline
-            age_in_time_units = self._calculate_age_from_timeline(subject_events)
-            age_t1_token, age_t2_token = self._encode_age_to_quantiles(age_in_time_units)
-            
-            # Get the birth event to use as template
-            birth_event = subject_birth_events.to_dicts()[0]
-            
-            # Create two age events with same schema as original
-            base_event = dict(birth_event)
-            
-            # Create age_t1 event
-            if self.insert_t1_code:
-                t1_code = f"{self.prefix}T1"
-                t1_value = age_t1_token
-            else:
-                t1_code = "STATIC_DATA_NO_CODE"
-                t1_value = f"{self.prefix}T1//{age_t1_token}" if self.prefix else f"T1//{age_t1_token}"
-            
-            age_t1_event = base_event.copy()
-            age_t1_event["code"] = t1_code
-            age_t1_event["text_value"] = t1_value
-            age_t1_event["numeric_value"] = None
-            age_t1_event["time"] = None  # Set timestamp to None for static age data
-            
-            # Create age_t2 event  
-            if self.insert_t2_code:
-                t2_code = f"{self.prefix}T2"
-                t2_value = age_t2_token
+        # Calculate every subject's age from their timeline, in order of their first MEDS_BIRTH event
+        ages = self._calculate_ages(events)
+        age_t1_tokens, age_t2_tokens = self._encode_ages_to_quantiles(ages["age"].to_numpy())
+        
+        # The first birth event of each subject is the template of its age events
+        base_events = (
+            birth_events.filter(pl.col("subject_id").is_not_null())
+            .group_by("subject_id", maintain_order=True)
+            .agg(pl.all().first())
+            .select(events.columns)
+        )
+        
+        # Create the age_t1 and age_t2 events with the same schema as the original
+        age_event_sets = []
+        for insert_code, component, tokens in [(self.insert_t1_code, "T1", age_t1_tokens), (self.insert_t2_code, "T2", age_t2_tokens)]:
+            if insert_code:
+                code = f"{self.prefix}{component}"
+                value = tokens
             else:
-                t2_code = "STATIC_DATA_NO_CODE"
-                t2_value = f"{self.prefix}T2//{age_t2_token}" if self.prefix else f"T2//{age_t2_token}"
-            
-            age_t2_event = base_event.copy()
-            age_t2_event["code"] = t2_code
-            age_t2_event["text_value"] = t2_value
-            age_t2_event["numeric_value"] = None
-            age_t2_event["time"] = None  # Set timestamp to None for static age data
-            
-            age_events.extend([age_t1_event, age_t2_event])
-        
-        # Convert age events to DataFrame if any were created
-        if age_events:
-            age_df = pl.DataFrame(age_events)
-            
-            # Ensure schema compatibility
-            age_df = age_df.select(events.columns)
-            for col in events.columns:
-                original_dtype = events.select(col).dtypes[0]
-                age_df = age_df.with_columns(pl.col(col).cast(original_dtype))
-            
-            # Combine with non-birth events
-            combined_events = pl.concat([age_df, non_birth_events], how="vertical")
-        else:
-            combined_events = non_birth_events
-        
-        # Sort by subject_id and time
-        combined_events = combined_events.sort(["subject_id", "time"])
+                code = "STATIC_DATA_NO_CODE"
+                value = f"{self.prefix}{component}//" + tokens if self.prefix else f"{component}//" + tokens
+            age_event_sets.append(base_events.with_columns(
+                pl.lit(code).alias("code"),
+                value.alias("text_value"),
+                pl.lit(None).alias("numeric_value"),
+                pl.lit(None).alias("time"),  # Set timestamp to None for static age data
+            ))
+        
+        # Combine with non-birth events, each subject's T1 event before its T2 event
+        age_events = align_to_schema(pl.concat(age_event_sets, how="diagonal_relaxed"), events.schema)
+        combined_events = insert_static_events(non_birth_events, age_events, events_sorted)
         
         if self.keep_meds_birth:
             print(f"Added {len(age_events)} age quantile events (kept {len(birth_events)} MEDS_BIRTH events)")
@@ -1,5 +1,7 @@
 from .base import BasePreprocessor
-from typing import List
+from typing import List, Optional
+from functools import reduce
+import operator
 import polars as pl
 
 class FilterPreprocessor(BasePreprocessor):
@@ -16,6 +18,20 @@ class FilterPreprocessor(BasePreprocessor):
         pass
 
     def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
+        predicate = self._predicate()
+        if predicate is None:
+            return events
+        return events.filter(predicate)
+
+    def encode_lazy(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        # A plain filter, so Polars can push it down into the parquet scan
+        predicate = self._predicate()
+        if predicate is None:
+            return events
+        return events.filter(predicate)
+
+    def _predicate(self) -> Optional[pl.Expr]:
+        """The expression selecting the events to keep, or None if nothing is filtered."""
         mask = None
         if self.matching_type == "starts_with":
             mask = pl.col("code").str.starts_with(self.matching_value)
@@ -29,6 +45,35 @@ class FilterPreprocessor(BasePreprocessor):
             mask = pl.col("code").str.contains(self.matching_value, literal=False)
             
         if mask is None:
-            return events
+            return None
     
-        return events.filter(~mask if not self.invert else mask)
\ No newline at end of file
+        return ~mask if not self.invert else mask
+
+class FusedFilterPreprocessor(BasePreprocessor):
+    """
+    Applies several adjacent row filters (FilterPreprocessor, TopKCodePreprocessor) as one predicate.
+    Built by the preprocessing planner, an event is kept if every filter keeps it.
+
+    Args:
+        filters (list): the fitted filters to apply, in pipeline order
+    """
+    def __init__(self, filters: list):
+        # Matching is done by the fused filters, the attributes are kept for interface compatibility
+        self.matching_type = ""
+        self.matching_value = ""
+        self.filters = filters
+
+    def fit(self, event_files: List[str]) -> None:
+        """The filters are already fitted."""
+        pass
+
+    def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
+        return events.filter(self._predicate())
+
+    def encode_lazy(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        return events.filter(self._predicate())
+
+    def _predicate(self) -> pl.Expr:
+        """The conjunction of the filters' predicates, filters that filter nothing are skipped."""
+        predicates = [predicate for predicate in (row_filter._predicate() for row_filter in self.filters) if predicate is not None]
+        return reduce(operator.and_, predicates, pl.lit(True))
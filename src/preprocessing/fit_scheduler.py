@@ -0,0 +1,221 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from functools import partial
+import os
+from tqdm import tqdm
+import polars as pl
+from .base import BasePreprocessor, ValuePreprocessor, CodePreprocessor
+from .utils import EVENT_COLUMNS, map_event_files, preprocess_events, summarise_values
+
+class ShardConsumer:
+    """
+    Something fitted on the train shards, e.g. a preprocessor or a tokenizer. The FitScheduler reads each
+    shard once and calls accumulate with the shard's events after the consumer's preprocessors are applied,
+    then calls finish with the results of every shard, in file order.
+
+    accumulate may run in a worker process: it must be picklable (a module level function or a bound method
+    of a picklable object) and return its result rather than update state.
+
+    Args:
+        name (str): the name shown in the progress bar
+        accumulate (Callable[[pl.DataFrame], Any]): summarises the events of one shard
+        finish (Callable[[List[Any]], None]): fits from the summaries of all shards, in file order
+        preprocessors (Optional[List[BasePreprocessor]]): fitted preprocessors applied before accumulate
+        columns (Optional[List[str]]): the columns accumulate reads, kept if present, None keeps every column
+        fits (Sequence[Any]): the objects finish fits, consumers whose preprocessors include one of them
+            run in a later pass
+    """
+    def __init__(
+        self,
+        name: str,
+        accumulate: Callable[[pl.DataFrame], Any],
+        finish: Callable[[List[Any]], None],
+        preprocessors: Optional[List[BasePreprocessor]] = None,
+        columns: Optional[List[str]] = EVENT_COLUMNS,
+        fits: Sequence[Any] = (),
+    ):
+        self.name = name
+        self.accumulate = accumulate
+        self.finish = finish
+        self.preprocessors = list(preprocessors or [])
+        self.columns = columns
+        self.fits = list(fits)
+
+    def depends_on(self, other: "ShardConsumer") -> bool:
+        """Whether this consumer reads events through a preprocessor the other consumer fits."""
+        return any(fitted is preprocessor for fitted in other.fits for preprocessor in self.preprocessors)
+
+class FitScheduler:
+    """
+    Feeds every registered consumer from a shared scan of the train shards. Consumers are run in passes
+    in dependency order: a consumer whose preprocessors are fitted by another consumer runs in the pass
+    after it. Within a pass each shard is read once, consumers with the same preprocessors share the
+    preprocessed events, and shards are processed on a process pool when workers > 1.
+
+    Args:
+        event_files (List[str]): the train shards
+        workers (int): number of worker processes (1 reads the shards serially)
+    """
+    def __init__(self, event_files: List[str], workers: int = 1):
+        self.event_files = event_files
+        self.workers = workers
+        self.consumers: List[ShardConsumer] = []
+
+    def register(self, consumer: ShardConsumer) -> "FitScheduler":
+        """
+        Add a consumer to the next run.
+
+        Args:
+            consumer (ShardConsumer): the consumer
+
+        Returns:
+            FitScheduler: this scheduler
+        """
+        self.consumers.append(consumer)
+        return self
+
+    def passes(self) -> List[List[ShardConsumer]]:
+        """
+        Group the registered consumers into passes over the shards, each after the passes it depends on.
+
+        Returns:
+            List[List[ShardConsumer]]: the consumers of each pass, in registration order
+        """
+        levels: Dict[int, int] = {}
+        remaining = list(self.consumers)
+        while remaining:
+            ready = [
+                consumer for consumer in remaining
+                if all(id(other) in levels for other in self.consumers if other is not consumer and consumer.depends_on(other))
+            ]
+            if not ready:
+                raise ValueError(f"Circular fit dependencies between: {[consumer.name for consumer in remaining]}")
+            for consumer in ready:
+                levels[id(consumer)] = 1 + max(
+                    [levels[id(other)] for other in self.consumers if other is not consumer and consumer.depends_on(other)],
+                    default=-1,
+                )
+            remaining = [consumer for consumer in remaining if id(consumer) not in levels]
+
+        passes = [[] for _ in range(1 + max(levels.values(), default=-1))]
+        for consumer in self.consumers:
+            passes[levels[id(consumer)]].append(consumer)
+        return passes
+
+    def run(self) -> None:
+        """Run the registered consumers, each shard is read once per pass. The consumers are then cleared."""
+        for file_path in self.event_files:
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"Event file not found: {file_path}")
+
+        for consumers in self.passes():
+            # resolve the steps in this process, once the previous passes have fitted their preprocessors
+            steps = [(consumer.accumulate, consumer.preprocessors, consumer.columns) for consumer in consumers]
+            desc = "Fitting " + ", ".join(consumer.name for consumer in consumers)
+            shard_results = map_event_files(consume_shard, self.event_files, self.workers, desc, steps)
+            for index, consumer in enumerate(consumers):
+                consumer.finish([results[index] for results in shard_results])
+        self.consumers = []
+
+def consume_shard(event_file: str, steps: List[tuple]) -> List[Any]:
+    """
+    Read one shard and call every accumulate function on it, see FitScheduler.
+
+    Args:
+        event_file (str): the parquet file to read
+        steps (List[tuple]): (accumulate, preprocessors, columns) of each consumer
+
+    Returns:
+        List[Any]: the result of each accumulate function
+    """
+    schema = pl.read_parquet_schema(event_file)
+    if any(preprocessors or columns is None for _accumulate, preprocessors, columns in steps):
+        # preprocessors may read any column
+        read_columns = list(schema)
+    else:
+        read_columns = [column for column in schema if any(column in columns for _accumulate, _preprocessors, columns in steps)]
+    shard = pl.read_parquet(event_file, columns=read_columns)
+
+    results = []
+    preprocessed = {}
+    for accumulate, preprocessors, columns in steps:
+        key = tuple(id(preprocessor) for preprocessor in preprocessors)
+        if key not in preprocessed:
+            preprocessed[key] = preprocess_events(shard.lazy(), preprocessors).collect(engine="streaming") if preprocessors else shard
+        events = preprocessed[key]
+        if columns is not None:
+            events = events.select([column for column in columns if column in events.columns])
+        results.append(accumulate(events))
+    return results
+
+def fit_preprocessors_jointly(preprocessors: List[BasePreprocessor], event_files: List[str], workers: int = 1) -> None:
+    """
+    Fit multiple preprocessors jointly by reading through the data files only once.
+    Preprocessors that learn from the events register a ShardConsumer (see BasePreprocessor.fit_consumer),
+    the value preprocessors share one consumer that collects their values after the code preprocessors are
+    applied, and a FitScheduler feeds them all from a single read of each file.
+    Fits the preprocessors in place and does not return anything.
+
+    Args:
+        preprocessors (List[BasePreprocessor]): list of preprocessors to fit
+        event_files (List[str]): list of parquet file paths to train on
+        workers (int): number of worker processes used to read the files (1 reads serially)
+
+    Returns:
+        None
+    """
+    # Validate all files exist before processing
+    for file_path in event_files:
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Event file not found: {file_path}")
+
+    # Separate preprocessors by type
+    value_preprocessors = [p for p in preprocessors if isinstance(p, ValuePreprocessor)]
+    code_preprocessors = [p for p in preprocessors if isinstance(p, CodePreprocessor)]
+    other_preprocessors = [p for p in preprocessors if not isinstance(p, (ValuePreprocessor, CodePreprocessor))]
+
+    # Fit code preprocessors (they don't need to read event files for training data)
+    for preprocessor in tqdm(code_preprocessors, desc="Fitting code preprocessors", leave=False):
+        preprocessor.fit(event_files)
+
+    # Other preprocessors either read the events through the scheduler or fit on their own, e.g. from a lookup file
+    scheduler = FitScheduler(event_files, workers)
+    for preprocessor in tqdm(other_preprocessors, desc="Fitting other preprocessors", leave=False):
+        consumer = preprocessor.fit_consumer()
+        if consumer is None:
+            preprocessor.fit(event_files)
+        else:
+            scheduler.register(consumer)
+
+    if value_preprocessors:
+        value_columns = [preprocessor.value_column for preprocessor in value_preprocessors]
+        scheduler.register(ShardConsumer(
+            "value preprocessors",
+            partial(summarise_values, value_preprocessors=value_preprocessors),
+            partial(_fit_value_preprocessors, value_preprocessors),
+            preprocessors=code_preprocessors,
+            columns=list(dict.fromkeys(["code", "numeric_value", "text_value", *value_columns])),
+            fits=value_preprocessors,
+        ))
+
+    scheduler.run()
+
+def _fit_value_preprocessors(value_preprocessors: List[ValuePreprocessor], collected: List[List[Dict[str, Any]]]) -> None:
+    """
+    Fit the value preprocessors from the summaries of summarise_values of every file.
+
+    Args:
+        value_preprocessors (List[ValuePreprocessor]): the value preprocessors
+        collected (List[List[Dict[str, Any]]]): per file, the summaries of each value preprocessor
+    """
+    # Merge the per file summaries in file order, so each code's values are in the order they were read
+    for index, preprocessor in enumerate(value_preprocessors):
+        parts: Dict[str, List[Any]] = {}
+        for file_summaries in collected:
+            for code, summary in file_summaries[index].items():
+                parts.setdefault(code, []).append(summary)
+        for code, summaries in parts.items():
+            preprocessor._add_summaries(code, summaries)
+
+    # Finally, fit the value preprocessors with the correctly collected data
+    for preprocessor in tqdm(value_preprocessors, desc="Fitting value preprocessors", leave=False):
+        preprocessor._fit()
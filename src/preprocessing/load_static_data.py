@@ -1,8 +1,9 @@
 import polars as pl
 import os
 from typing import Dict, List, Any, Optional
+import numpy as np
 from .base import BasePreprocessor
-from tqdm import tqdm
+from .utils import align_to_schema, insert_static_events
 
 class LoadStaticDataPreprocessor(BasePreprocessor):
     """
@@ -20,6 +21,8 @@ class LoadStaticDataPreprocessor(BasePreprocessor):
         columns (List[Dict]): List of column configurations with mappings and validation
     """
     
+    inserts_events = True
+
     def __init__(self, matching_type: str, matching_value: str, csv_filepath: str, 
                  subject_id_column: str, columns: List[Dict[str, Any]]):
         # Initialize base class attributes directly since matching is not used for static data
@@ -30,7 +33,7 @@ class LoadStaticDataPreprocessor(BasePreprocessor):
         self.subject_id_column = subject_id_column
         self.columns = columns
         self.static_data: Optional[pl.DataFrame] = None
-        self.subject_lookup: Dict[Any, Dict[str, str]] = {}
+        self.static_events: Optional[pl.DataFrame] = None
         
         # Validate column configurations
         self._validate_column_configs()
@@ -69,35 +72,37 @@ class LoadStaticDataPreprocessor(BasePreprocessor):
             if column_name not in self.static_data.columns:
                 raise ValueError(f"Column '{column_name}' not found in CSV. Available columns: {self.static_data.columns}")
         
-        # Create subject lookup table
-        self._create_subject_lookup()
+        # Compile the cleaned static events of every subject
+        self._compile_static_events()
         
-        print(f"Loaded static data for {len(self.subject_lookup)} subjects")
+        print(f"Loaded static data for {len(self.static_events)} subjects")
         
         # Print statistics about data values
         self._print_data_statistics()
     
-    def _create_subject_lookup(self):
-        """Create a lookup dictionary mapping subject_id to processed static data"""
-        self.subject_lookup = {}
-        
+    def _compile_static_events(self):
+        """
+        Create the static events table, one row per subject with the cleaned value and the final
+        text value of every configured column. Values are cleaned once per distinct value.
+        """
         # Handle multiple rows per subject by taking the first occurrence
         # (could be modified to take most recent which may effect columns like marital_status)
-        unique_subjects = self.static_data.group_by(self.subject_id_column).first()
+        unique_subjects = self.static_data.group_by(self.subject_id_column, maintain_order=True).first()
         
-        for row in tqdm(unique_subjects.iter_rows(named=True), desc="Processing static data"):
-            subject_id = row[self.subject_id_column]
-            subject_data = {}
-            
-            for col_config in self.columns:
-                column_name = col_config["column_name"]
-                raw_value = row[column_name]
-                
-                # Clean and map the value
-                cleaned_value = self._clean_value(raw_value, col_config)
-                subject_data[column_name] = cleaned_value
-            
-            self.subject_lookup[subject_id] = subject_data
+        columns = [unique_subjects[self.subject_id_column].alias("subject_id")]
+        for index, col_config in enumerate(self.columns):
+            raw_values = unique_subjects[col_config["column_name"]]
+            distinct_values = raw_values.drop_nulls().unique(maintain_order=True).to_list()
+            for name, function in [("cleaned", self._clean_value), ("text", self._static_text)]:
+                mapped = [function(value, col_config) for value in distinct_values]
+                columns.append(raw_values.replace_strict(
+                    distinct_values,
+                    [None if value is None else str(value) for value in mapped],
+                    default=_optional_str(function(None, col_config)),
+                    return_dtype=pl.String,
+                ).alias(f"{name}_{index}"))
+        
+        self.static_events = pl.DataFrame(columns)
     
     def _clean_value(self, value: Any, col_config: Dict[str, Any]) -> str:
         """
@@ -131,31 +136,44 @@ class LoadStaticDataPreprocessor(BasePreprocessor):
         
         return str_value
     
+    def _static_text(self, value: Any, col_config: Dict[str, Any]) -> Any:
+        """
+        Text value of the static event for a raw value, the cleaned value with the value prefix if specified
+        
+        Args:
+            value: Raw value from CSV
+            col_config: Column configuration dictionary
+            
+        Returns:
+            The text value of the static event
+        """
+        cleaned_value = self._clean_value(value, col_config)
+        if "value_prefix" in col_config and col_config["value_prefix"]:
+            return f"{col_config['value_prefix']}{cleaned_value}"
+        return cleaned_value
+    
     def _print_data_statistics(self):
         """Print statistics about the loaded static data"""
         print("\n=== Static Data Statistics ===")
         
-        for col_config in self.columns:
+        for index, col_config in enumerate(self.columns):
             column_name = col_config["column_name"]
             print(f"\n{column_name.upper()} distribution:")
             
-            # Count occurrences of each value
-            value_counts = {}
-            for subject_data in self.subject_lookup.values():
-                value = subject_data[column_name]
-                value_counts[value] = value_counts.get(value, 0) + 1
-            
-            # Sort by count descending
-            for value, count in sorted(value_counts.items(), key=lambda x: x[1], reverse=True):
-                percentage = (count / len(self.subject_lookup)) * 100
+            # Count occurrences of each value, sorted by count descending
+            value_counts = self.static_events.group_by(f"cleaned_{index}", maintain_order=True).len()
+            for value, count in value_counts.sort("len", descending=True, maintain_order=True).iter_rows():
+                percentage = (count / len(self.static_events)) * 100
                 print(f"  {value}: {count} ({percentage:.1f}%)")
     
-    def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
+    def encode_polars(self, events: pl.DataFrame, events_sorted: Optional[bool] = None) -> pl.DataFrame:
         """
         Insert static data events at the beginning of each subject's timeline.
+        Subjects are joined to the static events table, subjects missing from it get the default values.
         
         Args:
             events (pl.DataFrame): Original events DataFrame
+            events_sorted (Optional[bool]): whether the events are known to be sorted by (subject_id, time), None checks
             
         Returns:
             pl.DataFrame: Events DataFrame with static data events inserted
@@ -163,119 +181,66 @@ class LoadStaticDataPreprocessor(BasePreprocessor):
         if self.static_data is None:
             raise ValueError("Preprocessor must be fitted before encoding. Call fit() first.")
         
-        # Collect new static data events
-        static_events = []
-        
         # Get unique subject IDs from the events
-        unique_subjects = events.select("subject_id").unique().to_series().to_list()
-        
-        # Track matching statistics
-        subjects_found = 0
-        subjects_missing = 0
+        unique_subjects = events.select(pl.col("subject_id").unique(maintain_order=True))
+        static_events = self.static_events.select("subject_id", *[f"text_{index}" for index in range(len(self.columns))])
         
-        for subject_id in unique_subjects:
-            if subject_id in self.subject_lookup:
-                subjects_found += 1
-                subject_data = self.subject_lookup[subject_id]
-                
-                # Create events for each configured column
-                for col_config in self.columns:
-                    column_name = col_config["column_name"]
-                    code_template = col_config["code_template"]
-                    value = subject_data[column_name]
-                    
-                    # Create the event with schema matching the original events DataFrame
-                    static_event = {}
-                    
-                    # Apply value prefix if specified
-                    final_value = value
-                    if "value_prefix" in col_config and col_config["value_prefix"]:
-                        final_value = f"{col_config['value_prefix']}{value}"
-                    
-                    # Determine if code should be inserted
-                    insert_code = col_config.get("insert_code", True)  # Default to True for backward compatibility
-                    final_code = code_template if insert_code else "STATIC_DATA_NO_CODE"  # Use placeholder that won't match patterns
-                    
-                    # Set the key demographic fields
-                    static_event["subject_id"] = subject_id
-                    static_event["time"] = None  # Static data has null timestamp
-                    static_event["code"] = final_code
-                    static_event["numeric_value"] = None
-                    static_event["text_value"] = final_value
-                    
-                    # Fill in all other columns from the original events with None
-                    for col in events.columns:
-                        if col not in static_event:
-                            static_event[col] = None
-                    static_events.append(static_event)
+        # Subject IDs match if they are equal as Python values, e.g. 1001 and 1001.0 but not "1001"
+        key_dtype = static_events["subject_id"].dtype
+        if key_dtype != unique_subjects["subject_id"].dtype:
+            if key_dtype.is_numeric() and unique_subjects["subject_id"].dtype.is_numeric():
+                key_dtype = pl.Float64
             else:
-                subjects_missing += 1
-                
-                # Create events with default values for each configured column
-                for col_config in self.columns:
-                    column_name = col_config["column_name"]
-                    code_template = col_config["code_template"]
-                    default_value = col_config.get("map_invalids_to", "UNKNOWN")
-                    
-                    # Create the event with default value and schema matching the original events DataFrame
-                    static_event = {}
-                    
-                    # Apply value prefix to default value if specified
-                    final_default_value = default_value
-                    if "value_prefix" in col_config and col_config["value_prefix"]:
-                        final_default_value = f"{col_config['value_prefix']}{default_value}"
-                    
-                    # Determine if code should be inserted
-                    insert_code = col_config.get("insert_code", True)  # Default to True for backward compatibility
-                    final_code = code_template if insert_code else "STATIC_DATA_NO_CODE"  # Use placeholder that won't match patterns
-                    
-                    # Set the key demographic fields
-                    static_event["subject_id"] = subject_id
-                    static_event["time"] = None  # Static data has null timestamp
-                    static_event["code"] = final_code
-                    static_event["numeric_value"] = None
-                    static_event["text_value"] = final_default_value
-                    
-                    # Fill in all other columns from the original events with None
-                    for col in events.columns:
-                        if col not in static_event:
-                            static_event[col] = None
-                    static_events.append(static_event)
+                static_events = static_events.clear()
+        subject_key = pl.col("subject_id").cast(key_dtype).alias("key")
+        static_events = static_events.select(subject_key, pl.exclude("subject_id"))
+        unique_subjects = unique_subjects.with_columns(subject_key)
+        
+        # Subjects found in the static data, and the others with default values for each configured column
+        found = unique_subjects.join(static_events, on="key", how="inner", nulls_equal=True, maintain_order="left")
+        missing = unique_subjects.join(static_events, on="key", how="anti", nulls_equal=True, maintain_order="left").with_columns(
+            pl.lit(_optional_str(self._static_text(None, col_config)), dtype=pl.String).alias(f"text_{index}")
+            for index, col_config in enumerate(self.columns)
+        )
+        subjects_found, subjects_missing = len(found), len(missing)
         
         # Print summary statistics instead of individual warnings
         total_subjects = len(unique_subjects)
         match_percentage = (subjects_found / total_subjects) * 100 if total_subjects > 0 else 0
         print(f"Static data matching: {subjects_found}/{total_subjects} subjects found ({match_percentage:.1f}%), {subjects_missing} using default values")
         
-        if not static_events:
+        # One event per subject and configured column, each subject's events in column order
+        subject_texts = pl.concat([found, missing], how="vertical")
+        static_events = pl.concat([
+            subject_texts.select(
+                "subject_id",
+                # Use a placeholder that won't match patterns if the code should not be inserted
+                pl.lit(col_config["code_template"] if col_config.get("insert_code", True) else "STATIC_DATA_NO_CODE").alias("code"),
+                pl.col(f"text_{index}").alias("text_value"),
+            )
+            for index, col_config in enumerate(self.columns)
+        ]) if self.columns else pl.DataFrame()
+        
+        if static_events.is_empty():
             print("No static events to insert")
             return events
         
-        # Convert static events to DataFrame with proper schema matching
-        if static_events:
-            static_df = pl.DataFrame(static_events)
-            
-            # Ensure columns are in the same order as the original events DataFrame
-            static_df = static_df.select(events.columns)
-            
-            # Ensure schema compatibility by casting columns to match original events
-            for col in events.columns:
-                original_dtype = events.select(col).dtypes[0]
-                static_df = static_df.with_columns(pl.col(col).cast(original_dtype))
-            
-            # Combine with original events
-            combined_events = pl.concat([static_df, events], how="vertical")
-        else:
-            combined_events = events
+        order = np.arange(len(static_events)).reshape(len(self.columns), len(subject_texts)).T.reshape(-1)
+        static_events = align_to_schema(static_events[order], events.schema)
         
-        # Sort by subject_id and time (null values will sort first)
-        combined_events = combined_events.sort(["subject_id", "time"])
+        # Static data has null timestamps, so it goes ahead of each subject's timeline
+        combined_events = insert_static_events(events, static_events, events_sorted)
         
         print(f"Inserted {len(static_events)} static data events")
         
         return combined_events
 
 
+def _optional_str(value: Any) -> Optional[str]:
+    """str() of a value, None stays None."""
+    return None if value is None else str(value)
+
+
 if __name__ == "__main__":
     # Test the preprocessor with demographics data
     demographics_preprocessor = LoadStaticDataPreprocessor(
@@ -0,0 +1,162 @@
+from typing import List, Optional
+import re
+import numpy as np
+import polars as pl
+
+MATCHING_TYPES = ["starts_with", "ends_with", "contains", "equals", "regex"]
+
+# Matching types whose value is a literal substring of the code, found with one Aho-Corasick pass
+LITERAL_TYPES = ("starts_with", "ends_with", "contains")
+
+class CodeMatcher:
+    """
+    A code pattern compiled once: the matching type is resolved and a regex is compiled when the
+    matcher is built, not on every call. None or empty codes never match, unknown matching types
+    match nothing.
+
+    Args:
+        matching_type (str): the type of matching to perform
+        matching_value (str): the value to match against
+    """
+    def __init__(self, matching_type: str, matching_value: str):
+        self.matching_type = matching_type
+        self.matching_value = matching_value
+        self.regex: Optional[re.Pattern] = re.compile(matching_value) if matching_type == "regex" else None
+
+    def match(self, code: str) -> bool:
+        """
+        Check if a code matches the pattern
+
+        Args:
+            code (str): the code to check
+
+        Returns:
+            bool: True if the code matches the pattern, False otherwise
+        """
+        if code is None or code == "":
+            return False
+
+        if self.matching_type == "starts_with":
+            return code.startswith(self.matching_value)
+        elif self.matching_type == "ends_with":
+            return code.endswith(self.matching_value)
+        elif self.matching_type == "contains":
+            return self.matching_value in code
+        elif self.matching_type == "equals":
+            return code == self.matching_value
+        elif self.matching_type == "regex":
+            return bool(self.regex.search(code))
+        return False
+
+    def mask(self, codes: pl.Series) -> pl.Series:
+        """
+        Column version of match, literal patterns run natively over the column and regexes once per distinct code
+
+        Args:
+            codes (pl.Series): the codes to check
+
+        Returns:
+            pl.Series: a Boolean series, True where the code matches the pattern
+        """
+        codes = codes.cast(pl.String)
+        if self.matching_type == "starts_with":
+            matches = codes.str.starts_with(self.matching_value)
+        elif self.matching_type == "ends_with":
+            matches = codes.str.ends_with(self.matching_value)
+        elif self.matching_type == "contains":
+            matches = codes.str.contains(self.matching_value, literal=True)
+        elif self.matching_type == "equals":
+            matches = codes == self.matching_value
+        elif self.matching_type == "regex":
+            # Python's re syntax differs from the Rust regex engine, so search each distinct code once
+            unique_codes = codes.drop_nulls().unique()
+            matches = codes.is_in(unique_codes.filter(pl.Series([bool(self.regex.search(code)) for code in unique_codes], dtype=pl.Boolean)))
+        else:
+            matches = pl.repeat(False, len(codes), dtype=pl.Boolean, eager=True)
+
+        # None or empty codes never match
+        return (matches & (codes != "")).fill_null(False)
+
+class MatcherSet:
+    """
+    Several code matchers evaluated together over the distinct codes of a column. Every literal pattern
+    (starts_with, ends_with, contains) is found in one Aho-Corasick pass that reports where each pattern
+    occurs, equals is one comparison per pattern and regexes are searched once per distinct code.
+    The masks of the distinct codes are mapped back onto the column with a single join.
+
+    Args:
+        matchers (List[CodeMatcher]): the matchers, e.g. the matcher of each preprocessor
+    """
+    def __init__(self, matchers: List[CodeMatcher]):
+        self.matchers = matchers
+        self.literals = list(dict.fromkeys(
+            matcher.matching_value for matcher in matchers if matcher.matching_type in LITERAL_TYPES and matcher.matching_value != ""
+        ))
+
+    def unique_masks(self, unique_codes: pl.Series) -> List[np.ndarray]:
+        """
+        Evaluate every matcher on distinct codes.
+
+        Args:
+            unique_codes (pl.Series): distinct, non-null codes
+
+        Returns:
+            List[np.ndarray]: for each matcher, a boolean array over the codes
+        """
+        masks = [np.zeros(len(unique_codes), dtype=bool) for _ in self.matchers]
+
+        occurrences = None
+        if self.literals and len(unique_codes):
+            # every occurrence of every literal, with its start in bytes
+            occurrences = (
+                pl.DataFrame({
+                    "row": np.arange(len(unique_codes)),
+                    "pattern": unique_codes.str.extract_many(self.literals, overlapping=True),
+                    "start": unique_codes.str.find_many(self.literals, overlapping=True),
+                    "length": unique_codes.str.len_bytes(),
+                })
+                .explode(["pattern", "start"])
+                .drop_nulls("pattern")
+            )
+
+        for mask, matcher in zip(masks, self.matchers):
+            value = matcher.matching_value
+            if matcher.matching_type in LITERAL_TYPES:
+                if value == "":
+                    mask[:] = True
+                    continue
+                if occurrences is None:
+                    continue
+                hits = occurrences.filter(pl.col("pattern") == value)
+                if matcher.matching_type == "starts_with":
+                    hits = hits.filter(pl.col("start") == 0)
+                elif matcher.matching_type == "ends_with":
+                    hits = hits.filter(pl.col("start") + len(value.encode()) == pl.col("length"))
+                mask[hits["row"].to_numpy()] = True
+            elif matcher.matching_type == "equals":
+                mask[:] = (unique_codes == value).to_numpy()
+            elif matcher.matching_type == "regex":
+                mask[:] = [bool(matcher.regex.search(code)) for code in unique_codes]
+
+        # empty codes never match
+        empty = (unique_codes == "").to_numpy()
+        for mask in masks:
+            mask[empty] = False
+        return masks
+
+    def masks(self, codes: pl.Series) -> List[pl.Series]:
+        """
+        Evaluate every matcher on a column of codes, the same as each matcher's mask.
+
+        Args:
+            codes (pl.Series): the codes to check
+
+        Returns:
+            List[pl.Series]: for each matcher, a Boolean series, True where the code matches
+        """
+        codes = codes.cast(pl.String)
+        unique_codes = codes.drop_nulls().unique()
+        names = [f"match_{index}" for index in range(len(self.matchers))]
+        table = pl.DataFrame({"code": unique_codes, **dict(zip(names, self.unique_masks(unique_codes)))})
+        matched = codes.to_frame("code").join(table, on="code", how="left", maintain_order="left")
+        return [matched[name].fill_null(False) for name in names]
@@ -0,0 +1,192 @@
+from typing import List, Optional, Tuple
+import polars as pl
+from .base import BasePreprocessor, CodePreprocessor, ValuePreprocessor
+from .age import AgePreprocessor, BIRTH_CODE
+from .demographic_aggregation import DemographicAggregationPreprocessor
+from .ethos_quantile_age import EthosQuantileAgePreprocessor
+from .filter import FilterPreprocessor, FusedFilterPreprocessor
+from .load_static_data import LoadStaticDataPreprocessor
+from .top_k_filter import TopKCodePreprocessor
+
+# Preprocessors that only drop events, by a predicate on the code
+ROW_FILTERS = (FilterPreprocessor, TopKCodePreprocessor, FusedFilterPreprocessor)
+
+def plan_preprocessors(preprocessors: List[BasePreprocessor], event_files: Optional[List[str]] = None, verbose: bool = True) -> List[BasePreprocessor]:
+    """
+    Optimise a chain of fitted preprocessors without changing the events it produces:
+    1. filters that filter nothing are dropped
+    2. age preprocessors after one that removed every MEDS_BIRTH event are dropped, they have no birth to work from
+    3. row filters are moved ahead of the steps they commute with: value preprocessors, which encode each row
+       on its own, and demographic aggregations whose measurements and inserted codes the filter cannot drop
+    4. adjacent row filters are fused into one predicate, repeated filters are applied once
+
+    The preprocessors must already be fitted, fitting reads the event files in the configured order.
+
+    Args:
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors, in the configured order
+        event_files (Optional[List[str]]): event files used to estimate the number of events after each step
+        verbose (bool): whether to print the optimised plan
+
+    Returns:
+        List[BasePreprocessor]: the optimised chain
+    """
+    plan = [preprocessor for preprocessor in preprocessors if not (isinstance(preprocessor, FilterPreprocessor) and preprocessor._predicate() is None)]
+    plan = _drop_redundant_ages(plan)
+
+    # move each row filter ahead of the steps it commutes with, keeping the order of the filters
+    for index in range(len(plan)):
+        while index > 0 and isinstance(plan[index], ROW_FILTERS) and _commutes(plan[index], plan[index - 1]):
+            plan[index - 1], plan[index] = plan[index], plan[index - 1]
+            index -= 1
+
+    plan = _fuse_filters(plan)
+
+    if verbose:
+        print_plan(plan, len(preprocessors), event_files)
+    return plan
+
+def _drop_redundant_ages(plan: List[BasePreprocessor]) -> List[BasePreprocessor]:
+    """Drop the age preprocessors that follow one that removed every MEDS_BIRTH (and null code) event."""
+    result = []
+    births_removed = False
+    for preprocessor in plan:
+        if births_removed and isinstance(preprocessor, (AgePreprocessor, EthosQuantileAgePreprocessor)):
+            # without a birth there is no age, and the MEDS_BIRTH filter has nothing left to remove
+            continue
+        result.append(preprocessor)
+
+        if isinstance(preprocessor, AgePreprocessor) and not preprocessor.keep_meds_birth:
+            births_removed = True
+        elif births_removed and not _cannot_insert_code(preprocessor, BIRTH_CODE):
+            births_removed = False
+    return result
+
+def _cannot_insert_code(preprocessor: BasePreprocessor, code: str) -> bool:
+    """Whether the preprocessor can never produce events with this code, or with a null code."""
+    if isinstance(preprocessor, ROW_FILTERS + (ValuePreprocessor,)):
+        return True
+    if isinstance(preprocessor, (AgePreprocessor, EthosQuantileAgePreprocessor)):
+        # only called once the births are gone, so these leave the events unchanged
+        return True
+    if isinstance(preprocessor, LoadStaticDataPreprocessor):
+        return all(
+            not column.get("insert_code", True) or (isinstance(column["code_template"], str) and column["code_template"] != code)
+            for column in preprocessor.columns
+        )
+    if isinstance(preprocessor, DemographicAggregationPreprocessor):
+        return all(preprocessor._inserted_code(measurement) != code for measurement in preprocessor.measurements)
+    return False
+
+def _commutes(row_filter: BasePreprocessor, preprocessor: BasePreprocessor) -> bool:
+    """Whether applying the row filter before the preprocessor gives the same events as after it."""
+    if isinstance(preprocessor, ValuePreprocessor):
+        # value preprocessors encode each event on its own and never change its code
+        return True
+    if isinstance(preprocessor, DemographicAggregationPreprocessor):
+        dropped = _dropped_codes(row_filter)
+        if dropped is None:
+            return False
+        # the filter must not drop any aggregated measurement, nor any inserted demographic event
+        for measurement in preprocessor.measurements:
+            pattern = measurement["token_pattern"]
+            for match_type, value in dropped:
+                if (value.startswith(pattern) or pattern.startswith(value)) if match_type == "starts_with" else value.startswith(pattern):
+                    return False
+        inserted_codes = pl.DataFrame({"code": [preprocessor._inserted_code(measurement) for measurement in preprocessor.measurements]}, schema={"code": pl.String})
+        return len(inserted_codes.filter(row_filter._predicate())) == len(inserted_codes)
+    return False
+
+def _dropped_codes(row_filter: BasePreprocessor) -> Optional[List[Tuple[str, str]]]:
+    """
+    The codes a row filter may drop besides null codes, as ("starts_with", prefix) and ("equals", code)
+    pairs, or None if they cannot be described that way.
+    """
+    if isinstance(row_filter, TopKCodePreprocessor):
+        return [("starts_with", row_filter.matching_value)]
+    if isinstance(row_filter, FilterPreprocessor):
+        if row_filter.invert or row_filter.matching_type not in ("starts_with", "equals"):
+            return None
+        return [(row_filter.matching_type, row_filter.matching_value)]
+    if isinstance(row_filter, FusedFilterPreprocessor):
+        dropped = [_dropped_codes(component) for component in row_filter.filters]
+        return None if any(codes is None for codes in dropped) else [pair for codes in dropped for pair in codes]
+    return None
+
+def _filter_key(row_filter: BasePreprocessor) -> tuple:
+    """A key that is equal for filters that keep the same events."""
+    if isinstance(row_filter, TopKCodePreprocessor):
+        return ("top_k_filter", row_filter.matching_value, frozenset(row_filter.top_codes))
+    return ("filter", row_filter.matching_type, row_filter.matching_value, bool(row_filter.invert))
+
+def _fuse_filters(plan: List[BasePreprocessor]) -> List[BasePreprocessor]:
+    """Fuse runs of adjacent row filters into one FusedFilterPreprocessor, without repeated filters."""
+    result = []
+    run = []
+    for preprocessor in plan + [None]:
+        if isinstance(preprocessor, ROW_FILTERS):
+            run.extend(preprocessor.filters if isinstance(preprocessor, FusedFilterPreprocessor) else [preprocessor])
+            continue
+
+        if run:
+            unique_filters = {}
+            for row_filter in run:
+                unique_filters.setdefault(_filter_key(row_filter), row_filter)
+            unique_filters = list(unique_filters.values())
+            result.append(unique_filters[0] if len(unique_filters) == 1 else FusedFilterPreprocessor(unique_filters))
+            run = []
+        if preprocessor is not None:
+            result.append(preprocessor)
+    return result
+
+def describe_preprocessor(preprocessor: BasePreprocessor) -> str:
+    """A one line description of a preprocessor for the printed plan."""
+    if isinstance(preprocessor, FusedFilterPreprocessor):
+        return " & ".join(describe_preprocessor(row_filter) for row_filter in preprocessor.filters)
+    if isinstance(preprocessor, TopKCodePreprocessor):
+        return f"top_k_filter({preprocessor.matching_value!r}, k={preprocessor.k})"
+    if isinstance(preprocessor, FilterPreprocessor):
+        return f"filter({preprocessor.matching_type} {preprocessor.matching_value!r}{', keep' if preprocessor.invert else ''})"
+    if getattr(preprocessor, "matching_value", ""):
+        return f"{type(preprocessor).__name__}({preprocessor.matching_type} {preprocessor.matching_value!r})"
+    return type(preprocessor).__name__
+
+def estimate_event_counts(plan: List[BasePreprocessor], event_files: List[str]) -> List[int]:
+    """
+    Estimate the number of events before and after each step. The total comes from the parquet metadata, the fraction
+    each step keeps is measured on the codes of the first file. Steps that insert events are counted as
+    keeping the number of events.
+
+    Args:
+        plan (List[BasePreprocessor]): the fitted preprocessors
+        event_files (List[str]): the event files
+
+    Returns:
+        List[int]: the estimated number of input events, then the number after each step
+    """
+    total = pl.scan_parquet(event_files).select(pl.len()).collect().item()
+    codes = pl.read_parquet(event_files[0], columns=["code"])
+    sample_size = len(codes)
+
+    counts = [total]
+    for preprocessor in plan:
+        if isinstance(preprocessor, ROW_FILTERS):
+            codes = codes.filter(preprocessor._predicate())
+        elif isinstance(preprocessor, CodePreprocessor):
+            codes = codes.with_columns(preprocessor._transform_expression())
+        counts.append(round(total * len(codes) / sample_size) if sample_size else 0)
+    return counts
+
+def print_plan(plan: List[BasePreprocessor], configured_steps: int, event_files: Optional[List[str]] = None) -> None:
+    """
+    Print the optimised preprocessing plan, with the estimated number of events after each step.
+
+    Args:
+        plan (List[BasePreprocessor]): the optimised preprocessors
+        configured_steps (int): the number of configured preprocessors
+        event_files (Optional[List[str]]): event files to estimate the number of events on
+    """
+    counts = estimate_event_counts(plan, event_files) if event_files else [None] * (len(plan) + 1)
+    print(f"Preprocessing plan: {len(plan)} steps (configured {configured_steps})" + ("" if counts[0] is None else f", ~{counts[0]:,} input events"))
+    for step, (preprocessor, count) in enumerate(zip(plan, counts[1:]), start=1):
+        estimate = "" if count is None else f"  ~{count:,} events"
+        print(f"  {step}. {describe_preprocessor(preprocessor)}{estimate}")
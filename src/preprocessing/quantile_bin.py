@@ -1,4 +1,5 @@
 import numpy as np
+import polars as pl
 from typing import List
 from .base import ValuePreprocessor
 
@@ -11,10 +12,14 @@ class QuantileBinPreprocessor(ValuePreprocessor):
         matching_value (str): the value to match.
         k (int): the number of bins to create.
         value_column (str): the column containing the numeric values to bin.
+        fit_mode (str): "exact" computes the edges from every training value, "sketch" from a bounded-memory KLL sketch per code.
+        sketch_k (int): the sketch size in sketch mode, the rank error of the edges is about 1 / sketch_k.
     """
-    def __init__(self, matching_type: str, matching_value: str, k: int, value_column: str):
+    has_column_encoding = True
+
+    def __init__(self, matching_type: str, matching_value: str, k: int, value_column: str, fit_mode: str = "exact", sketch_k: int = 200):
         # Initialize base class
-        super().__init__(matching_type, matching_value, value_column)
+        super().__init__(matching_type, matching_value, value_column, fit_mode, sketch_k)
         
         assert k > 1, "k must be greater than 1"
 
@@ -33,10 +38,9 @@ class QuantileBinPreprocessor(ValuePreprocessor):
         
         print(f"\n--- DEBUG: Fitting QuantileBinPreprocessor for '{self.matching_value}' ---")
         
-        for code, values in self.data.items():
-            values = np.asarray(values)
+        for code in self.data:
             probs = np.linspace(0, 1, self.k + 1) # e.g. [0 , 0.25, 0.5, 0.75, 1]
-            edges = np.quantile(values, probs) # float edges, monotonic
+            edges = self._quantile(code, probs) # float edges, monotonic
             self.fits[code] = edges
 
             print(f"  - Learned bins for code '{code}': {edges}")
@@ -75,7 +79,47 @@ class QuantileBinPreprocessor(ValuePreprocessor):
                 return bin_label
         else:
             raise ValueError(f"_encode() called with code {code} that does not match the matching criteria.")
-    
+
+    def _encode_values(self, codes: pl.Series, values: pl.Series) -> pl.Series:
+        """
+        Column version of _encode. The inner bin edges of each code are joined onto the values
+        and the bin index is the number of edges the value is greater than or equal to, as in np.digitize.
+
+        Args:
+            codes (pl.Series): the codes
+            values (pl.Series): the Float64 values to encode
+
+        Returns:
+            pl.Series: the bin labels, null for codes without fitted bins
+        """
+        if self.fits is None:
+            raise ValueError("Preprocessor must be fitted before encoding. Call fit() first.")
+
+        # Edges that are not sorted or contain NaN (e.g. from infinite values) are left to np.digitize
+        inner_edges = {code: np.asarray(edges, dtype=np.float64)[1:-1] for code, edges in self.fits.items()}
+        sorted_codes = [code for code, edges in inner_edges.items() if np.all(np.diff(edges) >= 0) and not np.isnan(edges).any()]
+        num_edges = self.k - 1
+        edge_table = pl.DataFrame(
+            {"code": sorted_codes, **{f"edge_{i}": [inner_edges[code][i] for code in sorted_codes] for i in range(num_edges)}},
+            schema={"code": pl.String, **{f"edge_{i}": pl.Float64 for i in range(num_edges)}},
+        ).with_columns(pl.lit(True).alias("fitted"))
+
+        bin_index = pl.sum_horizontal([(pl.col("value") >= pl.col(f"edge_{i}")).cast(pl.UInt32) for i in range(num_edges)])
+        labels = (
+            pl.DataFrame({"code": codes, "value": values})
+            .join(edge_table, on="code", how="left", maintain_order="left")
+            .select(pl.when(pl.col("fitted")).then(pl.lit("Q") + bin_index.cast(pl.String)).alias(values.name))
+            .to_series()
+        )
+
+        unsorted_positions = codes.is_in(list(set(inner_edges) - set(sorted_codes))).arg_true()
+        if unsorted_positions.len() > 0:
+            labels = labels.scatter(unsorted_positions, pl.Series(
+                [self._encode(code, value) for code, value in zip(codes.gather(unsorted_positions), values.gather(unsorted_positions))],
+                dtype=pl.String,
+            ))
+        return labels
+
 if __name__ == "__main__":
     # Test the preprocessor
     train_values = np.random.randint(0, 100, 10)
@@ -1,4 +1,5 @@
 import numpy as np
+import polars as pl
 from typing import List
 from .base import ValuePreprocessor
 
@@ -13,10 +14,14 @@ class QuantileBin3LevelPreprocessor(ValuePreprocessor):
         matching_type (str): the type of matching to use. Must be one of "starts_with", "ends_with", "contains", "equals", "regex"
         matching_value (str): the value to match.
         value_column (str): the column containing the numeric values to bin.
+        fit_mode (str): "exact" computes the quantiles from every training value, "sketch" from a bounded-memory KLL sketch per code.
+        sketch_k (int): the sketch size in sketch mode, the rank error of the quantiles is about 1 / sketch_k.
     """
-    def __init__(self, matching_type: str, matching_value: str, value_column: str):
+    has_column_encoding = True
+
+    def __init__(self, matching_type: str, matching_value: str, value_column: str, fit_mode: str = "exact", sketch_k: int = 200):
         # Initialize base class
-        super().__init__(matching_type, matching_value, value_column)
+        super().__init__(matching_type, matching_value, value_column, fit_mode, sketch_k)
         
         print(f"QuantileBin3LevelPreprocessor initialized: matching_type='{matching_type}', matching_value='{matching_value}', value_column='{value_column}'")
 
@@ -31,11 +36,8 @@ class QuantileBin3LevelPreprocessor(ValuePreprocessor):
         
         print(f"\n--- DEBUG: Fitting QuantileBin3LevelPreprocessor for '{self.matching_value}' ---")
         
-        for code, values in self.data.items():
-            values = np.asarray(values)
-            q1 = np.quantile(values, 0.25)
-            q2 = np.quantile(values, 0.50)  # median
-            q3 = np.quantile(values, 0.75)
+        for code in self.data:
+            q1, q2, q3 = self._quantile(code, [0.25, 0.50, 0.75])  # q2 is the median
             self.fits[code] = {'q1': q1, 'q2': q2, 'q3': q3}
 
             print(f"  - Learned quantiles for code '{code}': Q1={q1:.4f}, Q2={q2:.4f}, Q3={q3:.4f}")
@@ -74,7 +76,47 @@ class QuantileBin3LevelPreprocessor(ValuePreprocessor):
                 return bin_label
         else:
             raise ValueError(f"_encode() called with code {code} that does not match the matching criteria.")
-    
+
+    def _encode_values(self, codes: pl.Series, values: pl.Series) -> pl.Series:
+        """
+        Column version of _encode, the quartiles of each code are joined onto the values.
+
+        Args:
+            codes (pl.Series): the codes
+            values (pl.Series): the Float64 values to encode
+
+        Returns:
+            pl.Series: the bin labels, null for codes without fitted quantiles
+        """
+        if self.fits is None:
+            raise ValueError("Preprocessor must be fitted before encoding. Call fit() first.")
+
+        quantile_table = pl.DataFrame(
+            {
+                "code": list(self.fits),
+                "q1": [float(quantiles['q1']) for quantiles in self.fits.values()],
+                "q3": [float(quantiles['q3']) for quantiles in self.fits.values()],
+            },
+            schema={"code": pl.String, "q1": pl.Float64, "q3": pl.Float64},
+        ).with_columns(pl.lit(True).alias("fitted"))
+
+        # Polars orders NaN above every number, comparisons with NaN are False in Python
+        value = pl.col("value")
+        comparable_q1 = value.is_not_nan() & pl.col("q1").is_not_nan()
+        comparable_q3 = value.is_not_nan() & pl.col("q3").is_not_nan()
+        return (
+            pl.DataFrame({"code": codes, "value": values})
+            .join(quantile_table, on="code", how="left", maintain_order="left")
+            .select(
+                pl.when(pl.col("fitted").is_null()).then(None)
+                .when(comparable_q1 & (value < pl.col("q1"))).then(pl.lit("low"))
+                .when(comparable_q3 & (value <= pl.col("q3"))).then(pl.lit("normal"))
+                .otherwise(pl.lit("high"))
+                .alias(values.name)
+            )
+            .to_series()
+        )
+
 if __name__ == "__main__":
     # Test the preprocessor
     import numpy as np
@@ -1,4 +1,6 @@
+import polars as pl
 from .base import ValuePreprocessor
+from .values import map_unique_floats
 
 class RoundNumericPreprocessor(ValuePreprocessor):
     """
@@ -11,6 +13,8 @@ class RoundNumericPreprocessor(ValuePreprocessor):
         value_column (str): the column containing the numeric values.
         decimals (int): number of decimal places to round to. Default is 1.
     """
+    has_column_encoding = True
+
     def __init__(self, matching_type: str, matching_value: str, value_column: str, decimals: int = 1):
         super().__init__(matching_type, matching_value, value_column)
         self.decimals = decimals
@@ -25,4 +29,10 @@ class RoundNumericPreprocessor(ValuePreprocessor):
         """
         Round the value to the specified number of decimal places.
         """
-        return f"{value:.{self.decimals}f}"
\ No newline at end of file
+        return f"{value:.{self.decimals}f}"
+
+    def _encode_values(self, codes: pl.Series, values: pl.Series) -> pl.Series:
+        """
+        Column version of _encode, each distinct value is formatted once.
+        """
+        return map_unique_floats(values, lambda value: f"{value:.{self.decimals}f}")
@@ -0,0 +1,220 @@
+from typing import Iterable, List, Optional
+import argparse
+import glob
+import os
+import numpy as np
+
+class KLLSketch:
+    """
+    A mergeable KLL quantile sketch over float values, used to fit quantile preprocessors
+    with bounded memory. Items are kept in compactors, an item in compactor h stands for 2**h
+    values. When the sketch is full the lowest full compactor is sorted and every other item
+    is promoted to the next level, so the sketch holds roughly 3 * k items whatever the number
+    of values. The rank error of a quantile is about 1 / k.
+
+    Sketches that never compacted hold every value and return the same quantiles as np.quantile.
+    Compaction offsets are derived from the seed and a compaction counter, so the same updates
+    and merges in the same order give the same sketch.
+
+    Args:
+        k (int): the size of the top compactor, larger is more accurate
+        seed (int): the seed of the compaction offsets
+    """
+    def __init__(self, k: int = 200, seed: int = 0):
+        if k < 2:
+            raise ValueError(f"Sketch size k must be at least 2, got {k}")
+        self.k = k
+        self.seed = seed
+        self.compactors: List[np.ndarray] = [np.empty(0, dtype=np.float64)]
+        self.count = 0
+        self.nan_count = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.compactions = 0
+
+    @classmethod
+    def from_values(cls, values: Iterable[float], k: int = 200, seed: int = 0) -> "KLLSketch":
+        """
+        Build a sketch from a set of values.
+
+        Args:
+            values (Iterable[float]): the values to add
+            k (int): the size of the top compactor
+            seed (int): the seed of the compaction offsets
+
+        Returns:
+            KLLSketch: the sketch of the values
+        """
+        sketch = cls(k, seed)
+        sketch.update(values)
+        return sketch
+
+    def __len__(self) -> int:
+        return self.count
+
+    def update(self, values: Iterable[float]) -> None:
+        """
+        Add values to the sketch. NaN values are counted but not stored, any NaN makes every
+        quantile NaN as it does for np.quantile.
+
+        Args:
+            values (Iterable[float]): the values to add
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        nans = np.isnan(values)
+        if nans.any():
+            self.nan_count += int(nans.sum())
+            values = values[~nans]
+        if values.size == 0:
+            return
+
+        self.count += int(values.size)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+
+    def merge(self, other: "KLLSketch") -> None:
+        """
+        Merge another sketch into this one, level by level.
+
+        Args:
+            other (KLLSketch): the sketch to merge, built with the same k
+        """
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with different sizes ({self.k} and {other.k})")
+
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+
+        self.count += other.count
+        self.nan_count += other.nan_count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compactions += other.compactions
+        self._compress()
+
+    def quantile(self, probs) -> np.ndarray:
+        """
+        Estimate quantiles of the values added so far, interpolating linearly between the
+        ranks of the stored items as np.quantile does between the sorted values.
+
+        Args:
+            probs: the probabilities of the quantiles, between 0 and 1
+
+        Returns:
+            np.ndarray: the estimated quantiles
+        """
+        probs = np.asarray(probs, dtype=np.float64)
+        if self.count == 0 and self.nan_count == 0:
+            raise ValueError("Cannot compute quantiles of an empty sketch")
+        if self.nan_count:
+            return np.full(probs.shape, np.nan)
+        if len(self.compactors) == 1:
+            return np.quantile(self.compactors[0], probs)
+
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(level_items), 2 ** level, dtype=np.float64) for level, level_items in enumerate(self.compactors)])
+        order = np.argsort(items, kind="stable")
+        items, weights = items[order], weights[order]
+
+        # the rank of an item is the middle of the ranks of the values it stands for, compaction
+        # keeps the total weight equal to the count so ranks run from 0 to count - 1
+        ranks = np.cumsum(weights) - weights + (weights - 1) / 2
+        if ranks[0] > 0:
+            ranks, items = np.concatenate([[0.0], ranks]), np.concatenate([[self.min], items])
+        if ranks[-1] < self.count - 1:
+            ranks, items = np.concatenate([ranks, [self.count - 1]]), np.concatenate([items, [self.max]])
+        return np.interp(probs * (self.count - 1), ranks, items)
+
+    def _capacity(self, level: int) -> int:
+        """The number of items compactor level can hold, the top compactor holds k."""
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self) -> None:
+        """Compact the lowest full compactor until every compactor is within its capacity."""
+        while True:
+            full_levels = [level for level, items in enumerate(self.compactors) if len(items) > self._capacity(level)]
+            if not full_levels:
+                return
+            level = full_levels[0]
+            if level + 1 == len(self.compactors):
+                self.compactors.append(np.empty(0, dtype=np.float64))
+
+            items = np.sort(self.compactors[level])
+            # an odd item out stays at this level
+            keep = items[-1:] if len(items) % 2 else items[:0]
+            items = items[:len(items) - len(keep)]
+
+            offset = int(np.random.default_rng([self.seed, self.compactions]).integers(2))
+            self.compactions += 1
+            self.compactors[level + 1] = np.concatenate([self.compactors[level + 1], items[offset::2]])
+            self.compactors[level] = keep
+
+def edge_deviation_report(preprocessor, event_files: List[str], probs, sketch_k: int = 200, code_preprocessors: Optional[list] = None) -> List[dict]:
+    """
+    Compare the quantiles a sketch fit gives with the exact quantiles on a sample of event files.
+
+    Args:
+        preprocessor (ValuePreprocessor): the preprocessor whose matching and value column are used
+        event_files (List[str]): the sample of event files
+        probs: the probabilities of the quantiles to compare, e.g. the bin edges
+        sketch_k (int): the sketch size to evaluate
+        code_preprocessors (Optional[list]): fitted code preprocessors applied before collecting values
+
+    Returns:
+        List[dict]: per code, the number of values, the largest absolute edge deviation and the largest rank error
+    """
+    from .utils import collect_values
+
+    values = {}
+    for event_file in event_files:
+        for code, code_values in collect_values(event_file, code_preprocessors or [], [preprocessor])[0].items():
+            values.setdefault(code, []).append(code_values)
+
+    probs = np.asarray(probs, dtype=np.float64)
+    report = []
+    for code, parts in values.items():
+        exact_values = np.sort(np.concatenate(parts))
+        sketch = KLLSketch(sketch_k)
+        for part in parts:
+            sketch.merge(KLLSketch.from_values(part, sketch_k))
+
+        exact_edges = np.quantile(exact_values, probs)
+        sketch_edges = sketch.quantile(probs)
+        # a value covers the ranks from the first to the last of its copies in the sorted values
+        lowest_ranks = np.searchsorted(exact_values, sketch_edges, side="left") / len(exact_values)
+        highest_ranks = np.searchsorted(exact_values, sketch_edges, side="right") / len(exact_values)
+        rank_errors = np.maximum(np.maximum(lowest_ranks - probs, probs - highest_ranks), 0)
+        report.append({
+            "code": code,
+            "count": len(exact_values),
+            "max_edge_deviation": float(np.max(np.abs(sketch_edges - exact_edges))),
+            "max_rank_error": float(np.max(rank_errors)),
+        })
+    return report
+
+if __name__ == "__main__":
+    from .quantile_bin import QuantileBinPreprocessor
+
+    parser = argparse.ArgumentParser(description="Report how far sketch fitted quantile bin edges are from exact ones on a sample of event files")
+    parser.add_argument("--data_directory", type=str, required=True, help="directory of parquet event files to sample")
+    parser.add_argument("--matching_type", type=str, required=True)
+    parser.add_argument("--matching_value", type=str, required=True)
+    parser.add_argument("--value_column", type=str, default="numeric_value")
+    parser.add_argument("--k", type=int, default=10, help="number of quantile bins")
+    parser.add_argument("--sketch_k", type=int, default=200, help="sketch size to evaluate")
+    parser.add_argument("--max_files", type=int, default=4, help="number of event files in the sample")
+    args = parser.parse_args()
+
+    event_files = sorted(glob.glob(os.path.join(args.data_directory, "*.parquet")))[:args.max_files]
+    preprocessor = QuantileBinPreprocessor(args.matching_type, args.matching_value, args.k, args.value_column)
+    report = edge_deviation_report(preprocessor, event_files, np.linspace(0, 1, args.k + 1), args.sketch_k)
+
+    for row in sorted(report, key=lambda row: -row["max_rank_error"]):
+        print(f"{row['code']}: {row['count']} values, max edge deviation {row['max_edge_deviation']:.6g}, max rank error {row['max_rank_error']:.4f}")
+    if report:
+        print(f"Overall: max edge deviation {max(row['max_edge_deviation'] for row in report):.6g}, max rank error {max(row['max_rank_error'] for row in report):.4f}")
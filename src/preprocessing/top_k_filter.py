@@ -1,7 +1,7 @@
 from .base import BasePreprocessor
+from .fit_scheduler import FitScheduler, ShardConsumer
 from typing import List, Set
 import polars as pl
-from tqdm import tqdm
 
 class TopKCodePreprocessor(BasePreprocessor):
     """
@@ -13,18 +13,32 @@ class TopKCodePreprocessor(BasePreprocessor):
         self.top_codes: Set[str] = set()
 
     def fit(self, event_files: List[str]) -> None:
+        FitScheduler(event_files).register(self.fit_consumer()).run()
+
+    def fit_consumer(self) -> ShardConsumer:
+        # only the code column is read from the shared scan of the files
+        return ShardConsumer(f"Top {self.k} {self.matching_value} codes", self._count_codes, self._select_top_codes, columns=["code"], fits=[self])
+
+    def _count_codes(self, events: pl.DataFrame) -> pl.DataFrame:
+        return events.filter(pl.col("code").str.starts_with(self.matching_value)).group_by("code").agg(pl.len().alias("count"))
+
+    def _select_top_codes(self, file_counts: List[pl.DataFrame]) -> None:
         counts = pl.DataFrame()
-        for file in tqdm(event_files, desc="Calculating Top K"):
-            df = pl.read_parquet(file).filter(pl.col("code").str.starts_with(self.matching_value))
-            df_counts = df.group_by("code").agg(pl.len().alias("count"))
+        for df_counts in file_counts:
             counts = pl.concat([counts, df_counts]).group_by("code").agg(pl.col("count").sum())
         
         self.top_codes = set(counts.sort("count", descending=True).limit(self.k)["code"].to_list())
         print(f"Top {self.k} codes for {self.matching_value} identified.")
 
     def encode_polars(self, events: pl.DataFrame) -> pl.DataFrame:
+        return events.filter(self._predicate())
+
+    def encode_lazy(self, events: pl.LazyFrame) -> pl.LazyFrame:
+        return events.filter(self._predicate())
+
+    def _predicate(self) -> pl.Expr:
         # Keep if it doesn't match the prefix OR if it's in the top_codes list
-        return events.filter(
+        return (
             (~pl.col("code").str.starts_with(self.matching_value)) | 
             (pl.col("code").is_in(list(self.top_codes)))
-        )
\ No newline at end of file
+        )
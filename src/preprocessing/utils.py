@@ -1,72 +1,377 @@
-from typing import List
+from typing import Any, Callable, Dict, Iterator, List, Optional
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+import numpy as np
 import polars as pl
 from .base import BasePreprocessor, ValuePreprocessor, CodePreprocessor
+from .matcher import MatcherSet
+from .values import python_float
 
-def fit_preprocessors_jointly(preprocessors: List[BasePreprocessor], event_files: List[str]) -> None:
+# Columns of the preprocessed events read by the tokenizers
+EVENT_COLUMNS = ["subject_id", "time", "code", "numeric_value", "text_value", "unit"]
+
+# Debug check that every preprocessor the pipeline expects to keep the events sorted by (subject_id, time)
+# did, set CHECK_SORTED_EVENTS=1 to enable it (worker processes inherit the environment)
+CHECK_SORTED_EVENTS = os.environ.get("CHECK_SORTED_EVENTS", "0") == "1"
+
+def scan_events(event_file: str, preprocessors: List[BasePreprocessor]) -> pl.LazyFrame:
+    """
+    Build one lazy query that reads an event file and applies the preprocessors in order, see preprocess_events.
+
+    Args:
+        event_file (str): the parquet file to read
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors to apply
+
+    Returns:
+        pl.LazyFrame: the preprocessed events
+    """
+    return preprocess_events(pl.scan_parquet(event_file), preprocessors)
+
+def preprocess_events(events: pl.LazyFrame, preprocessors: List[BasePreprocessor]) -> pl.LazyFrame:
+    """
+    Apply the preprocessors in order to a lazy query over events.
+    Expression-based preprocessors are added to the query, so Polars can push filters and
+    column selections down into a parquet scan. Other preprocessors collect the query
+    built so far, see BasePreprocessor.encode_lazy.
+
+    The query tracks whether the events are sorted by (subject_id, time). The input events are checked
+    once, before the first preprocessor that inserts events, and the result is passed on to every
+    inserting preprocessor while the steps in between keep the order. An inserting preprocessor then
+    merges its events into the sorted timelines instead of sorting all the events again.
+
+    Args:
+        events (pl.LazyFrame): the events, e.g. a parquet scan
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors to apply
+
+    Returns:
+        pl.LazyFrame: the preprocessed events
+    """
+    # whether the events are sorted by (subject_id, time), None if unknown
+    events_sorted = None
+    # consecutive value preprocessors share one pass of their code matchers
+    value_run = []
+    for index, preprocessor in enumerate(preprocessors):
+        if _encodes_value_column(preprocessor):
+            value_run.append(preprocessor)
+            if index + 1 < len(preprocessors) and _encodes_value_column(preprocessors[index + 1]):
+                continue
+            events = _encode_value_run(events, value_run)
+            value_run = []
+        elif preprocessor.inserts_events:
+            collected = events.collect()
+            if events_sorted is None:
+                events_sorted = is_sorted_by_subject_time(collected)
+            events = preprocessor.encode_polars(collected, events_sorted=events_sorted).lazy()
+            # unsorted events are sorted by the insertion, unless there was nothing to insert
+            events_sorted = True if events_sorted else None
+        else:
+            events = preprocessor.encode_lazy(events)
+            if not preprocessor.keeps_sorted:
+                events_sorted = None
+
+        if CHECK_SORTED_EVENTS and events_sorted:
+            events = events.collect().lazy()
+            if not is_sorted_by_subject_time(events.collect()):
+                raise RuntimeError(f"{type(preprocessor).__name__} did not keep the events sorted by (subject_id, time)")
+    return events
+
+def _encodes_value_column(preprocessor: BasePreprocessor) -> bool:
+    """Whether the preprocessor encodes its value column a column at a time, with ValuePreprocessor.encode_lazy."""
+    return (
+        isinstance(preprocessor, ValuePreprocessor)
+        and type(preprocessor).encode_lazy is ValuePreprocessor.encode_lazy
+        and preprocessor.has_column_encoding
+    )
+
+def _encode_value_run(events: pl.LazyFrame, preprocessors: List[ValuePreprocessor]) -> pl.LazyFrame:
+    """
+    Add consecutive value preprocessors to a lazy query. Value preprocessors never change the codes,
+    so the code matchers of all of them are evaluated together once per batch (see MatcherSet) and
+    each preprocessor reads its mask from a temporary column.
+
+    Args:
+        events (pl.LazyFrame): the events to encode
+        preprocessors (List[ValuePreprocessor]): the value preprocessors, in order
+
+    Returns:
+        pl.LazyFrame: the events with the encoded value columns
     """
-    Fit multiple preprocessors jointly by reading through the data files only once.
-    Handles ValuePreprocessor, CodePreprocessor, and other BasePreprocessor types.
-    Fits the preprocessors in place and does not return anything.
-    
+    if len(preprocessors) == 1:
+        return preprocessors[0].encode_lazy(events)
+
+    matcher_set = MatcherSet([preprocessor.matcher for preprocessor in preprocessors])
+    mask_columns = [f"__code_match_{index}" for index in range(len(preprocessors))]
+    events = events.with_columns(
+        pl.col("code").map_batches(
+            lambda codes: pl.DataFrame(dict(zip(mask_columns, matcher_set.masks(codes)))).to_struct("masks"),
+            return_dtype=pl.Struct({column: pl.Boolean for column in mask_columns}),
+            is_elementwise=True,
+        ).alias("__code_matches")
+    ).unnest("__code_matches")
+    for preprocessor, mask_column in zip(preprocessors, mask_columns):
+        events = events.with_columns(preprocessor._encode_expression(mask_column))
+    return events.drop(mask_columns)
+
+def load_events(event_file: str, preprocessors: List[BasePreprocessor], columns: Optional[List[str]] = EVENT_COLUMNS) -> pl.DataFrame:
+    """
+    Read an event file and apply the preprocessors as a single query, using the streaming engine.
+
+    Args:
+        event_file (str): the parquet file to read
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors to apply
+        columns (Optional[List[str]]): the columns to keep if present, None keeps every column
+
+    Returns:
+        pl.DataFrame: the preprocessed events
+    """
+    return _select_columns(scan_events(event_file, preprocessors), columns).collect(engine="streaming")
+
+def stream_events(event_file: str, preprocessors: List[BasePreprocessor], row_budget: int, columns: Optional[List[str]] = EVENT_COLUMNS) -> Iterator[pl.DataFrame]:
+    """
+    Read an event file about row_budget rows at a time and apply the preprocessors to each batch, so only one
+    batch is held in memory. Batches end on a subject boundary: the rows of the last subject read are carried
+    over into the next batch, so the preprocessors always see every event of a subject (a subject with more
+    rows than row_budget is read whole). Concatenating the batches gives the events of load_events.
+
+    This relies on the events being sorted by subject_id, as MEDS shards are. Files that are not are read
+    whole, with load_events.
+
+    Args:
+        event_file (str): the parquet file to read
+        preprocessors (List[BasePreprocessor]): the fitted preprocessors to apply
+        row_budget (int): number of rows to read at a time
+        columns (Optional[List[str]]): the columns to keep if present, None keeps every column
+
+    Yields:
+        pl.DataFrame: the preprocessed events of consecutive subjects
+    """
+    if row_budget <= 0:
+        raise ValueError(f"row_budget must be positive, got {row_budget}")
+    scan = pl.scan_parquet(event_file)
+    num_rows = scan.select(pl.len()).collect().item()
+
+    # Check the subjects are sorted reading only their ids, a batch at a time
+    previous = None
+    for offset in range(0, num_rows, row_budget):
+        subject_ids = scan.select("subject_id").slice(offset, row_budget).collect()["subject_id"]
+        if subject_ids.null_count() or not subject_ids.is_sorted() or (previous is not None and subject_ids[0] < previous):
+            print(f"Events in {event_file} are not sorted by subject_id, reading the whole file")
+            yield load_events(event_file, preprocessors, columns)
+            return
+        previous = subject_ids[-1]
+
+    carried = None
+    for offset in range(0, num_rows, row_budget):
+        batch = scan.slice(offset, row_budget).collect()
+        if carried is not None:
+            batch = pl.concat([carried, batch])
+
+        if offset + row_budget < num_rows:
+            # hold back the last subject, its remaining rows are in the next batch
+            end = batch["subject_id"].search_sorted(batch["subject_id"][-1], side="left")
+            batch, carried = batch.slice(0, end), batch.slice(end)
+            if batch.is_empty():
+                continue
+
+        yield _select_columns(preprocess_events(batch.lazy(), preprocessors), columns).collect(engine="streaming")
+
+def _select_columns(events: pl.LazyFrame, columns: Optional[List[str]]) -> pl.LazyFrame:
+    """Keep the columns that are present, in the given order, None keeps every column."""
+    if columns is None:
+        return events
+    schema = events.collect_schema()
+    return events.select([column for column in columns if column in schema])
+
+def align_to_schema(rows: pl.DataFrame, schema: pl.Schema) -> pl.DataFrame:
+    """
+    Give new event rows the columns and dtypes of the events they are added to, missing columns are null.
+
+    Args:
+        rows (pl.DataFrame): the new events
+        schema (pl.Schema): the schema of the events
+
+    Returns:
+        pl.DataFrame: the new events with the given schema
+    """
+    return rows.select([
+        pl.col(name).cast(dtype) if name in rows.columns else pl.lit(None, dtype=dtype).alias(name)
+        for name, dtype in schema.items()
+    ])
+
+def is_sorted_by_subject_time(events: pl.DataFrame) -> bool:
+    """
+    Whether the events are in the order sort(["subject_id", "time"]) gives, nulls first.
+
+    Args:
+        events (pl.DataFrame): the events
+
+    Returns:
+        bool: whether every row is ordered after the previous one
+    """
+    subject, previous_subject = pl.col("subject_id"), pl.col("subject_id").shift(1)
+    time, previous_time = pl.col("time"), pl.col("time").shift(1)
+    same_subject = (subject == previous_subject) | (subject.is_null() & previous_subject.is_null())
+    out_of_order = (
+        (subject.is_null() & previous_subject.is_not_null())
+        | (subject < previous_subject).fill_null(False)
+        | (same_subject & ((time.is_null() & previous_time.is_not_null()) | (time < previous_time).fill_null(False)))
+    )
+    return not events.select((out_of_order & (pl.int_range(pl.len()) > 0)).any()).item()
+
+def insert_static_events(events: pl.DataFrame, static_events: pl.DataFrame, events_sorted: Optional[bool] = None, after_untimed: bool = False) -> pl.DataFrame:
+    """
+    Insert static events (without a time) into their subject's timeline. The result is the same as
+    pl.concat([static_events, events]).sort(["subject_id", "time"], maintain_order=True), or with the
+    static events concatenated after the events if after_untimed. When the events are sorted the two
+    sorted runs are merged: each static event is placed at its subject's first event, or after its
+    subject's events without a time, with one gather instead of a sort.
+
+    Args:
+        events (pl.DataFrame): the events
+        static_events (pl.DataFrame): the static events, with the schema of the events and each subject's
+            static events in order
+        events_sorted (Optional[bool]): whether the events are known to be sorted by (subject_id, time),
+            None checks
+        after_untimed (bool): whether the static events go after the subject's events without a time
+
+    Returns:
+        pl.DataFrame: the events sorted by (subject_id, time) with the static events inserted
+    """
+    if events_sorted is None:
+        events_sorted = is_sorted_by_subject_time(events)
+    if events_sorted and static_events.is_empty():
+        return events
+    if not events_sorted:
+        combined = pl.concat([events, static_events] if after_untimed else [static_events, events], how="vertical")
+        return combined.sort(["subject_id", "time"], maintain_order=True)
+
+    # the rows of each subject, null subjects sort first
+    subjects, null_subjects = events["subject_id"], events["subject_id"].null_count()
+    sorted_subjects = subjects.slice(null_subjects).to_numpy()
+    static_subjects = static_events["subject_id"]
+    has_subject = static_subjects.is_not_null().to_numpy()
+    first_rows = np.zeros(len(static_events), dtype=np.int64)
+    end_rows = np.full(len(static_events), null_subjects, dtype=np.int64)
+    first_rows[has_subject] = null_subjects + np.searchsorted(sorted_subjects, static_subjects.drop_nulls().to_numpy(), side="left")
+    end_rows[has_subject] = null_subjects + np.searchsorted(sorted_subjects, static_subjects.drop_nulls().to_numpy(), side="right")
+
+    positions = first_rows
+    if after_untimed:
+        # events without a time sort first within a subject
+        untimed = np.concatenate([[0], np.cumsum(events["time"].is_null().to_numpy())])
+        positions = first_rows + untimed[end_rows] - untimed[first_rows]
+
+    # a static event goes before the event at its position, after the static events placed before it,
+    # static events of subjects without events are placed at the same position as the next subject's
+    order = (
+        pl.DataFrame({"position": positions, "subject_id": static_subjects})
+        .with_row_index("row")
+        .sort(["position", "subject_id"], maintain_order=True)["row"]
+        .to_numpy()
+        .astype(np.int64)
+    )
+    positions = positions[order]
+    targets = np.concatenate([
+        positions + np.arange(len(positions)),
+        np.arange(len(events)) + np.searchsorted(positions, np.arange(len(events)), side="right"),
+    ])
+    combined = pl.concat([static_events, events], how="vertical")
+    sources = np.empty(len(combined), dtype=np.int64)
+    sources[targets] = np.concatenate([order, len(static_events) + np.arange(len(events))])
+    return combined[sources]
+
+def map_event_files(function: Callable, event_files: List[str], workers: int, desc: str, *args) -> list:
+    """
+    Call function(event_file, *args) for every event file, on a process pool when workers > 1.
+    The function and its arguments must be picklable.
+
+    Args:
+        function (Callable): the module level function to call
+        event_files (List[str]): the event files
+        workers (int): number of worker processes (1 runs serially)
+        desc (str): the progress bar description
+        *args: further arguments passed to every call
+
+    Returns:
+        list: the results, in the order of event_files
+    """
+    if workers <= 1 or len(event_files) <= 1:
+        return [function(event_file, *args) for event_file in tqdm(event_files, desc=desc)]
+
+    # spawn rather than fork, forking a process that has already used polars' thread pool can deadlock
+    with ProcessPoolExecutor(max_workers=min(workers, len(event_files)), mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(tqdm(
+            executor.map(function, event_files, *[[arg] * len(event_files) for arg in args]),
+            total=len(event_files),
+            desc=desc,
+        ))
+
+def collect_values(event_file: str, code_preprocessors: List[CodePreprocessor], value_preprocessors: List[ValuePreprocessor]) -> List[Dict[str, Any]]:
+    """
+    Collect the float values each value preprocessor is fitted on from one event file,
+    after the code preprocessors are applied, see summarise_values.
+
+    Args:
+        event_file (str): the parquet file to read
+        code_preprocessors (List[CodePreprocessor]): the fitted code preprocessors to apply first
+        value_preprocessors (List[ValuePreprocessor]): the value preprocessors to collect values for
+
+    Returns:
+        List[Dict[str, Any]]: for each value preprocessor, the summary (see ValuePreprocessor._summarise) of each matching code
+    """
+    value_columns = [preprocessor.value_column for preprocessor in value_preprocessors]
+    transformed_events = load_events(event_file, code_preprocessors, columns=list(dict.fromkeys(["code", "numeric_value", "text_value", *value_columns])))
+    return summarise_values(transformed_events, value_preprocessors)
+
+def summarise_values(transformed_events: pl.DataFrame, value_preprocessors: List[ValuePreprocessor]) -> List[Dict[str, Any]]:
+    """
+    Summarise the float values of each value preprocessor in events the code preprocessors were applied to.
+    Values are grouped by code with one Polars aggregation per preprocessor, codes and values keep the order
+    they appear in the events.
+
+    Args:
+        transformed_events (pl.DataFrame): the code and value columns of the events
+        value_preprocessors (List[ValuePreprocessor]): the value preprocessors to collect values for
+
+    Returns:
+        List[Dict[str, Any]]: for each value preprocessor, the summary (see ValuePreprocessor._summarise) of each matching code
+    """
+    # Ensure the necessary value columns exist on the transformed data
+    if "numeric_value" in transformed_events.columns and "text_value" not in transformed_events.columns:
+        transformed_events = transformed_events.with_columns(
+            pl.col("numeric_value").cast(pl.Utf8).alias("text_value")
+        )
+
+    code_masks = MatcherSet([preprocessor.matcher for preprocessor in value_preprocessors]).masks(transformed_events["code"])
+    collected = []
+    for preprocessor, code_mask in zip(value_preprocessors, code_masks):
+        # keep matching events whose value converts to a float, as float() would
+        values = transformed_events[preprocessor.value_column]
+        matched = code_mask & values.is_not_null()
+        grouped = (
+            pl.DataFrame({"code": transformed_events["code"].filter(matched), "value": python_float(values.filter(matched))})
+            .drop_nulls("value")
+            .group_by("code", maintain_order=True)
+            .agg(pl.col("value"))
+        )
+        collected.append({code: preprocessor._summarise(code_values.to_numpy()) for code, code_values in zip(grouped["code"], grouped["value"])})
+    return collected
+
+def fit_preprocessors_jointly(preprocessors: List[BasePreprocessor], event_files: List[str], workers: int = 1) -> None:
+    """
+    Fit multiple preprocessors jointly by reading through the data files only once, see
+    fit_scheduler.fit_preprocessors_jointly. Kept here so existing imports from utils keep working.
+
     Args:
         preprocessors (List[BasePreprocessor]): list of preprocessors to fit
         event_files (List[str]): list of parquet file paths to train on
+        workers (int): number of worker processes used to read the files (1 reads serially)
 
     Returns:
         None
     """
-    # Validate all files exist before processing
-    for file_path in event_files:
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"Event file not found: {file_path}")
-    
-    # Separate preprocessors by type
-    value_preprocessors = [p for p in preprocessors if isinstance(p, ValuePreprocessor)]
-    code_preprocessors = [p for p in preprocessors if isinstance(p, CodePreprocessor)]
-    other_preprocessors = [p for p in preprocessors if not isinstance(p, (ValuePreprocessor, CodePreprocessor))]
-    
-    # Fit code preprocessors (they don't need to read event files for training data)
-    for preprocessor in tqdm(code_preprocessors, desc="Fitting code preprocessors", leave=False):
-        preprocessor.fit(event_files)
-    
-    # Fit other preprocessors (they handle their own fitting logic)
-    for preprocessor in tqdm(other_preprocessors, desc="Fitting other preprocessors", leave=False):
-        preprocessor.fit(event_files)
-    
-    # If there are no value preprocessors, we're done
-    if not value_preprocessors:
-        return
-    
-    # Loop through each event file once and collect data for all value preprocessors
-    for event_file in tqdm(event_files, desc="Collecting data for value preprocessors"):
-        events = pl.read_parquet(event_file)
-        
-        transformed_events = events
-        for preprocessor in code_preprocessors:
-            transformed_events = preprocessor.encode_polars(transformed_events)
-            
-        # Ensure the necessary value columns exist on the transformed data
-        if "numeric_value" in transformed_events.columns and "text_value" not in transformed_events.columns:
-            transformed_events = transformed_events.with_columns(
-                pl.col("numeric_value").cast(pl.Utf8).alias("text_value")
-            )
-
-        # Now, collect data for fitting from the *transformed* events
-        for event in transformed_events.to_dicts():
-            for preprocessor in value_preprocessors:
-                value = event[preprocessor.value_column]
-                
-                if value is not None and preprocessor._match(event["code"]):
-                    try:
-                        value_float = float(value)
-                    except (ValueError, TypeError):
-                        continue
-                    if event["code"] not in preprocessor.data:
-                        preprocessor.data[event["code"]] = []
-                    preprocessor.data[event["code"]].append(value_float)
-    
-    # Finally, fit the value preprocessors with the correctly collected data
-    for preprocessor in tqdm(value_preprocessors, desc="Fitting value preprocessors", leave=False):
-        preprocessor._fit()
\ No newline at end of file
+    from .fit_scheduler import fit_preprocessors_jointly as fit_jointly
+
+    fit_jointly(preprocessors, event_files, workers=workers)
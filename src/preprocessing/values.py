@@ -0,0 +1,109 @@
+from typing import Callable
+import time
+import numpy as np
+import polars as pl
+
+# Column-level versions of the Python conversions the row-wise code applies to each value.
+# Polars' own string <-> float conversions differ from Python's (e.g. '1e+16' vs '1e16',
+# ' 5' and '1_000' are rejected by the cast), so Python is applied once per distinct value.
+
+def map_unique_floats(values: pl.Series, function: Callable[[float], str]) -> pl.Series:
+    """
+    Apply a Python float -> str function once per distinct float value, nulls stay null.
+    Values are deduplicated by bit pattern, so -0.0 and NaN payloads are kept apart.
+
+    Args:
+        values (pl.Series): a Float32 or Float64 series
+        function (Callable[[float], str]): the function to apply to each Python float
+
+    Returns:
+        pl.Series: the String results
+    """
+    array = values.fill_null(0).to_numpy()
+    bits = array.view(np.uint32 if array.dtype == np.float32 else np.uint64)
+    unique_bits, inverse = np.unique(bits, return_inverse=True)
+    unique_strings = np.array([function(float(value)) for value in unique_bits.view(array.dtype)], dtype=object)
+    formatted = pl.Series(values.name, unique_strings[inverse.reshape(-1)], dtype=pl.String)
+    return pl.select(pl.when(values.is_null()).then(None).otherwise(formatted).alias(values.name)).to_series()
+
+def python_str(values: pl.Series) -> pl.Series:
+    """
+    Format a column as the strings str() gives for its Python values, nulls stay null.
+
+    Args:
+        values (pl.Series): the values to format
+
+    Returns:
+        pl.Series: the formatted values
+    """
+    if values.dtype == pl.String:
+        return values
+    if values.dtype.is_integer():
+        return values.cast(pl.String)
+    if values.dtype in (pl.Float32, pl.Float64):
+        return map_unique_floats(values, str)
+    return values.map_elements(str, return_dtype=pl.String)
+
+def python_float(values: pl.Series) -> pl.Series:
+    """
+    Convert a column as float() converts its Python values. Values float() rejects become null.
+    Strings are parsed natively first, only those the native cast rejects are retried with float().
+
+    Args:
+        values (pl.Series): the values to convert
+
+    Returns:
+        pl.Series: the Float64 values
+    """
+    if values.dtype == pl.Float64:
+        return values
+    if values.dtype.is_numeric() or values.dtype == pl.Boolean:
+        return values.cast(pl.Float64)
+    if values.dtype != pl.String:
+        values = python_str(values)
+
+    floats = values.cast(pl.Float64, strict=False)
+    rejected = floats.is_null() & values.is_not_null()
+    if not rejected.any():
+        return floats
+
+    def parse(value: str):
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return None
+
+    rejected_values = values.filter(rejected)
+    parsed = {value: parse(value) for value in rejected_values.unique().to_list()}
+    return floats.scatter(rejected.arg_true(), pl.Series([parsed[value] for value in rejected_values], dtype=pl.Float64))
+
+def python_timestamp(times: pl.Series) -> pl.Series:
+    """
+    Convert a Datetime column to seconds since the epoch as datetime.timestamp() does,
+    naive datetimes are interpreted in local time. Nulls stay null.
+
+    Args:
+        times (pl.Series): the Datetime column
+
+    Returns:
+        pl.Series: the Float64 timestamps
+    """
+    nulls = times.is_null().to_numpy()
+    if times.dtype.time_zone is not None:
+        seconds = (times.dt.epoch("us").fill_null(0).to_numpy() / 1e6).astype(np.float64)
+    elif times.dtype.time_unit == "us" and local_time_is_utc():
+        # Without a UTC offset this is the arithmetic datetime.timestamp() does
+        physical = times.to_physical().fill_null(0).to_numpy()
+        seconds = (physical // 1_000_000).astype(np.float64) + (physical % 1_000_000) / 1e6
+    else:
+        # The local UTC offset depends on the date, so convert each distinct datetime once
+        physical = times.to_physical().fill_null(0).to_numpy()
+        unique_physical, inverse = np.unique(physical, return_inverse=True)
+        unique_datetimes = pl.Series(unique_physical).cast(times.dtype).to_list()
+        unique_seconds = np.array([value.timestamp() for value in unique_datetimes], dtype=np.float64)
+        seconds = unique_seconds[inverse.reshape(-1)]
+    return pl.Series(times.name, seconds, dtype=pl.Float64).scatter(np.flatnonzero(nulls), None)
+
+def local_time_is_utc() -> bool:
+    """Whether naive datetimes are interpreted as UTC, i.e. the local time zone is UTC."""
+    return time.daylight == 0 and time.timezone == 0 and time.tzname[0] == "UTC"
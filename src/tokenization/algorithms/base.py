@@ -1,9 +1,17 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 import polars as pl
+import numpy as np
 from src.preprocessing.base import BasePreprocessor
+from src.preprocessing.fit_scheduler import ShardConsumer
+from src.preprocessing.utils import stream_events
+from src.preprocessing.values import python_str, python_timestamp
+from src.postprocessing.base import Postprocessor
 from abc import ABC, abstractmethod
 import datetime
 
+# Placeholder code of static events that only carry a value, it is never emitted as a token
+NO_CODE = "STATIC_DATA_NO_CODE"
+
 class Tokenizer(ABC):
     """
     A base class for tokenizers. Tokenizers are responsible for converting sequences of events into tokens.
@@ -50,6 +58,20 @@ class Tokenizer(ABC):
             self.end_token: 2,
         }
 
+    def fit_consumer(self, preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor]) -> Optional[ShardConsumer]:
+        """
+        The consumer that trains the tokenizer from a shared read of the train files, see
+        src.preprocessing.fit_scheduler. None trains it with train(event_files, ...) instead.
+
+        Args:
+            preprocessors (List[BasePreprocessor]): the fitted preprocessors applied to the events
+            postprocessors (List[Postprocessor]): the postprocessors applied to the events
+
+        Returns:
+            Optional[ShardConsumer]: the consumer, or None
+        """
+        return None
+
     def _process_events(self, events: pl.DataFrame) -> List[str]:
         """
         Convert events DataFrame into list of strings for tokenization.
@@ -60,31 +82,151 @@ class Tokenizer(ABC):
         Returns:
             List[str]: the processed events
         """
-        processed_events = []
-        print(events.columns)
-        
-        for subject_id, subject_events in events.group_by("subject_id", maintain_order=True):
-
-            event_list = []
-            for event in subject_events.to_dicts():
-                event_dict = {
-                    "code": event["code"],
-                    "timestamp": event["time"],
-                    "numeric_value": event["numeric_value"],
-                    "text_value": event["text_value"],
-                    "unit": event.get("unit")
-                }
-                event_list.append(event_dict)
-
-            processed_events.append(
-                {
-                    "subject_id": subject_id,
-                    "event_list": event_list,
-                }
-            )
-
-        return processed_events
-    
+        # Build every subject's event list in one aggregation and convert it to Python once
+        unit = pl.col("unit") if "unit" in events.columns else pl.lit(None)
+        grouped = events.group_by("subject_id", maintain_order=True).agg(
+            pl.struct(
+                pl.col("code"),
+                pl.col("time").alias("timestamp"),
+                pl.col("numeric_value"),
+                pl.col("text_value"),
+                unit.alias("unit"),
+            ).alias("event_list")
+        )
+
+        # subject_id is kept as the group key tuple, as consumers read x["subject_id"][0]
+        return [
+            {"subject_id": (subject_id,), "event_list": event_list}
+            for subject_id, event_list in zip(grouped["subject_id"].to_list(), grouped["event_list"].to_list())
+        ]
+
+    def _flatten_events(self, events: pl.DataFrame, postprocessors: List[Postprocessor]) -> Dict[str, List]:
+        """
+        Convert preprocessed events into per-subject token strings and timestamps.
+        Without postprocessors this runs as columnar Polars expressions, postprocessors
+        operate on Python event lists so they go through _process_events and _events_to_lists.
+
+        Args:
+            events (pl.DataFrame): the preprocessed events
+            postprocessors (List[Postprocessor]): the postprocessors to apply
+
+        Returns:
+            Dict[str, List]: the subject_ids, strings and timestamps of every subject
+        """
+        if not postprocessors and self._supports_columnar(events):
+            return self._events_to_lists_columnar(events)
+
+        processed_events = self._process_events(events)
+        for postprocessor in postprocessors or []:
+            processed_events = postprocessor.encode(processed_events)
+
+        result = self._events_to_lists(processed_events)
+        result["subject_ids"] = [x["subject_id"][0] for x in processed_events]
+        return result
+
+    @staticmethod
+    def _supports_columnar(events: pl.DataFrame) -> bool:
+        """Whether _events_to_lists_columnar reproduces _events_to_lists for these events."""
+        return (
+            events.schema.get("code") == pl.String
+            and isinstance(events.schema.get("time"), pl.Datetime)
+            and events["code"].null_count() == 0
+            and events["subject_id"].null_count() == 0
+        )
+
+    def _events_to_lists_columnar(self, events: pl.DataFrame) -> Dict[str, List]:
+        """
+        Columnar equivalent of _process_events followed by _events_to_lists.
+        Every token slot of an event (event tokens, code, values, unit) is a Polars expression
+        that is null when the slot is skipped, values are formatted with Python's str once per
+        distinct value.
+
+        Args:
+            events (pl.DataFrame): the preprocessed events, with a String code and Datetime time column
+
+        Returns:
+            Dict[str, List]: the subject_ids, strings and timestamps of every subject
+        """
+        value_columns = [column for column in ["numeric_value", "text_value", "unit"] if column in events.columns]
+        frame = events.select(
+            pl.col("subject_id"),
+            pl.col("code"),
+            python_timestamp(events["time"]).alias("timestamp"),
+            *[python_str(events[column]) for column in value_columns],
+        )
+
+        def when_present(column: str, token) -> pl.Expr:
+            return pl.when(pl.col(column).is_not_null()).then(token)
+
+        pieces = []
+        if self.insert_event_tokens:
+            pieces.append(pl.lit(self.event_start_token))
+        pieces.append(pl.when(pl.col("code") != NO_CODE).then(pl.col("code")))
+        for column, insert_tokens, start_token, end_token in [
+            ("numeric_value", self.insert_numeric_tokens, "<numeric>", "</numeric>"),
+            ("text_value", self.insert_text_tokens, "<text>", "</text>"),
+        ]:
+            if column not in value_columns:
+                continue
+            if insert_tokens:
+                pieces.extend([when_present(column, pl.lit(start_token)), pl.col(column), when_present(column, pl.lit(end_token))])
+            else:
+                pieces.append(pl.col(column))
+        if "unit" in value_columns:
+            pieces.append(pl.col("unit"))
+        if self.insert_event_tokens:
+            pieces.append(pl.lit(self.event_end_token))
+
+        # One row per token: stack the pieces, interleave them back into event order and
+        # drop the skipped (null) ones, every token shares its event's timestamp
+        num_events, num_pieces = frame.height, len(pieces)
+        stacked = pl.concat([frame.with_columns(piece.cast(pl.String).alias("string"))["string"] for piece in pieces])
+        order = np.arange(num_events * num_pieces).reshape(num_pieces, num_events).T.reshape(-1)
+        tokens = pl.DataFrame({
+            "string": stacked.gather(order),
+            "event": np.repeat(np.arange(num_events), num_pieces),
+        }).drop_nulls("string")
+        tokens = pl.DataFrame({
+            "subject_id": frame["subject_id"].gather(tokens["event"]),
+            "string": tokens["string"],
+            "timestamp": frame["timestamp"].gather(tokens["event"]),
+        })
+
+        # Subjects in order of their first event, a subject may have events without any tokens
+        subjects = frame.group_by("subject_id", maintain_order=True).agg(
+            pl.col("timestamp").last().alias("end_timestamp"),
+            pl.col("timestamp").is_null().any().alias("untimed"),
+        )
+        subject_tokens = tokens.group_by("subject_id", maintain_order=True).agg(
+            pl.col("string").alias("strings"),
+            pl.col("timestamp").alias("timestamps"),
+        )
+        subjects = subjects.join(subject_tokens, on="subject_id", how="left", maintain_order="left").with_columns(
+            pl.col("strings").fill_null(pl.lit([], dtype=pl.List(pl.String))),
+            pl.col("timestamps").fill_null(pl.lit([], dtype=pl.List(pl.Float64))),
+        )
+
+        # Wrap each subject in <start> (timestamp 0) and <end> (timestamp of the last event)
+        subjects = subjects.select(
+            pl.col("subject_id"),
+            pl.concat_list(pl.lit(self.start_token), pl.col("strings"), pl.lit(self.end_token)).alias("strings"),
+            pl.concat_list(pl.lit(0.0), pl.col("timestamps"), pl.col("end_timestamp")).alias("timestamps"),
+            pl.col("untimed"),
+        )
+
+        # <start> and untimed events get the int 0 that _events_to_lists gives them
+        timestamps = subjects["timestamps"].to_list()
+        for subject_timestamps, untimed in zip(timestamps, subjects["untimed"]):
+            if untimed:
+                subject_timestamps[:] = [0 if timestamp is None else timestamp for timestamp in subject_timestamps]
+            subject_timestamps[0] = 0
+
+        return {
+            "subject_ids": subjects["subject_id"].to_list(),
+            "strings": subjects["strings"].to_list(),
+            "timestamps": timestamps,
+        }
+
     def _events_to_lists(self, events: List[dict]) -> Dict[str, List[str]]:
         """
         Convert a list of events to a string.
@@ -181,6 +323,29 @@ class Tokenizer(ABC):
     def encode(self, events: pl.DataFrame, preprocessors: List[BasePreprocessor], allow_unknown: bool = False) -> List[int]:
         raise NotImplementedError("Subclasses must implement this method")
 
+    @abstractmethod
+    def encode_events(self, events: pl.DataFrame, postprocessors: List[Postprocessor]) -> List[dict]:
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def encode_stream(self, event_filepath: str, preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor], row_budget: int) -> Iterator[List[dict]]:
+        """
+        Encode an event file about row_budget rows at a time, see src.preprocessing.utils.stream_events.
+        Only one batch of events, and its post-processed events and strings, is held in memory at a time.
+        The timelines of the batches, in order, are the timelines encode returns.
+
+        Args:
+            event_filepath (str): the parquet file to encode
+            preprocessors (List[BasePreprocessor]): the fitted preprocessors to apply
+            postprocessors (List[Postprocessor]): the postprocessors to apply
+            row_budget (int): number of event rows to read at a time
+
+        Yields:
+            List[dict]: the timelines of the subjects of one batch
+        """
+        for events in stream_events(event_filepath, preprocessors or [], row_budget):
+            yield self.encode_events(events, postprocessors)
+
     def __str__(self) -> str:
         return f"Tokenizer: {self.tokenizer_name}\n" \
-               f"Vocab size: {len(self.vocab)}\n"
\ No newline at end of file
+               f"Vocab size: {len(self.vocab)}\n"
+
@@ -1,10 +1,13 @@
 from src.tokenization.algorithms.base import Tokenizer
 from typing import List, Dict, Tuple
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
+import heapq
 import polars as pl
-import gc
+from functools import partial
 from tqdm import tqdm
 from src.preprocessing.base import BasePreprocessor
+from src.preprocessing.utils import load_events
+from src.preprocessing.fit_scheduler import FitScheduler, ShardConsumer
 from src.postprocessing.base import Postprocessor
 
 class BPETokenizer(Tokenizer):
@@ -19,12 +22,17 @@ class BPETokenizer(Tokenizer):
         insert_numeric_tokens (bool): whether to insert numeric tokens.
         insert_text_tokens (bool): whether to insert text tokens.
         end_of_word_suffix (str): suffix to mark end of words (default: "</w>")
+        cache_size (int): maximum number of words in the word -> token ids cache, 0 disables it
     """
+    # The word cache and its counters change with every shard encoded, they are not fitted state
+    _transient_state = ("word_cache", "cache_hits", "cache_misses")
+
     def __init__(self, vocab_size: int = 1000, 
                  insert_event_tokens: bool = True, 
                  insert_numeric_tokens: bool = True, 
                  insert_text_tokens: bool = True,
-                 end_of_word_suffix: str = "</w>") -> None:
+                 end_of_word_suffix: str = "</w>",
+                 cache_size: int = 100000) -> None:
         super().__init__("bpe", vocab_size, insert_event_tokens, 
                         insert_numeric_tokens, insert_text_tokens)
         
@@ -32,11 +40,23 @@ class BPETokenizer(Tokenizer):
         self.merges = []  # List of (pair, new_token) tuples in order of learning
         self.merge_ranks = {}  # Maps pair tuples to their merge priority
         
+        # Bounded LRU cache of word -> token ids, seeded at the end of training
+        self.cache_size = cache_size
+        self.word_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        
         # Initialize vocab_map with special tokens
         self.vocab_map = {
             token: idx for token, idx in self.special_tokens.items()
         }
     
+    def _reset_transient_state(self) -> None:
+        """Empty the word cache, e.g. after fitted state is loaded without it. It refills as words are encoded."""
+        self.word_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
     def _tokenize_word(self, word: str) -> List[str]:
         """Split a word into characters with end-of-word marker."""
         if not word:
@@ -82,44 +102,61 @@ class BPETokenizer(Tokenizer):
             raise ValueError("event_files list cannot be empty")
         
         print(f"Training BPE tokenizer on {len(event_files)} files...")
-        
-        # Step 1: Collect all words and their frequencies
+        FitScheduler(event_files).register(self.fit_consumer(preprocessors, postprocessors)).run()
+
+    def fit_consumer(self, preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor]) -> ShardConsumer:
+        """
+        The consumer that collects the words of each train file and learns the merges from them.
+
+        Args:
+            preprocessors (List[BasePreprocessor]): the fitted preprocessors applied to the events
+            postprocessors (List[Postprocessor]): the postprocessors applied to the events
+
+        Returns:
+            ShardConsumer: the consumer
+        """
+        return ShardConsumer("BPE words", partial(self._collect_words, postprocessors=postprocessors), self._train_from_words, preprocessors=preprocessors, fits=[self])
+
+    def _collect_words(self, events: pl.DataFrame, postprocessors: List[Postprocessor]) -> Tuple[Counter, List[List[str]]]:
+        """
+        Count the words of one file's preprocessed events.
+
+        Args:
+            events (pl.DataFrame): the preprocessed events
+            postprocessors (List[Postprocessor]): the postprocessors to apply
+
+        Returns:
+            Tuple[Counter, List[List[str]]]: word -> frequency in order of first occurrence, and the first 3 trajectories
+        """
+        subject_strs = self._flatten_events(events, postprocessors)["strings"]
+
         word_freqs = Counter()
-        sample_trajectories = []
-        
-        for file_idx, file_path in enumerate(tqdm(event_files, desc="Collecting words")):
-            events = pl.read_parquet(file_path)
-            
-            if len(preprocessors) > 0:
-                for preprocessor in preprocessors:
-                    events = preprocessor.encode_polars(events)
-            
-            processed_events = self._process_events(events)
-            
-            if len(postprocessors) > 0:
-                for postprocessor in postprocessors:
-                    processed_events = postprocessor.encode(processed_events)
-            
-            subject_strs = self._events_to_lists(processed_events)["strings"]
-            
-            # Collect sample trajectories from first file
-            if file_idx == 0 and len(sample_trajectories) < 3:
-                for i, string_list in enumerate(subject_strs[:3]):
-                    sample_trajectories.append(string_list)
+        for string_list in subject_strs:
+            for word in string_list:
+                if word not in self.special_tokens:
+                    word_freqs[word] += 1
+        return word_freqs, subject_strs[:3]
+
+    def _train_from_words(self, file_words: List[Tuple[Counter, List[List[str]]]]) -> None:
+        """
+        Learn the vocabulary and merges from the words of every train file, see _collect_words.
+
+        Args:
+            file_words (List[Tuple[Counter, List[List[str]]]]): per file, the word frequencies and sample trajectories
+        """
+        # Step 1: Collect all words and their frequencies, in order of first occurrence
+        word_freqs = Counter()
+        for file_idx, (file_word_freqs, samples) in enumerate(file_words):
+            # Show sample trajectories from first file
+            if file_idx == 0:
+                for i, string_list in enumerate(samples):
                     print(f"\n=== Sample Trajectory {i+1} ===")
                     print(f"Length: {len(string_list)} tokens")
                     print(f"First 20 tokens: {string_list[:20]}")
                     if len(string_list) > 20:
                         print(f"Last 10 tokens: {string_list[-10:]}")
                     print("=" * 50)
-            
-            for string_list in subject_strs:
-                for word in string_list:
-                    if word not in self.special_tokens:
-                        word_freqs[word] += 1
-            
-            del events, processed_events, subject_strs
-            gc.collect()
+            word_freqs.update(file_word_freqs)
         
         print(f"Found {len(word_freqs)} unique words")
         
@@ -143,23 +180,66 @@ class BPETokenizer(Tokenizer):
         
         # Step 3: Learn merges
         num_merges = self.vocab_size - len(self.vocab_map)
+        self._learn_merges(word_freqs, split_words, num_merges, next_token_id)
+        
+        print(f"Training complete! Learned {len(self.merges)} merges")
+        print(f"Final vocabulary size: {len(self.vocab_map)}")
+        
+        # Build the vocab DataFrame for compatibility
+        vocab_rows = [
+            {"token": token_id, "str": token_str, "count": 0}
+            for token_str, token_id in self.vocab_map.items()
+        ]
+        self.vocab = pl.DataFrame(vocab_rows)
+        
+        self._seed_word_cache(word_freqs)
+    
+    def _learn_merges(self, word_freqs: Counter, split_words: Dict[str, List[str]],
+                      num_merges: int, next_token_id: int) -> None:
+        """
+        Learn up to num_merges merges and add them to the vocabulary.
+        Pair frequencies are maintained incrementally: a pair -> words inverted index
+        finds the words containing the merged pair and only those words are rewritten
+        and re-counted. A lazy min-heap of pair keys (stale entries are skipped when
+        popped) gives the most frequent pair, see _pair_key.
+        
+        The result matches recounting every pair before every merge: a pair counts
+        once per word containing it, weighted by the word frequency, and ties go to
+        the pair that occurs first in the earliest word containing one of the tied pairs.
+        
+        Args:
+            word_freqs (Counter): word -> frequency, in order of first occurrence
+            split_words (Dict[str, List[str]]): word -> its current tokens, updated in place
+            num_merges (int): the maximum number of merges to learn
+            next_token_id (int): the id of the first merged token
+        """
+        words = list(word_freqs.keys())
+        word_tokens = [split_words[word] for word in words]
+        freqs = [word_freqs[word] for word in words]
+        
+        # Initial pair counts, inverted index and the first word containing each pair
+        pair_freqs = defaultdict(int)
+        pair_words = defaultdict(set)
+        pair_first = {}
+        for word_idx, tokens in enumerate(word_tokens):
+            for pair in self._get_pairs(tokens):
+                pair_freqs[pair] += freqs[word_idx]
+                pair_words[pair].add(word_idx)
+                pair_first.setdefault(pair, word_idx)
+        
+        # The current key of every pair, a heap entry is valid only while it holds that key
+        pair_keys = {
+            pair: self._pair_key(pair, pair_freqs, pair_first, word_tokens) for pair in pair_freqs
+        }
+        heap = [(*key, pair) for pair, key in pair_keys.items()]
+        heapq.heapify(heap)
         
         for merge_idx in tqdm(range(num_merges), desc="Learning merges"):
-            # Count all pairs across all words (weighted by word frequency)
-            pair_freqs = Counter()
-            for word, freq in word_freqs.items():
-                word_tokens = split_words[word]
-                pairs = self._get_pairs(word_tokens)
-                for pair in pairs:
-                    pair_freqs[pair] += freq
-            
-            if not pair_freqs:
+            best_pair = self._pop_best_pair(heap, pair_keys)
+            if best_pair is None:
                 print(f"No more pairs to merge. Stopping at {len(self.vocab_map)} tokens.")
                 break
             
-            # Find most frequent pair
-            best_pair = max(pair_freqs, key=pair_freqs.get)
-            
             # Create merged token
             merged_token = ''.join(best_pair)
             
@@ -171,21 +251,112 @@ class BPETokenizer(Tokenizer):
             self.merges.append((best_pair, merged_token))
             self.merge_ranks[best_pair] = merge_idx
             
-            # Update all words with this merge
-            for word in split_words:
-                split_words[word] = self._merge_pair(
-                    split_words[word], best_pair, merged_token
-                )
+            # Rewrite only the words containing the pair and update their pair counts. A pair the
+            # word keeps may have moved within it, it is re-keyed when this is its first word
+            changed_pairs = {best_pair}
+            for word_idx in list(pair_words[best_pair]):
+                old_pairs = self._get_pairs(word_tokens[word_idx])
+                word_tokens[word_idx] = self._merge_pair(word_tokens[word_idx], best_pair, merged_token)
+                new_pairs = self._get_pairs(word_tokens[word_idx])
+                
+                for pair in old_pairs - new_pairs:
+                    pair_freqs[pair] -= freqs[word_idx]
+                    pair_words[pair].discard(word_idx)
+                    if pair_first[pair] == word_idx:
+                        pair_first[pair] = min(pair_words[pair], default=None)
+                for pair in new_pairs - old_pairs:
+                    pair_freqs[pair] += freqs[word_idx]
+                    pair_words[pair].add(word_idx)
+                    if pair_first.get(pair) is None or word_idx < pair_first[pair]:
+                        pair_first[pair] = word_idx
+                changed_pairs |= old_pairs ^ new_pairs
+                changed_pairs.update(pair for pair in old_pairs & new_pairs if pair_first[pair] == word_idx)
+            
+            for pair in changed_pairs:
+                if pair_freqs[pair] > 0:
+                    key = self._pair_key(pair, pair_freqs, pair_first, word_tokens)
+                    if key != pair_keys.get(pair):
+                        pair_keys[pair] = key
+                        heapq.heappush(heap, (*key, pair))
+                else:
+                    del pair_freqs[pair], pair_words[pair], pair_first[pair]
+                    pair_keys.pop(pair, None)
         
-        print(f"Training complete! Learned {len(self.merges)} merges")
-        print(f"Final vocabulary size: {len(self.vocab_map)}")
+        for word, tokens in zip(words, word_tokens):
+            split_words[word] = tokens
+    
+    @staticmethod
+    def _pair_key(pair: Tuple[str, str], pair_freqs: Dict[Tuple[str, str], int],
+                  pair_first: Dict[Tuple[str, str], int],
+                  word_tokens: List[List[str]]) -> Tuple[int, int, int]:
+        """
+        The heap key of a pair: (-frequency, first word containing it, its first position
+        in that word). The smallest key is the most frequent pair, and among pairs tied on
+        frequency the one that occurs first, in token order, in the earliest word containing
+        one of them. Two pairs never share a word and position, so the key decides every tie.
+        """
+        first_word = pair_first[pair]
+        tokens = word_tokens[first_word]
+        position = next(i for i, word_pair in enumerate(zip(tokens, tokens[1:])) if word_pair == pair)
+        return -pair_freqs[pair], first_word, position
+    
+    def _pop_best_pair(self, heap: list,
+                       pair_keys: Dict[Tuple[str, str], Tuple[int, int, int]]) -> Tuple[str, str]:
+        """
+        Pop the pair with the smallest key from the heap, or None if there are no pairs left.
+        Entries whose key is no longer the pair's current key are stale and skipped.
+        """
+        while heap:
+            *key, pair = heapq.heappop(heap)
+            if pair_keys.get(pair) == tuple(key):
+                del pair_keys[pair]
+                return pair
+        return None
+    
+    def _seed_word_cache(self, word_freqs: Counter) -> None:
+        """
+        Fill the word cache with the encodings of the most frequent training words.
+        They are inserted least frequent first, so the most frequent words are evicted last.
         
-        # Build the vocab DataFrame for compatibility
-        vocab_rows = [
-            {"token": token_id, "str": token_str, "count": 0}
-            for token_str, token_id in self.vocab_map.items()
-        ]
-        self.vocab = pl.DataFrame(vocab_rows)
+        Args:
+            word_freqs (Counter): word -> frequency of the training words
+        """
+        self.word_cache.clear()
+        if self.cache_size <= 0:
+            return
+        for word, _ in reversed(word_freqs.most_common(self.cache_size)):
+            self._encode_word_ids(word)
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    def _encode_word_ids(self, word: str) -> List[int]:
+        """
+        Encode a single word into token ids, using the word cache.
+        The returned list is shared with the cache and must not be modified.
+        """
+        token_ids = self.word_cache.get(word)
+        if token_ids is not None:
+            self.word_cache.move_to_end(word)
+            self.cache_hits += 1
+            return token_ids
+        
+        self.cache_misses += 1
+        unknown_id = self.vocab_map[self.unknown_token]
+        token_ids = [self.vocab_map.get(bpe_token, unknown_id) for bpe_token in self._encode_word(word)]
+        if self.cache_size > 0:
+            self.word_cache[word] = token_ids
+            if len(self.word_cache) > self.cache_size:
+                self.word_cache.popitem(last=False)
+        return token_ids
+    
+    def cache_info(self) -> Dict[str, int]:
+        """Get the hits, misses and current size of the word cache."""
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self.word_cache),
+            "max_size": self.cache_size,
+        }
     
     def _encode_word(self, word: str) -> List[str]:
         """Encode a single word using learned BPE merges."""
@@ -223,23 +394,15 @@ class BPETokenizer(Tokenizer):
                preprocessors: List[BasePreprocessor], 
                postprocessors: List[Postprocessor]) -> List[dict]:
         """Encode events using BPE tokenization."""
+        return self.encode_events(load_events(event_filepath, preprocessors), postprocessors)
+
+    def encode_events(self, events: pl.DataFrame, postprocessors: List[Postprocessor]) -> List[dict]:
+        """Encode preprocessed events of whole subjects using BPE tokenization."""
         if not self.vocab_map or not self.merges:
             raise ValueError("Tokenizer is not trained yet.")
-        
-        events = pl.read_parquet(event_filepath)
-        
-        if len(preprocessors) > 0:
-            for preprocessor in preprocessors:
-                events = preprocessor.encode_polars(events)
-        
-        processed_events = self._process_events(events)
-        
-        if len(postprocessors) > 0:
-            for postprocessor in postprocessors:
-                processed_events = postprocessor.encode(processed_events)
-        
-        subject_ids = [x["subject_id"][0] for x in processed_events]
-        subject_event_lists = self._events_to_lists(processed_events)
+
+        subject_event_lists = self._flatten_events(events, postprocessors)
+        subject_ids = subject_event_lists["subject_ids"]
         
         timelines = []
         for subject_id, subject_strings, subject_timestamps in zip(
@@ -250,14 +413,9 @@ class BPETokenizer(Tokenizer):
             tokens = []
             expanded_timestamps = []
             for word, timestamp in zip(subject_strings, subject_timestamps):
-                bpe_tokens = self._encode_word(word)
-                for bpe_token in bpe_tokens:
-                    token_id = self.vocab_map.get(
-                        bpe_token, 
-                        self.vocab_map[self.unknown_token]
-                    )
-                    tokens.append(token_id)
-                    expanded_timestamps.append(timestamp)
+                token_ids = self._encode_word_ids(word)
+                tokens.extend(token_ids)
+                expanded_timestamps.extend([timestamp] * len(token_ids))
             
             timelines.append({
                 "subject_id": subject_id,
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import itertools
 from pathlib import Path
 from typing import Iterable, Iterator, List, Optional
 
@@ -10,6 +11,7 @@ from transformers import PreTrainedTokenizerFast
 
 from src.postprocessing.base import Postprocessor
 from src.preprocessing.base import BasePreprocessor
+from src.preprocessing.utils import load_events
 from src.tokenization.algorithms.base import Tokenizer
 
 
@@ -25,6 +27,7 @@ class HFBPETokenizer(Tokenizer):
         insert_text_tokens: bool = True,
         tokenizer_dir: Optional[str] = None,
         special_tokens: Optional[List[str]] = None,
+        encode_batch_size: Optional[int] = 1024,
     ) -> None:
         super().__init__(
             tokenizer_name="hf_bpe",
@@ -50,6 +53,9 @@ class HFBPETokenizer(Tokenizer):
         self.tokenizer_dir = Path(tokenizer_dir) if tokenizer_dir else None
         self._hf_tokenizer: Optional[PreTrainedTokenizerFast] = None
 
+        # Subjects per batched tokenizer call in encode, 0 or None encodes a whole shard at once
+        self.encode_batch_size = encode_batch_size
+
     # --------------------------------------------------------------------- #
     # Training                                                              #
     # --------------------------------------------------------------------- #
@@ -113,45 +119,67 @@ class HFBPETokenizer(Tokenizer):
         """
         Encode one parquet file into token-id timelines (with timestamps).
         """
+        return self.encode_events(load_events(event_filepath, preprocessors or []), postprocessors)
+
+    def encode_events(
+        self,
+        events: pl.DataFrame,
+        postprocessors: List[Postprocessor],
+    ) -> List[dict]:
+        """
+        Encode the preprocessed events of whole subjects into token-id timelines (with timestamps).
+        """
         if self._hf_tokenizer is None:
             if not self.tokenizer_dir:
                 raise ValueError("Tokenizer has not been trained yet.")
             self._load_existing_tokenizer(self.tokenizer_dir)
 
+        subject_lists = self._flatten_events(events, postprocessors or [])
+        subjects = zip(subject_lists["subject_ids"], subject_lists["strings"], subject_lists["timestamps"])
+
+        # Encode the pre-split word lists in batches, so the Rust tokenizer can parallelise
+        # over subjects; a batch size of 0 or None encodes the whole shard in one call
         timelines = []
-        for subject_id, strings, timestamps in self._yield_subject_sequences(
-            [event_filepath], preprocessors, postprocessors, include_subject_ids=True
-        ):
-            encoding = self._hf_tokenizer(
-                strings,
-                is_split_into_words=True,
-                add_special_tokens=False,
-                return_attention_mask=False,
-            )
+        while True:
+            batch = list(itertools.islice(subjects, self.encode_batch_size or None))
+            if not batch:
+                break
+            timelines.extend(self._encode_batch(batch))
 
-            encoded_ids = encoding.ids
-            encoded_word_ids = encoding.word_ids()
+        return timelines
 
-            expanded_timestamps = []
-            for word_id in encoded_word_ids:
-                if word_id is None:
-                    expanded_timestamps.append(0.0)
-                else:
-                    expanded_timestamps.append(timestamps[word_id])
+    # --------------------------------------------------------------------- #
+    # Helpers                                                               #
+    # --------------------------------------------------------------------- #
+    def _encode_batch(self, batch: List[tuple]) -> List[dict]:
+        """
+        Encode a batch of subjects with one tokenizer call. Each token gets the timestamp
+        of the word it came from, looked up from word_ids.
+        """
+        encoding = self._hf_tokenizer(
+            [strings for _subject_id, strings, _timestamps in batch],
+            is_split_into_words=True,
+            add_special_tokens=False,
+            return_attention_mask=False,
+        )
+
+        timelines = []
+        for idx, (subject_id, _strings, timestamps) in enumerate(batch):
+            # Tokens without a word (None) get timestamp 0.0, the rest keep their word's timestamp as is
+            expanded_timestamps = [
+                0.0 if word_id is None else timestamps[word_id] for word_id in encoding.word_ids(idx)
+            ]
 
             timelines.append(
                 {
                     "subject_id": subject_id,
-                    "tokens": encoded_ids,
+                    "tokens": encoding["input_ids"][idx],
                     "timestamps": expanded_timestamps,
                 }
             )
 
         return timelines
 
-    # --------------------------------------------------------------------- #
-    # Helpers                                                               #
-    # --------------------------------------------------------------------- #
     def _yield_subject_sequences(
         self,
         event_files: Iterable[str],
@@ -160,23 +188,14 @@ class HFBPETokenizer(Tokenizer):
         include_subject_ids: bool = False,
     ) -> Iterator:
         for file_path in event_files:
-            events = pl.read_parquet(file_path)
-
-            for preprocessor in preprocessors or []:
-                events = preprocessor.encode_polars(events)
-
-            processed_events = self._process_events(events)
-
-            for postprocessor in postprocessors or []:
-                processed_events = postprocessor.encode(processed_events)
+            events = load_events(file_path, preprocessors or [])
 
-            subject_lists = self._events_to_lists(processed_events)
+            subject_lists = self._flatten_events(events, postprocessors or [])
 
-            for idx, (strings, timestamps) in enumerate(
-                zip(subject_lists["strings"], subject_lists["timestamps"])
+            for subject_id, strings, timestamps in zip(
+                subject_lists["subject_ids"], subject_lists["strings"], subject_lists["timestamps"]
             ):
                 if include_subject_ids:
-                    subject_id = processed_events[idx]["subject_id"][0]
                     yield subject_id, strings, timestamps
                 else:
                     yield strings, timestamps
@@ -2,10 +2,11 @@ from src.tokenization.algorithms.base import Tokenizer
 from typing import List, Tuple
 from collections import Counter, defaultdict
 import polars as pl
-import gc
+from functools import partial
 import os
-from tqdm import tqdm
 from src.preprocessing.base import BasePreprocessor
+from src.preprocessing.utils import load_events
+from src.preprocessing.fit_scheduler import FitScheduler, ShardConsumer
 from src.postprocessing.base import Postprocessor
 
 class WordLevelTokenizer(Tokenizer):
@@ -59,38 +60,51 @@ class WordLevelTokenizer(Tokenizer):
                 raise FileNotFoundError(f"Event file not found: {file_path}")
         
         print(f"Training tokenizer on {len(event_files)} files...")
-        
-        # Count frequencies of all codes across all files
-        code_counts = Counter()
-        
-        for file_path in tqdm(event_files, total=len(event_files)):
-            
-            # Read one file at a time for memory efficiency processing
-            events = pl.read_parquet(file_path)
+        FitScheduler(event_files).register(self.fit_consumer(preprocessors, postprocessors)).run()
 
-            # Apply preprocessors to the events
-            if len(preprocessors) > 0:
-                for preprocessor in preprocessors:
-                    events = preprocessor.encode_polars(events)
-            
-            # Process events for this file
-            processed_events = self._process_events(events)
-            
-            # Apply postprocessors to the events
-            if len(postprocessors) > 0:
-                for postprocessor in postprocessors:
-                    processed_events = postprocessor.encode(processed_events)
+    def fit_consumer(self, preprocessors: List[BasePreprocessor], postprocessors: List[Postprocessor]) -> ShardConsumer:
+        """
+        The consumer that counts the tokens of each train file and builds the vocabulary from them.
 
-            # Convert events to string list
-            subject_strs = self._events_to_lists(processed_events)["strings"]
+        Args:
+            preprocessors (List[BasePreprocessor]): the fitted preprocessors applied to the events
+            postprocessors (List[Postprocessor]): the postprocessors applied to the events
 
-            # Update counts for this file
-            for code in subject_strs:
-                code_counts.update(code)
-            
-            # Explicitly delete large objects and force garbage collection
-            del events, processed_events, subject_strs
-            gc.collect()
+        Returns:
+            ShardConsumer: the consumer
+        """
+        return ShardConsumer("token counts", partial(self._count_tokens, postprocessors=postprocessors), self._build_vocab, preprocessors=preprocessors, fits=[self])
+
+    def _count_tokens(self, events: pl.DataFrame, postprocessors: List[Postprocessor]) -> Counter:
+        """
+        Count the tokens of one file's preprocessed events.
+
+        Args:
+            events (pl.DataFrame): the preprocessed events
+            postprocessors (List[Postprocessor]): the postprocessors to apply
+
+        Returns:
+            Counter: token -> frequency, in order of first occurrence
+        """
+        # Process events for this file, apply postprocessors and convert them to string lists
+        subject_strs = self._flatten_events(events, postprocessors)["strings"]
+
+        code_counts = Counter()
+        for code in subject_strs:
+            code_counts.update(code)
+        return code_counts
+
+    def _build_vocab(self, file_counts: List[Counter]) -> None:
+        """
+        Build the vocabulary from the token counts of every train file, see _count_tokens.
+
+        Args:
+            file_counts (List[Counter]): the token counts of each file, in file order
+        """
+        # Count frequencies of all codes across all files
+        code_counts = Counter()
+        for counts in file_counts:
+            code_counts.update(counts)
         
         print(f"Found {len(code_counts)} unique tokens across all files")
         
@@ -143,28 +157,29 @@ class WordLevelTokenizer(Tokenizer):
             postprocessors: List of postprocessors to apply to the events
             allow_unknown: Whether to use <unknown> token for out-of-vocabulary words
             
+        Returns:
+            List of dictionaries with subject_id, tokens, and timestamps for each subject
+        """
+        # Read the file with the preprocessors applied as a single query
+        return self.encode_events(load_events(event_filepath, preprocessors), postprocessors)
+
+    def encode_events(self, events: pl.DataFrame, postprocessors: List[Postprocessor]) -> List[dict]:
+        """
+        Encode preprocessed events into their corresponding token IDs.
+
+        Args:
+            events: The preprocessed events of whole subjects
+            postprocessors: List of postprocessors to apply to the events
+
         Returns:
             List of dictionaries with subject_id, tokens, and timestamps for each subject
         """
         if self.vocab.is_empty():
             raise ValueError("Tokenizer is not trained yet.")
-        
-        events = pl.read_parquet(event_filepath)
-        
-        # Apply preprocessors to the events
-        if len(preprocessors) > 0:
-            for preprocessor in preprocessors:
-                events = preprocessor.encode_polars(events)
-        
-        processed_events = self._process_events(events)
-
-        # Apply postprocessors to the events
-        if len(postprocessors) > 0:
-            for postprocessor in postprocessors:
-                processed_events = postprocessor.encode(processed_events)
 
-        subject_ids = [x["subject_id"][0] for x in processed_events]
-        subject_event_lists = self._events_to_lists(processed_events)
+        # Apply postprocessors and convert the events to string lists
+        subject_event_lists = self._flatten_events(events, postprocessors)
+        subject_ids = subject_event_lists["subject_ids"]
 
         timelines = []
         for subject_id, subject_strings, subject_timestamps in zip(subject_ids, subject_event_lists["strings"], subject_event_lists["timestamps"]):